@@ -0,0 +1,186 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Benchmarks of the hot paths
+# Every case is timed over a sweep of number of particles (N) and / or number of wall panels, as the best of a few
+# repeats on a fresh state. Results are written to JSON with a description of the machine, and compared against a
+# stored baseline: a case is a regression if it is slower than the baseline by more than the tolerance
+# (times below a noise floor are not compared). The first run on a machine, with no baseline file yet, writes the baseline.
+# python -c "import benchmark; benchmark.runBenchmarks()"     will time all cases and compare them with BASELINE
+
+import os
+import time
+import json
+import math
+import platform
+import numpy
+import definations as dfn
+import wallBC
+import diffusion
+import tInt
+import matplotlib.pyplot as plt
+
+# Baseline results, kept next to this file
+BASELINE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmarkBaseline.json')
+
+def randomVortices(N,rad=1.0,seed=0):
+	"""N Chorin blobs of random strength in an annulus from 1.05*rad to 3*rad around the origin"""
+	rng=numpy.random.RandomState(seed)
+	r=rad*(1.05+1.95*rng.uniform(size=N))
+	theta=2*math.pi*rng.uniform(size=N)
+	V=dfn.vortexList()
+	V.addVortices(numpy.array([r*numpy.cos(theta),r*numpy.sin(theta)]).transpose(),rng.uniform(-0.01,0.01,N),2,0.03)
+	return(V)
+
+def cylinderWall(nPanels,rad=1.0):
+	"""Wall (wallNPNSBC) of a cylinder with nPanels panels"""
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(rad,nPanels)
+	return(wallBC.wallNPNSBC(points,cp,normals,inF,reF))
+
+def caseVelField(N,nPanels):
+	"""definations.velField of N blobs on themselves"""
+	V=randomVortices(N)
+	return(lambda: dfn.velField(V.pos,[V],numpy.array([1.0,0.0])))
+
+def caseLinFieldEffect(N,nPanels):
+	"""Velocity of the sheets of nPanels panels at N points (linVortList, batched path used by velField)"""
+	BC=cylinderWall(nPanels)
+	BC.findVcp([],numpy.array([1.0,0.0]))
+	BC.applyNPBC([])
+	pos=randomVortices(N).pos
+	return(lambda: BC.linList.batchFieldEffect(pos))
+
+def caseLinNPA(N,nPanels):
+	"""Influence matrix of nPanels panels (wallBC.linNPA), without the cache"""
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,nPanels)
+	return(lambda: wallBC.linNPA(points,cp,normals,cache=False))
+
+def caseSolveGamma(N,nPanels):
+	"""Sheet strengths of nPanels panels from the cached factorization of the wall (wallBC.solveGamma), as in applyNPBC"""
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,nPanels)
+	Ainv=wallBC.factorA(wallBC.linNPA(points,cp,normals))
+	B=wallBC.NPB(points,numpy.zeros([nPanels,2])+numpy.array([1.0,0.0]),normals)
+	return(lambda: wallBC.solveGamma(Ainv,B))
+
+def caseApplyRVM(N,nPanels):
+	"""One random walk step of N blobs with reflection at a cylinder (diffusion.applyRVM)"""
+	V=randomVortices(N)
+	BCList=[cylinderWall(nPanels)]
+	rng=diffusion.makeRNG(0)
+	return(lambda: diffusion.applyRVM(0.1,0.002,[V],BCList,rng))
+
+def caseAdvectRK2(N,nPanels):
+	"""One advection step (tInt.advectRK2) of N blobs around a cylinder of nPanels panels"""
+	V=randomVortices(N)
+	BCList=[cylinderWall(nPanels)]
+	return(lambda: tInt.advectRK2(0.05,[V],[V],numpy.array([1.0,0.0]),BCList))
+
+# Case name, setup (returning the function to time) and the sweeps it depends on
+CASES=[['velField',caseVelField,['N']],
+	['linVortList.fieldEffect',caseLinFieldEffect,['N','nPanels']],
+	['linNPA',caseLinNPA,['nPanels']],
+	['solveGamma',caseSolveGamma,['nPanels']],
+	['applyRVM',caseApplyRVM,['N']],
+	['advectRK2',caseAdvectRK2,['N','nPanels']]]
+
+def timeCase(setup,N,nPanels,repeat=3):
+	"""Best time of repeat runs, each on a fresh state from setup"""
+	best=float('inf')
+	for k in range(repeat):
+		run=setup(N,nPanels)
+		start=time.time()
+		run()
+		best=min(best,time.time()-start)
+	return(best)
+
+def machine():
+	"""Description of the machine and versions, kept with the results"""
+	return({'python':platform.python_version(),'numpy':numpy.__version__,'platform':platform.platform(),
+		'processor':platform.processor(),'date':time.strftime('%Y-%m-%d %H:%M:%S')})
+
+def runSuite(Ns=[500,1000,2000,4000],panels=[25,50,100],repeat=3,cases=None):
+	"""Time the cases (all, or those named in cases) over the sweeps. Cases which do not depend on a sweep
+	are run at its middle value. Returns the results as a list of dictionaries (case, N, nPanels, time)"""
+	results=[]
+	for [name,setup,sweeps] in CASES:
+		if cases is not None and name not in cases:
+			continue
+		NList=Ns if 'N' in sweeps else [Ns[len(Ns)//2]]
+		panelList=panels if 'nPanels' in sweeps else [panels[len(panels)//2]]
+		for N in NList:
+			for nPanels in panelList:
+				t=timeCase(setup,N,nPanels,repeat)
+				print "%-24s N=%6i panels=%4i  %10.6f s" %(name,N,nPanels,t)
+				results.append({'case':name,'N':N,'nPanels':nPanels,'time':t})
+	return(results)
+
+def saveResults(results,fileName):
+	"""Write results with the machine description to a JSON file"""
+	f=open(fileName,'w')
+	try:
+		json.dump({'machine':machine(),'results':results},f,indent=1)
+	finally:
+		f.close()
+
+def loadResults(fileName):
+	"""Results of a JSON file written by saveResults"""
+	f=open(fileName)
+	try:
+		return(json.load(f)['results'])
+	finally:
+		f.close()
+
+def compareBaseline(results,baseline,tolerance=0.25,minTime=1e-3):
+	"""Compare results with baseline results (list, or JSON file name). Prints the ratio of every case found in both.
+	Returns the regressions: cases slower than baseline by more than tolerance (fraction), where either time is above minTime"""
+	if isinstance(baseline,str):
+		baseline=loadResults(baseline)
+	old=dict([((r['case'],r['N'],r['nPanels']),r['time']) for r in baseline])
+	regressions=[]
+	for r in results:
+		key=(r['case'],r['N'],r['nPanels'])
+		if key not in old:
+			continue
+		ratio=r['time']/max(old[key],1e-12)
+		slow=(ratio>1.+tolerance) and (max(r['time'],old[key])>minTime)
+		print "%-24s N=%6i panels=%4i  %10.6f s / %10.6f s = %6.2f %s" %(key[0],key[1],key[2],r['time'],old[key],ratio,'REGRESSION' if slow else '')
+		if slow:
+			regressions.append(dict(r,baseline=old[key],ratio=ratio))
+	return(regressions)
+
+def plotScaling(results):
+	"""Log-log plot of time against N (and against panels) for every case"""
+	for [sweep,other] in [['N','nPanels'],['nPanels','N']]:
+		plt.figure()
+		plt.title('Time against %s' %sweep)
+		for [name,setup,sweeps] in CASES:
+			if sweep not in sweeps:
+				continue
+			rows=[r for r in results if r['case']==name]
+			for value in sorted(set([r[other] for r in rows])):
+				curve=sorted([[r[sweep],r['time']] for r in rows if r[other]==value])
+				if len(curve)>1:
+					curve=numpy.array(curve)
+					plt.loglog(curve[:,0],curve[:,1],'o-',label='%s (%s=%i)' %(name,other,value))
+		plt.xlabel(sweep)
+		plt.ylabel('time (s)')
+		plt.legend(loc='upper left',fontsize='small')
+
+def runBenchmarks(fileName='benchmark.json',baseline=BASELINE,tolerance=0.25,plot=False,**suiteArgs):
+	"""Run the suite, save it in fileName and compare it against baseline (JSON file) if given.
+	If the baseline file does not exist yet, the results are saved as the baseline instead.
+	Returns the results and the regressions"""
+	results=runSuite(**suiteArgs)
+	saveResults(results,fileName)
+	regressions=[]
+	if baseline is not None and not os.path.exists(baseline):
+		saveResults(results,baseline)
+		print "No baseline yet: results saved as baseline in %s" %baseline
+	elif baseline is not None:
+		regressions=compareBaseline(results,baseline,tolerance)
+		print "%i regressions against %s" %(len(regressions),baseline)
+	if plot:
+		plotScaling(results)
+	return(results,regressions)
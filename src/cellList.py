@@ -0,0 +1,116 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Uniform cell list for finding neighbouring particles
+# Points are binned in square cells of the size of the cutoff, so that all neighbours of a point
+# are in its own or the 8 surrounding cells. Cost is O(N) for a fixed number of points per cell
+
+import numpy
+import random
+import matplotlib.pyplot as plt
+
+# Cell offsets which visit every pair of neighbouring cells once
+HALFSTENCIL=[(0,0),(0,1),(1,-1),(1,0),(1,1)]
+
+def cellKeys(pos,cutoff):
+	"""Cell of every point as one integer key. Keys of neighbouring cells differ by ox*span+oy"""
+	cell=numpy.floor(pos/cutoff).astype(int)
+	cell=cell-cell.min(axis=0)+1
+	span=cell[:,1].max()+2
+	return(cell[:,0]*span+cell[:,1],span)
+
+def cellPairs(pos,cutoff):
+	"""All pairs of points closer than cutoff, each pair once.
+	Returns index arrays i,j (i!=j) and the distances"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	if len(pos)<2:
+		return(numpy.zeros(0,int),numpy.zeros(0,int),numpy.zeros(0))
+	[key,span]=cellKeys(pos,cutoff)
+	order=numpy.argsort(key,kind='mergesort')
+	[cells,starts,counts]=numpy.unique(key[order],return_index=True,return_counts=True)
+	iList=[]
+	jList=[]
+	for [ox,oy] in HALFSTENCIL:
+		# Occupied neighbour cell of every occupied cell
+		neighbour=cells+ox*span+oy
+		loc=numpy.minimum(numpy.searchsorted(cells,neighbour),len(cells)-1)
+		found=cells[loc]==neighbour
+		a=numpy.nonzero(found)[0]
+		b=loc[found]
+		
+		# Every point of cell a with every point of cell b
+		na=counts[a]
+		nb=counts[b]
+		total=na*nb
+		pairCell=numpy.repeat(numpy.arange(len(a)),total)
+		within=numpy.arange(total.sum())-numpy.repeat(numpy.cumsum(total)-total,total)
+		ia=starts[a][pairCell]+within//nb[pairCell]
+		ib=starts[b][pairCell]+within%nb[pairCell]
+		if ox==0 and oy==0:
+			keep=ia<ib
+			ia=ia[keep]
+			ib=ib[keep]
+		iList.append(order[ia])
+		jList.append(order[ib])
+	i=numpy.concatenate(iList)
+	j=numpy.concatenate(jList)
+	dist=((pos[i]-pos[j])**2).sum(axis=1)**0.5
+	close=dist<cutoff
+	return(i[close],j[close],dist[close])
+
+def crossPairs(tPos,sPos,cutoff):
+	"""All pairs of a target (tPos) and a source (sPos) closer than cutoff.
+	Returns target indices, source indices and the distances"""
+	tPos=numpy.asarray(tPos,dtype=float).reshape(-1,2)
+	sPos=numpy.asarray(sPos,dtype=float).reshape(-1,2)
+	if len(tPos)==0 or len(sPos)==0:
+		return(numpy.zeros(0,int),numpy.zeros(0,int),numpy.zeros(0))
+	# Cells of both sets on one grid
+	low=numpy.minimum(tPos.min(axis=0),sPos.min(axis=0))
+	tCell=numpy.floor((tPos-low)/cutoff).astype(int)+1
+	sCell=numpy.floor((sPos-low)/cutoff).astype(int)+1
+	span=max(tCell[:,1].max(),sCell[:,1].max())+2
+	tKey=tCell[:,0]*span+tCell[:,1]
+	sKey=sCell[:,0]*span+sCell[:,1]
+	order=numpy.argsort(sKey,kind='mergesort')
+	[cells,starts,counts]=numpy.unique(sKey[order],return_index=True,return_counts=True)
+	iList=[]
+	jList=[]
+	for ox in [-1,0,1]:
+		for oy in [-1,0,1]:
+			# Occupied source cell next to every target
+			neighbour=tKey+ox*span+oy
+			loc=numpy.minimum(numpy.searchsorted(cells,neighbour),len(cells)-1)
+			found=numpy.nonzero(cells[loc]==neighbour)[0]
+			b=loc[found]
+			nb=counts[b]
+			pairTarget=numpy.repeat(found,nb)
+			within=numpy.arange(nb.sum())-numpy.repeat(numpy.cumsum(nb)-nb,nb)
+			iList.append(pairTarget)
+			jList.append(order[numpy.repeat(starts[b],nb)+within])
+	i=numpy.concatenate(iList)
+	j=numpy.concatenate(jList)
+	dist=((tPos[i]-sPos[j])**2).sum(axis=1)**0.5
+	close=dist<cutoff
+	return(i[close],j[close],dist[close])
+
+#### Test functions ####
+def testCellPairs(N=2000,cutoff=0.05):
+	"""Compare pairs (within the points, and between two halves of them) from the cell list with all pairs found by brute force"""
+	pos=numpy.array([[random.uniform(0.,1.),random.gauss(0.,0.2)] for k in range(N)])
+	[i,j,dist]=cellPairs(pos,cutoff)
+	found=set(zip(numpy.minimum(i,j),numpy.maximum(i,j)))
+	d=((pos[:,None,:]-pos[None,:,:])**2).sum(axis=2)**0.5
+	[bi,bj]=numpy.nonzero(numpy.triu(d<cutoff,1))
+	exact=set(zip(bi,bj))
+	print "pairs from cell list = %i, by brute force = %i, missing = %i, extra = %i" %(len(found),len(exact),len(exact-found),len(found-exact))
+	[ci,cj,cdist]=crossPairs(pos[:N//2],pos[N//2:],cutoff)
+	[bi,bj]=numpy.nonzero(d[:N//2,N//2:]<cutoff)
+	crossErr=len(set(zip(ci,cj))^set(zip(bi,bj)))
+	print "cross pairs from cell list = %i, by brute force = %i, different = %i" %(len(ci),len(bi),crossErr)
+	plt.figure()
+	plt.title('Neighbouring pairs')
+	plt.plot(pos[:,0],pos[:,1],'b.',markersize=2.0)
+	return(len(exact-found)+len(found-exact)+crossErr)
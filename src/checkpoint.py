@@ -0,0 +1,254 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Checkpoint and restart of the simulation state
+# A checkpoint is a directory with one .npy file per array (particle fields, recorded traces, wall geometry
+# and wall state, sheets) and header.json with list layout, time, step index and random generator states.
+# It is written in a temporary directory which is then renamed, so a checkpoint is either complete or absent.
+# The older checkpoint is moved to path.old while the new one is put in place; if a crash leaves only path.old,
+# it is read instead.
+# Arrays are loaded memory mapped and copied once into the particle lists.
+# Functions of the walls (inBoundary, reflect) cannot be saved; walls are built again by the caller
+# and their geometry is checked against the checkpoint
+
+import os
+import json
+import shutil
+import random
+import numpy
+import definations as dfn
+import wallBC
+import diffusion
+import traces
+
+VERSION=2
+
+def saveArray(directory,name,array):
+	"""Write an array as directory/name.npy and flush it to disk"""
+	f=open(os.path.join(directory,name+'.npy'),'wb')
+	try:
+		numpy.save(f,numpy.ascontiguousarray(array))
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+
+def loadArray(directory,name,mmap=True):
+	"""Read directory/name.npy, memory mapped if mmap"""
+	return(numpy.load(os.path.join(directory,name+'.npy'),mmap_mode='r' if mmap else None))
+
+def rngState(rng,directory):
+	"""JSON description of the state of a numpy generator or RandomState. Large arrays are saved in directory"""
+	if hasattr(rng,'bit_generator'):
+		return({'type':'Generator','bitGenerator':type(rng.bit_generator).__name__,'state':jsonable(rng.bit_generator.state,directory,'rng')})
+	[name,keys,pos,hasGauss,cached]=rng.get_state()
+	saveArray(directory,'rng_keys',keys)
+	return({'type':'RandomState','name':name,'pos':int(pos),'hasGauss':int(hasGauss),'cached':float(cached)})
+
+def restoreRNG(state,directory):
+	"""Generator or RandomState with the state described by rngState"""
+	if state['type']=='Generator':
+		bitGenerator=getattr(numpy.random,state['bitGenerator'])()
+		bitGenerator.state=fromJsonable(state['state'],directory)
+		return(numpy.random.Generator(bitGenerator))
+	rng=numpy.random.RandomState()
+	rng.set_state((state['name'],numpy.array(loadArray(directory,'rng_keys',False)),state['pos'],state['hasGauss'],state['cached']))
+	return(rng)
+
+def jsonable(value,directory,prefix):
+	"""Copy of a (nested) dictionary with numpy arrays saved in directory and replaced by references"""
+	if isinstance(value,dict):
+		return(dict([(key,jsonable(value[key],directory,prefix+'_'+str(key))) for key in value]))
+	if isinstance(value,numpy.ndarray):
+		saveArray(directory,prefix,value)
+		return({'array':prefix})
+	if isinstance(value,numpy.generic):
+		return(value.item())
+	return(value)
+
+def fromJsonable(value,directory):
+	"""Inverse of jsonable"""
+	if isinstance(value,dict):
+		if value.keys()==['array']:
+			return(numpy.array(loadArray(directory,value['array'],False)))
+		return(dict([(str(key),fromJsonable(value[key],directory)) for key in value]))
+	return(value)
+
+def listIndex(eachList,lists):
+	"""Index of eachList (by identity) in lists, None if it is not there"""
+	for i in range(len(lists)):
+		if lists[i] is eachList:
+			return(i)
+	return(None)
+
+def saveStore(store,directory,prefix):
+	"""Save the arrays and trace histories of a particle store. Returns its header entry"""
+	entry={'kind':store.__class__.__name__,'nPoints':store.nPoints,'nextId':store.nextId,'fields':[]}
+	for [name,dtype,shape] in store.fields:
+		saveArray(directory,prefix+'_'+name,store.data[name][:store.nPoints])
+		entry['fields'].append(name)
+	saveArray(directory,prefix+'_traces',store.recorder.memoryRows())
+	entry['recorder']=store.recorder.settings()
+	return(entry)
+
+def loadStore(entry,directory,prefix,mmap=True):
+	"""Particle store saved by saveStore"""
+	store=getattr(dfn,entry['kind'])()
+	n=entry['nPoints']
+	store.reserve(n)
+	for name in entry['fields']:
+		store.data[name][:n]=loadArray(directory,prefix+'_'+name,mmap)
+	store.nPoints=n
+	store.nextId=entry['nextId']
+	store.recorder=traces.recorderFromSettings(entry['recorder'],loadArray(directory,prefix+'_traces',mmap))
+	return(store)
+
+def saveCheckpoint(path,toMod,fieldGens,BCList=[],time=0.0,step=0,extra={}):
+	"""Write the simulation state atomically in the directory path: all lists of toMod, field generators
+	(as references to toMod lists where shared), wall geometry and state, time, step index, the generator of
+	diffusion (diffusion.RNG) and python's random state. extra is a dictionary of other JSON values (e.g. next dt)"""
+	path=os.path.abspath(path)
+	tmp=path+'.tmp'
+	if os.path.exists(tmp):
+		shutil.rmtree(tmp)
+	os.makedirs(tmp)
+	header={'version':VERSION,'time':time,'step':step,'extra':extra,'toMod':[],'fieldGens':[],'walls':[]}
+	for i in range(len(toMod)):
+		header['toMod'].append(saveStore(toMod[i],tmp,'list%i'%i))
+	for i in range(len(fieldGens)):
+		eachGen=fieldGens[i]
+		index=listIndex(eachGen,toMod)
+		if index is not None:
+			header['fieldGens'].append({'kind':'toMod','index':index})
+		elif isinstance(eachGen,dfn.linVortList):
+			[geom,gamma1,gamma2]=eachGen.panelArrays()
+			for [name,array] in [['x1',[l.x1 for l in eachGen.allLin]],['x2',[l.x2 for l in eachGen.allLin]],['gamma1',gamma1],['gamma2',gamma2]]:
+				saveArray(tmp,'gen%i_%s'%(i,name),numpy.array(array,dtype=float))
+			header['fieldGens'].append({'kind':'linVortList','nPoints':eachGen.nPoints})
+		elif isinstance(eachGen,dfn.particleStore):
+			header['fieldGens'].append(saveStore(eachGen,tmp,'gen%i'%i))
+		else:
+			raise ValueError("field generator of type %s cannot be saved" %eachGen.__class__.__name__)
+	for i in range(len(BCList)):
+		eachBC=BCList[i]
+		wall={'key':wallBC.geometryKey(eachBC.points,eachBC.cp,eachBC.normals),'nsMetrics':getattr(eachBC,'nsMetrics',None)}
+		wall['blobStore']=listIndex(getattr(eachBC,'blobStore',None),toMod) if hasattr(eachBC,'blobStore') else None
+		saveArray(tmp,'wall%i_points'%i,numpy.array(eachBC.points,dtype=float))
+		for name in ['vcp','vcps','releasedGamma']:
+			if hasattr(eachBC,name):
+				saveArray(tmp,'wall%i_%s'%(i,name),getattr(eachBC,name))
+				wall[name]=True
+		header['walls'].append(wall)
+	header['rng']=rngState(diffusion.RNG,tmp)
+	header['random']=random.getstate()
+	f=open(os.path.join(tmp,'header.json'),'w')
+	try:
+		json.dump(header,f)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+
+	# Swap the complete checkpoint in place of an older one
+	old=path+'.old'
+	if os.path.exists(path):
+		if os.path.exists(old):
+			shutil.rmtree(old)
+		os.rename(path,old)
+	os.rename(tmp,path)
+	if os.path.exists(old):
+		shutil.rmtree(old)
+	return(path)
+
+def loadCheckpoint(path,BCList=[],mmap=True):
+	"""Read a checkpoint written by saveCheckpoint. BCList are the walls built again in the same order;
+	their geometry must match the checkpoint, and their state is restored. diffusion.RNG and python's random
+	state are restored too. If path is missing (a crash while saving), the previous checkpoint path.old is read.
+	Returns toMod, fieldGens, time, step and extra"""
+	if not os.path.exists(os.path.join(path,'header.json')) and os.path.exists(os.path.join(path+'.old','header.json')):
+		path=path+'.old'
+	f=open(os.path.join(path,'header.json'))
+	try:
+		header=json.load(f)
+	finally:
+		f.close()
+	if header['version']!=VERSION:
+		raise ValueError("checkpoint version %s is not supported" %header['version'])
+	toMod=[loadStore(header['toMod'][i],path,'list%i'%i,mmap) for i in range(len(header['toMod']))]
+	fieldGens=[]
+	for i in range(len(header['fieldGens'])):
+		entry=header['fieldGens'][i]
+		if entry['kind']=='toMod':
+			fieldGens.append(toMod[entry['index']])
+		elif entry['kind']=='linVortList':
+			[x1,x2,gamma1,gamma2]=[loadArray(path,'gen%i_%s'%(i,name),False) for name in ['x1','x2','gamma1','gamma2']]
+			linList=dfn.linVortList()
+			for k in range(entry['nPoints']):
+				linList.addLinVortex(gamma1[k],gamma2[k],x1[k],x2[k])
+			fieldGens.append(linList)
+		else:
+			fieldGens.append(loadStore(entry,path,'gen%i'%i,mmap))
+	if len(BCList)!=len(header['walls']):
+		raise ValueError("checkpoint has %i walls, %i given" %(len(header['walls']),len(BCList)))
+	for i in range(len(BCList)):
+		eachBC=BCList[i]
+		wall=header['walls'][i]
+		if wallBC.geometryKey(eachBC.points,eachBC.cp,eachBC.normals)!=wall['key']:
+			raise ValueError("geometry of wall %i does not match the checkpoint" %i)
+		for name in ['vcp','vcps','releasedGamma']:
+			if wall.get(name):
+				setattr(eachBC,name,numpy.array(loadArray(path,'wall%i_%s'%(i,name),False)))
+		if wall['nsMetrics'] is not None:
+			eachBC.nsMetrics=dict([(str(key),wall['nsMetrics'][key]) for key in wall['nsMetrics']])
+		if wall['blobStore'] is not None:
+			eachBC.blobStore=toMod[wall['blobStore']]
+	diffusion.RNG=restoreRNG(header['rng'],path)
+	state=header['random']
+	random.setstate((state[0],tuple(state[1]),state[2]))
+	return(toMod,fieldGens,header['time'],header['step'],header['extra'])
+
+#### Test functions ####
+def testCheckpoint(path='checkpointTest',nSteps=6):
+	"""Run a short viscous cylinder simulation straight, and again with a checkpoint and restart half way.
+	Prints the largest difference between the final positions and strengths (zero for a bit for bit restart)"""
+	import tInt
+	import math
+	def newWalls():
+		[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,50)
+		return([wallBC.wallNPNSBC(points,cp,normals,inF,reF)])
+	vinf=numpy.array([1.0,0.0])
+	dt=0.1
+	def run(toMod,fieldGens,BCList,steps):
+		for i in range(steps):
+			tInt.advectRK2(dt,toMod,fieldGens,vinf,BCList)
+			[eachBC.applyNSBC(fieldGens,toMod,0.2,0.03,coalesce=True,persist=True) for eachBC in BCList]
+			diffusion.applyRVM(dt,0.002,toMod,BCList)
+	diffusion.seedRVM(7)
+	toMod=[]
+	fieldGens=[]
+	BCList=newWalls()
+	run(toMod,fieldGens,BCList,nSteps)
+	straight=[dfn.gatherPos(toMod),numpy.concatenate([eachList.strength for eachList in toMod])]
+
+	diffusion.seedRVM(7)
+	toMod=[]
+	fieldGens=[]
+	BCList=newWalls()
+	run(toMod,fieldGens,BCList,nSteps//2)
+	saveCheckpoint(path,toMod,fieldGens,BCList,nSteps//2*dt,nSteps//2)
+	diffusion.seedRVM(0)
+	BCList=newWalls()
+	[toMod,fieldGens,time,step,extra]=loadCheckpoint(path,BCList)
+	run(toMod,fieldGens,BCList,nSteps-step)
+	restarted=[dfn.gatherPos(toMod),numpy.concatenate([eachList.strength for eachList in toMod])]
+	err=max(abs(straight[0]-restarted[0]).max(),abs(straight[1]-restarted[1]).max())
+	print "Largest difference between straight and restarted runs = %e" %err
+
+	# A crash between moving the old checkpoint away and putting the new one in place leaves only path.old
+	os.rename(path,path+'.old')
+	[oldToMod,oldFieldGens,oldTime,oldStep,extra]=loadCheckpoint(path,newWalls())
+	print "Step read after an interrupted save: %i (saved %i)" %(oldStep,nSteps//2)
+	shutil.rmtree(path+'.old')
+	return(err)
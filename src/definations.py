@@ -11,11 +11,14 @@ import cmath
 from copy import deepcopy
 import matplotlib.pyplot as plt
 import threading
+import traces
+import instrument
 NODETOL=1e-08
+BLOCKSIZE=2**18		# Largest number of target-source pairs evaluated at once by the batched kernels
 
 #### Define Elements ####
 
-class vortex:
+class vortex(object):
 	"""A single vortex. It can be either a point vortex or a blob. 
 	It has following properties. Location of vortex([x,y,z]), 
 	Strength of vortex, Blob type (0 for no blob, 1 for Krasny blob, 2 for Chorin blob), 
@@ -60,6 +63,44 @@ class vortex:
 		if self.traceFlag==1:
 			self.traceHist.append(self.position)
 			
+def blobVel(pos,srcPos,strength,blobType,delta,blockSize=BLOCKSIZE):
+	"""Velocity at all "pos" (array of positions) due to vortices at "srcPos" with given strengths, blob types and deltas.
+	Same kernels as vortex.fieldEffect, evaluated for blocks of targets at once, so that memory stays bounded.
+	Sources closer than NODETOL to a target have no effect on it"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	field=numpy.zeros([len(pos),2])
+	M=len(srcPos)
+	if M==0 or len(pos)==0:
+		return(field)
+	z0=srcPos[:,0]+((1j)*srcPos[:,1])
+	strength=numpy.asarray(strength,dtype=float)*numpy.ones(M)
+	blobType=numpy.asarray(blobType)*numpy.ones(M,int)
+	delta=numpy.asarray(delta,dtype=float)*numpy.ones(M)
+	krasny=(blobType==1)
+	chorin=(blobType==2)
+	anyKrasny=krasny.any()
+	anyChorin=chorin.any()
+	safeDelta=numpy.where(delta>0.,delta,1.)
+	nTargets=max(1,blockSize//M)
+	for start in range(0,len(pos),nTargets):
+		block=pos[start:start+nTargets]
+		z=block[:,0]+((1j)*block[:,1])
+		dz=z[:,None]-z0[None,:]
+		r=abs(dz)
+		near=(r<NODETOL)
+		dz[near]=1.0
+		r[near]=1.0
+		gamma=strength*numpy.ones(r.shape)
+		if anyKrasny:			#Krasny Blob
+			gamma=numpy.where(krasny,gamma*r**2/(r**2+delta**2),gamma)
+		if anyChorin:			#Chorin Blob
+			gamma=numpy.where(chorin&(r<=delta),gamma*r/safeDelta,gamma)
+		gamma[near]=0.
+		complexVelocity=(1j)/2/math.pi*(gamma/dz).sum(axis=1)
+		field[start:start+len(block),0]=complexVelocity.real
+		field[start:start+len(block),1]=-complexVelocity.imag
+	return(field)
+
 def testVortex(strength=1.0,blobType=0,delta=0.0):
 	"""Test function for a point vortex"""
 	position=numpy.array([0.,0.])
@@ -80,7 +121,7 @@ def testVortex(strength=1.0,blobType=0,delta=0.0):
 	plt.show()
 	return()
 	
-class tracer:
+class tracer(object):
 	"""A tracer point : Points with zero strength"""
 	
 	def __init__(self,position,traceFlag=0):
@@ -128,6 +169,52 @@ class linVortex:
 		vel=vel*(math.e**(-1j*self.theta))
 		return(numpy.array([vel.real,-vel.imag]))
 
+def panelGeometry(x1,x2):
+	"""Geometry of linear vortex sheets from points x1 to points x2 (arrays of positions) as arrays.
+	Returns complex start points, complex end points, lengths and rotations e^(-i*theta) of all the sheets"""
+	x1=numpy.asarray(x1,dtype=float).reshape(-1,2)
+	x2=numpy.asarray(x2,dtype=float).reshape(-1,2)
+	z1=x1[:,0]+((1j)*x1[:,1])
+	z2=x2[:,0]+((1j)*x2[:,1])
+	lemda=abs(z2-z1)
+	theta=numpy.angle(z2-z1)
+	rot=numpy.exp(-1j*theta)
+	return(z1,z2,lemda,rot)
+
+def panelInfluence(pos,geom):
+	"""Influence of linear vortex sheets with geometry geom (from panelGeometry) on an array of positions.
+	Returns complex arrays c1 and c2 (positions x sheets), such that u-iv=c1*gamma1+c2*gamma2 for each sheet.
+	A sheet has no effect on positions closer than NODETOL to its end points"""
+	[z1,z2,lemda,rot]=geom
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	zd=(pos[:,0]+((1j)*pos[:,1]))[:,None]
+	near=(abs(zd-z1)<NODETOL)|(abs(zd-z2)<NODETOL)
+	z=(zd-z1)*rot
+	z[near]=-1.0
+	logRatio=numpy.log((z-lemda)/z)
+	c1=(1j)/2./math.pi*(((z/lemda)-1)*logRatio+1)*rot
+	c2=-(1j)/2./math.pi*((z/lemda)*logRatio+1)*rot
+	c1[near]=0.
+	c2[near]=0.
+	return(c1,c2)
+
+def linVortVel(pos,geom,gamma1,gamma2,blockSize=BLOCKSIZE):
+	"""Velocity at an array of positions due to linear vortex sheets with geometry geom and strengths gamma1, gamma2.
+	All sheets are evaluated against blocks of positions at once"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	field=numpy.zeros([len(pos),2])
+	Np=len(geom[0])
+	if Np==0 or len(pos)==0:
+		return(field)
+	nTargets=max(1,blockSize//Np)
+	for start in range(0,len(pos),nTargets):
+		block=pos[start:start+nTargets]
+		[c1,c2]=panelInfluence(block,geom)
+		vel=c1.dot(gamma1)+c2.dot(gamma2)
+		field[start:start+len(block),0]=vel.real
+		field[start:start+len(block),1]=-vel.imag
+	return(field)
+
 def testLinVort(p1=numpy.array([0.,0.]),p2=numpy.array([1.,1.]),g1=0.1,g2=0.1):
 	L=linVortex(g1,g2,p1,p2)
 	X,Y = numpy.meshgrid(numpy.arange(-4.,4.,0.4),numpy.arange(-3.,3.,0.4) )
@@ -155,28 +242,136 @@ class vector:
 
 #### Define element lists ####
 
-class vortexList:
-	"""List of vortices. allV is list of all the vortices, nP is total number of vortices"""
+class particleStore(object):
+	"""Structure of arrays storage for a list of particles.
+	Every per particle property is kept in a contiguous numpy array (fields), which grows in chunks.
+	Arrays are read through attributes of the same name (for example pos, ids, traceFlag)"""
+	fields=[('pos',float,(2,)),('ids',int,()),('traceFlag',int,())]
+	viewClass=None
 	
 	def __init__(self):
-		self.allV=[]
 		self.nPoints=0
+		self.nextId=0
+		self.data={}
+		for [name,dtype,shape] in self.fields:
+			self.data[name]=numpy.zeros((0,)+shape,dtype)
+		self.recorder=traces.traceRecorder()
+	
+	def __getattr__(self,name):
+		"""Give a view of the filled part of the field array 'name'"""
+		if name not in ('data','recorder') and name in self.data:
+			return(self.data[name][:self.nPoints])
+		raise AttributeError(name)
+	
+	def reserve(self,n):
+		"""Make sure the arrays can hold n particles without reallocation"""
+		capacity=len(self.data['pos'])
+		if n<=capacity:
+			return()
+		capacity=max(n,2*capacity,16)
+		for [name,dtype,shape] in self.fields:
+			newArray=numpy.zeros((capacity,)+shape,dtype)
+			newArray[:self.nPoints]=self.data[name][:self.nPoints]
+			self.data[name]=newArray
+	
+	def appendFields(self,n,values):
+		"""Append n particles. values is a dictionary of field name and value (scalar or array of length n)"""
+		self.reserve(self.nPoints+n)
+		start=self.nPoints
+		for [name,dtype,shape] in self.fields:
+			if name in values:
+				self.data[name][start:start+n]=values[name]
+			else:
+				self.data[name][start:start+n]=0
+		self.data['ids'][start:start+n]=numpy.arange(self.nextId,self.nextId+n)
+		self.nextId=self.nextId+n
+		self.nPoints=self.nPoints+n
+		# Start trace history of traced particles with their initial position
+		traced=start+numpy.nonzero(self.data['traceFlag'][start:start+n]==1)[0]
+		self.recorder.record(self.data['ids'][traced],self.data['pos'][traced],force=True)
+	
+	def addStore(self,list1):
+		"""Append all particles of another store of the same kind"""
+		values={}
+		for [name,dtype,shape] in self.fields:
+			if name!='ids':
+				values[name]=list1.data[name][:list1.nPoints]
+		self.appendFields(list1.nPoints,values)
+	
+	def keepOnly(self,keep):
+		"""Remove all the points for which the boolean array keep is False. Ids of the other points do not change"""
+		keep=numpy.asarray(keep,dtype=bool)
+		n=int(keep.sum())
+		for [name,dtype,shape] in self.fields:
+			self.data[name][:n]=self.data[name][:self.nPoints][keep]
+		self.nPoints=n
+	
+	def posit(self):
+		"""returns a list containing positions of all the points"""
+		pos=list(self.pos.copy())
+		return(pos)
+	
+	def setPos(self,newPos,record=True):
+		"""Modify positions of all the points at once. With record, positions of traced points are a new frame of the recorder"""
+		self.pos[:]=newPos
+		if record:
+			traced=self.traceFlag==1
+			self.recorder.record(self.ids[traced],self.pos[traced])
+	
+	def setRecorder(self,recorder):
+		"""Record traces with recorder (a traces.traceRecorder, e.g. streaming to a file) from now on"""
+		self.recorder=recorder
+	
+	def getTraceHists(self):
+		"""Dictionary of id and recorded positions (array) of traced points"""
+		return(self.recorder.histories())
+	traceHists=property(getTraceHists)
+	
+	def getAllV(self):
+		"""Per particle objects, kept for callers written against lists of vortex/tracer objects.
+		They read from and write into the arrays of this store"""
+		return([self.viewClass(self,i) for i in range(self.nPoints)])
+	allV=property(getAllV)
+
+class vortexView(vortex):
+	"""A vortex inside a vortexList. Behaves like vortex, but reads and writes the arrays of the list"""
+	
+	def __init__(self,store,index):
+		self.store=store
+		self.index=index
+	
+	position=property(lambda self: self.store.pos[self.index].copy())
+	strength=property(lambda self: self.store.strength[self.index])
+	blobType=property(lambda self: self.store.blobType[self.index])
+	delta=property(lambda self: self.store.delta[self.index])
+	traceFlag=property(lambda self: self.store.traceFlag[self.index])
+	pointid=property(lambda self: self.store.ids[self.index])
+	traceHist=property(lambda self: self.store.recorder.history(self.pointid))
+	
+	def modifyPos(self,newPos):
+		"""Modify position of the vortex"""
+		self.store.pos[self.index]=newPos
+		if self.traceFlag==1:
+			self.store.recorder.record([self.pointid],[self.position])
+
+class vortexList(particleStore):
+	"""List of vortices. Positions, strengths, blob types, deltas, ids and trace flags of all the vortices are stored in arrays.
+	allV gives a list of vortex like objects of all the vortices, nPoints is total number of vortices"""
+	fields=particleStore.fields+[('strength',float,()),('blobType',int,()),('delta',float,())]
+	viewClass=vortexView
 	
 	def addVortex(self,position, strength,blobType=0,delta=0.0,traceFlag=0):
 		"""add a vortex to this vortex list"""
-		self.allV.append(vortex(position, strength,blobType,delta,traceFlag))
-		self.allV[-1].pointid=self.nPoints
-		self.nPoints=self.nPoints+1
+		self.appendFields(1,{'pos':position,'strength':strength,'blobType':blobType,'delta':delta,'traceFlag':traceFlag})
+	
+	def addVortices(self,positions,strengths,blobType=0,delta=0.0,traceFlag=0):
+		"""add many vortices at once. Strengths, blobType, delta and traceFlag can be scalars or arrays"""
+		positions=numpy.asarray(positions,dtype=float).reshape(-1,2)
+		self.appendFields(len(positions),{'pos':positions,'strength':strengths,'blobType':blobType,'delta':delta,'traceFlag':traceFlag})
 	
 	def addLists(self,list1):
 		"""add two vortex lists"""
-		for i in range(list1.nPoints):
-			position=list1.allV[i].position
-			strength=list1.allV[i].strength
-			blobType=list1.allV[i].blobType
-			delta=list1.allV[i].delta
-			traceFlag=list1.allV[i].traceFlag
-			self.addVortex(position, strength,blobType,delta,traceFlag)
+		self.addStore(list1)
 	
 	def fieldEffect(self,pos):
 		"""velocity field due to the whole vortex list at a position"""
@@ -186,10 +381,9 @@ class vortexList:
 			newValue=newValue+eachPointActive.fieldEffect(pos)
 		return(newValue)
 	
-	def posit(self):
-		"""returns a list containing positions of all the points"""
-		pos=[eachV.position for eachV in self.allV]
-		return(pos)
+	def batchFieldEffect(self,pos):
+		"""velocity field due to the whole vortex list at an array of positions"""
+		return(blobVel(pos,self.pos,self.strength,self.blobType,self.delta))
 
 def testVortexList(strength=1.0,blobType=0,delta=0.0):
 	"""Test function for a point vortex list"""
@@ -217,34 +411,63 @@ def testVortexList(strength=1.0,blobType=0,delta=0.0):
 	plt.show()
 	return()
 
-class traceList:
-	"""List of tracers. allV is list of all the vortices, nP is total number of vortices"""
+def testBlobKernel(N=200,Np=50,delta=0.1):
+	"""Compare batched velocity of a vortex list with the vortex by vortex velocity.
+	Uses a mix of point vortices, Krasny blobs and Chorin blobs, and some targets on top of the vortices"""
+	V=vortexList()
+	for i in range(Np):
+		V.addVortex(numpy.random.rand(2),numpy.random.rand()-0.5,i%3,delta)
+	pos=numpy.concatenate([numpy.random.rand(N,2),V.pos[:5]])
+	fieldBatch=V.batchFieldEffect(pos)
+	fieldScalar=numpy.array([V.fieldEffect(eachPos) for eachPos in pos])
+	err=abs(fieldBatch-fieldScalar).max()
+	print "Maximum difference between batched and scalar velocities = %e" %err
+	return(err)
+
+class tracerView(tracer):
+	"""A tracer inside a traceList. Behaves like tracer, but reads and writes the arrays of the list"""
 	
-	def __init__(self):
-		self.allV=[]
-		self.nPoints=0
+	def __init__(self,store,index):
+		self.store=store
+		self.index=index
+	
+	position=property(lambda self: self.store.pos[self.index].copy())
+	traceFlag=property(lambda self: self.store.traceFlag[self.index])
+	traceid=property(lambda self: self.store.ids[self.index])
+	pointid=traceid
+	traceHist=property(lambda self: self.store.recorder.history(self.pointid))
+	
+	def modifyPos(self,newPos):
+		"""Modify the position of tracer particle"""
+		self.store.pos[self.index]=newPos
+		if self.traceFlag==1:
+			self.store.recorder.record([self.pointid],[self.position])
+
+class traceList(particleStore):
+	"""List of tracers. Positions, ids and trace flags are stored in arrays.
+	allV gives a list of tracer like objects, nPoints is total number of tracers"""
+	viewClass=tracerView
 	
 	def addTracer(self,position,traceFlag=0):
 		""" Add a tracer point to this tracer list"""
-		self.allV.append(tracer(position,traceFlag))
-		self.allV[-1].pointid=self.nPoints
-		self.nPoints=self.nPoints+1
+		self.appendFields(1,{'pos':position,'traceFlag':traceFlag})
+	
+	def addTracers(self,positions,traceFlag=0):
+		"""Add many tracer points at once"""
+		positions=numpy.asarray(positions,dtype=float).reshape(-1,2)
+		self.appendFields(len(positions),{'pos':positions,'traceFlag':traceFlag})
 	
 	def addLists(self,list1):
 		"""Add two tracer lists"""
-		for i in range(list1.nPoints):
-			position=list1.allV[i].position
-			traceFlag=list1.allV[i].traceFlag
-			self.addTracer(position,traceFlag)
+		self.addStore(list1)
 	
 	def fieldEffect(self,pos):
 		"""Field effect at any position due to a tracer field will be zero"""
 		return(vector.zeroValue)
 	
-	def posit(self):
-		"""returns a list containing positions of all the points"""
-		pos=[eachV.position for eachV in self.allV]
-		return(pos)
+	def batchFieldEffect(self,pos):
+		"""Field effect at an array of positions due to a tracer field will be zero"""
+		return(numpy.zeros([len(pos),2]))
 
 class linVortList:
 	"""List of linear vortex sheets"""
@@ -252,12 +475,24 @@ class linVortList:
 	def __init__(self):
 		self.allLin=[]
 		self.nPoints=0
+		self.geom=None
 	
 	def addLinVortex(self,gamma1,gamma2,x1,x2):
 		"""Add a linear vortex sheet to the list"""
 		self.allLin.append(linVortex(gamma1,gamma2,x1,x2))
 		self.allLin[-1].linid=self.nPoints
 		self.nPoints=self.nPoints+1
+		self.geom=None
+	
+	def panelArrays(self):
+		"""Geometry and strengths of all the sheets as arrays. Computed once and kept till a sheet is added"""
+		if self.geom is None:
+			x1=numpy.array([eachLin.x1 for eachLin in self.allLin]).reshape(-1,2)
+			x2=numpy.array([eachLin.x2 for eachLin in self.allLin]).reshape(-1,2)
+			self.geom=panelGeometry(x1,x2)
+			self.gamma1=numpy.array([eachLin.gamma1 for eachLin in self.allLin],dtype=float)
+			self.gamma2=numpy.array([eachLin.gamma2 for eachLin in self.allLin],dtype=float)
+		return(self.geom,self.gamma1,self.gamma2)
 	
 	def addLists(self,list1):
 		""""Add two linear vortex sheet lists"""
@@ -275,6 +510,11 @@ class linVortList:
 		for eachLin in linSheets:
 			newValue=newValue+eachLin.fieldEffect(pos)
 		return(newValue)
+	
+	def batchFieldEffect(self,pos):
+		"""Velocity field at an array of positions due to all linear Vortex sheets in this list"""
+		[geom,gamma1,gamma2]=self.panelArrays()
+		return(linVortVel(pos,geom,gamma1,gamma2))
 
 def testLinVortList():
 	"""Test function for a linear vortex sheet list"""
@@ -303,6 +543,21 @@ def testLinVortList():
 	plt.show()
 	return()
 
+def testPanelKernel(N=200,Npanels=30):
+	"""Compare batched velocity of a linear vortex sheet list with the sheet by sheet velocity.
+	Some targets are placed on end points and on the sheets"""
+	V=linVortList()
+	theta=numpy.linspace(0.,2*math.pi,Npanels+1)
+	points=numpy.array([numpy.cos(theta),numpy.sin(theta)]).transpose()
+	for i in range(Npanels):
+		V.addLinVortex(numpy.random.rand()-0.5,numpy.random.rand()-0.5,points[i],points[i+1])
+	pos=numpy.concatenate([3*numpy.random.rand(N,2)-1.5,points[:5],(points[:5]+points[1:6])/2.])
+	fieldBatch=V.batchFieldEffect(pos)
+	fieldScalar=numpy.array([V.fieldEffect(eachPos) for eachPos in pos])
+	err=abs(fieldBatch-fieldScalar).max()
+	print "Maximum difference between batched and scalar velocities = %e" %err
+	return(err)
+
 #### Define additional Functions ####
 		
 def linearTimeMesh(startTime, timeStep, endTime):
@@ -326,6 +581,34 @@ def eulerInt(oldPos,fVal,dt):
 		newPos[k]=new
 	return(newPos)
 
+def gatherPos(lists):
+	"""Returns an array with positions of all the points of the lists, in order"""
+	if len(lists)==0:
+		return(numpy.zeros([0,2]))
+	pos=numpy.concatenate([eachList.pos for eachList in lists])
+	return(pos)
+
+def scatterPos(lists,pos,record=True):
+	"""Modify positions of all the points of the lists from an array given in the order of gatherPos"""
+	n=0
+	for eachList in lists:
+		eachList.setPos(pos[n:n+eachList.nPoints],record)
+		n=n+eachList.nPoints
+	return()
+
+def gatherSources(fieldGens):
+	"""Collects vortices of all the vortex lists in fieldGens as arrays.
+	Returns positions, strengths, blob types, deltas and a list of the remaining field generators (sheets etc.); tracers are dropped"""
+	vLists=[eachGen for eachGen in fieldGens if isinstance(eachGen,vortexList)]
+	others=[eachGen for eachGen in fieldGens if not isinstance(eachGen,(vortexList,traceList))]
+	if len(vLists)==0:
+		return(numpy.zeros([0,2]),numpy.zeros(0),numpy.zeros(0,int),numpy.zeros(0),others)
+	pos=numpy.concatenate([eachList.pos for eachList in vLists])
+	strength=numpy.concatenate([eachList.strength for eachList in vLists])
+	blobType=numpy.concatenate([eachList.blobType for eachList in vLists])
+	delta=numpy.concatenate([eachList.delta for eachList in vLists])
+	return(pos,strength,blobType,delta,others)
+
 def findParticle(pos,vList):
 	"""find particle in vortex list or tracer list"""
 	for eachVortex in vList.allV:
@@ -335,13 +618,29 @@ def findParticle(pos,vList):
 			return(pid)
 	return()
 
+def othersVel(pos,others,field=None):
+	"""Velocity at all "pos" due to the field generators in others, summed directly (added to field if given).
+	Generators with a batched kernel are evaluated at all positions in one go, the rest point by point"""
+	pos=numpy.asarray(pos,dtype=float)
+	if field is None:
+		field=numpy.zeros(pos.shape)
+	for eachGen in others:
+		if hasattr(eachGen,'batchFieldEffect'):
+			field=field+eachGen.batchFieldEffect(pos)
+		else:
+			for i in range(len(pos)):
+				field[i]=field[i]+eachGen.fieldEffect(pos[i])
+	return(field)
+
+@instrument.timed('velField')
 def velField(pos,fieldGen,vinf=0.0):
 	"""Define velocity field at set of points due to vinf and fieldGen( a list containing various velocity generator lists)"""
 	field=numpy.zeros(pos.shape)
 	print "number of Positions = %i" %len(pos)
-	for i in range(len(pos)):
-		vel=vector.zeroValue
+	field=field+vinf
+	instrument.count('velField.targets',len(pos))
+	if instrument.ENABLED:
 		for eachGen in fieldGen:
-			vel=vel+eachGen.fieldEffect(pos[i])
-		field[i]=vel+vinf
-	return(field)
+			# Generators without points (e.g. sampled fields) evaluate no kernels
+			instrument.count('kernel.evaluations',len(pos)*getattr(eachGen,'nPoints',0))
+	return(othersVel(pos,fieldGen,field))
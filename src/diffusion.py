@@ -7,32 +7,108 @@
 
 import numpy
 import definations as dfn
+import cellList
+import instrument
 import math
 import random
 import matplotlib.pyplot as plt
 
-def applyRVM(dt,nu=0.1,toMod=[dfn.vortexList(),dfn.traceList()],BCList=[]):
+def makeRNG(seed=None):
+	"""Random number generator for diffusion. numpy Generator where available, otherwise RandomState.
+	Both give the same run again for the same seed"""
+	if hasattr(numpy.random,'default_rng'):
+		return(numpy.random.default_rng(seed))
+	return(numpy.random.RandomState(seed))
+
+# Generator used when none is given to applyRVM
+RNG=makeRNG()
+
+def seedRVM(seed):
+	"""Reset the default generator of applyRVM, to reproduce a run"""
+	global RNG
+	RNG=makeRNG(seed)
+	return(RNG)
+
+@instrument.timed('diffusion.RVM')
+def applyRVM(dt,nu=0.1,toMod=[dfn.vortexList(),dfn.traceList()],BCList=[],rng=None):
 	"""Apply RVM diffusion based on kinematic viscocity nu on "toMod" list of lists
-	Also, reflect any vortex which is getting diffused into the boundary"""
+	Also, reflect any vortex which is getting diffused into the boundary.
+	rng is a generator (or a seed for a new one); the module generator RNG is used by default"""
 	
 	#Calculate mu and sigma for random number generation gaussian distribution
 	mu=0.0
 	sigma=(2*nu*dt)**0.5
+	if rng is None:
+		rng=RNG
+	elif not hasattr(rng,'normal'):
+		rng=makeRNG(rng)
 	
-	#Modify position for each point
-	for eachList in toMod:
-		#Diffusion should not be applied on tracers. This is only for vortex lists. check that condition
-		if eachList.__class__.__name__=='vortexList':
-			for eachPoint in eachList.allV:
-				rad=random.gauss(mu,sigma)
-				theta=random.uniform(-math.pi,math.pi)
-				dPos=numpy.array([rad*math.cos(theta),rad*math.sin(theta)])
-				newPos=eachPoint.position+dPos
-				#Reflect the new position if it is in boundary
-				for eachBC in BCList:
-					if (eachBC.inBoundary(newPos)):
-						newPos=eachBC.reflect(eachPoint.position,dPos)
-				eachPoint.modifyPos(newPos)          #This will also change fieldGen point positions
+	#Diffusion should not be applied on tracers. This is only for vortex lists
+	vLists=[eachList for eachList in toMod if isinstance(eachList,dfn.vortexList)]
+	pos=dfn.gatherPos(vLists)
+	N=len(pos)
+	if N==0:
+		return()
+	
+	#Displacements of all vortices at once
+	rad=rng.normal(mu,sigma,N)
+	theta=rng.uniform(-math.pi,math.pi,N)
+	dPos=numpy.array([rad*numpy.cos(theta),rad*numpy.sin(theta)]).transpose()
+	newPos=pos+dPos
+	
+	#Reflect the new positions which are in boundary
+	instrument.count('RVM.particles',N)
+	for eachBC in BCList:
+		inside=eachBC.inMask(newPos)
+		if inside.any():
+			newPos[inside]=eachBC.reflectMany(pos[inside],dPos[inside])
+			instrument.count('RVM.reflected',int(inside.sum()))
+	dfn.scatterPos(vLists,newPos)          #This will also change fieldGen point positions
+	return()
+
+@instrument.timed('diffusion.PSE')
+def applyPSE(dt,nu=0.1,toMod=[dfn.vortexList()],BCList=[],eps=None,h=None,cutoff=4.0):
+	"""Apply particle strength exchange (PSE) diffusion based on kinematic viscocity nu on vortex lists of "toMod".
+	Circulation is exchanged between pairs of vortices with the gaussian kernel 4/pi*exp(-(r/eps)**2), in a
+	conservative form, so total circulation is not changed. eps is the kernel width and h the particle spacing
+	(median blob delta by default, for both). Neighbours within cutoff*eps are found with a cell list.
+	Pairs whose midpoint is inside a boundary exchange nothing: the wall is a zero flux boundary here, and the
+	vorticity flux from the wall is introduced only by the no slip blobs of wallNPNSBC.applyNSBC.
+	Particles do not move, so PSE should be used with remeshing to keep them overlapped"""
+	vLists=[eachList for eachList in toMod if isinstance(eachList,dfn.vortexList)]
+	[pos,strength,blobType,delta,others]=dfn.gatherSources(vLists)
+	if len(pos)<2:
+		return()
+	if eps is None:
+		eps=numpy.median(delta) if (delta>0).any() else 1.
+	if h is None:
+		h=eps
+	
+	#Neighbour pairs, leaving out pairs across a boundary
+	[i,j,dist]=cellList.cellPairs(pos,cutoff*eps)
+	mid=(pos[i]+pos[j])/2.
+	across=numpy.zeros(len(i),bool)
+	for eachBC in BCList:
+		across=across|eachBC.inMask(mid)
+	i=i[~across]
+	j=j[~across]
+	eta=4./math.pi*numpy.exp(-(dist[~across]/eps)**2)/eps**2
+	
+	#Explicit steps, split into substeps so that every particle gives away at most half of its difference with its
+	#neighbours in a substep (dt/nSteps*sum of its rates <= 1/2). The sum is taken over real neighbours, as particles
+	#are not always spaced by h (no slip blobs are released on top of each other)
+	rate=nu*h**2/eps**2*eta
+	rowSum=numpy.bincount(i,weights=rate,minlength=len(pos))+numpy.bincount(j,weights=rate,minlength=len(pos))
+	nSteps=max(int(math.ceil(2.*dt*rowSum.max())),1) if len(rate)>0 else 1
+	for k in range(nSteps):
+		flux=(dt/nSteps)*rate*(strength[j]-strength[i])
+		strength=strength+numpy.bincount(i,weights=flux,minlength=len(pos))-numpy.bincount(j,weights=flux,minlength=len(pos))
+	
+	#Write circulations back to the lists
+	n=0
+	for eachList in vLists:
+		eachList.strength[:]=strength[n:n+eachList.nPoints]
+		n=n+eachList.nPoints
 	return()
 
 def testRVM(cpos=numpy.array([1.,1.]),Np=100):
@@ -73,3 +149,47 @@ def testRVM(cpos=numpy.array([1.,1.]),Np=100):
 	plt.show()
 	
 	return()
+
+def testPSE(h=0.02,nu=0.01,dt=0.1,nSteps=10,t0=0.5):
+	"""Diffuse a Lamb-Oseen vortex on a lattice of particles with PSE and compare vorticity with the exact solution"""
+	V=dfn.vortexList()
+	x=numpy.arange(-1.,1.+h/2.,h)
+	X,Y=numpy.meshgrid(x,x)
+	pos=numpy.array([X.flatten(),Y.flatten()]).transpose()
+	r2=(pos**2).sum(axis=1)
+	def omega(t):
+		return(numpy.exp(-r2/(4*nu*t))/(4*math.pi*nu*t))
+	V.addVortices(pos,omega(t0)*h**2,2,h)
+	for k in range(nSteps):
+		applyPSE(dt,nu,[V],eps=2*h,h=h)
+	exact=omega(t0+nSteps*dt)
+	err=abs(V.strength/h**2-exact).max()/exact.max()
+	print "Maximum vorticity error / maximum vorticity = %e, circulation = %f" %(err,V.strength.sum())
+	plt.figure()
+	plt.title("PSE diffusion of a Lamb-Oseen vortex")
+	plt.plot(x,(V.strength/h**2).reshape(X.shape)[len(x)//2],'bo',label='PSE')
+	plt.plot(x,exact.reshape(X.shape)[len(x)//2],'r-',label='exact')
+	plt.legend()
+	return(err)
+
+def testPSECoincident(nPile=200,h=0.03,nu=0.01,dt=0.1,nSteps=10):
+	"""PSE on piles of coincident particles (as released by the no slip condition) over a lattice of empty particles.
+	Strengths must stay bounded by the initial largest strength and circulation must not change"""
+	V=dfn.vortexList()
+	x=numpy.arange(-0.3,0.3+h/2.,h)
+	X,Y=numpy.meshgrid(x,x)
+	V.addVortices(numpy.array([X.flatten(),Y.flatten()]).transpose(),0.,2,h)
+	V.addVortices(numpy.zeros([nPile,2])+numpy.array([0.1,0.]),0.05,2,h)
+	V.addVortices(numpy.zeros([nPile,2])-numpy.array([0.1,0.]),-0.05,2,h)
+	gammaMax=abs(V.strength).max()
+	total=V.strength.sum()
+	growth=0.
+	for k in range(nSteps):
+		applyPSE(dt,nu,[V],eps=h,h=h)
+		growth=max(growth,abs(V.strength).max()/gammaMax)
+	print "Largest strength / initial largest strength = %f, circulation change = %e" %(growth,V.strength.sum()-total)
+	plt.figure()
+	plt.title("PSE of coincident particles")
+	plt.scatter(V.pos[:,0],V.pos[:,1],c=V.strength,s=10)
+	plt.colorbar()
+	return(growth)
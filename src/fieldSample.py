@@ -0,0 +1,163 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Sampling of vorticity, stream function and velocity of particle fields on grids (or any set of points)
+# Vorticity and stream function of each blob type follow from its velocity in definations.vortex.
+# With the sign convention of definations.vortex (positive strength rotates clockwise),
+# stream function of a point vortex is gamma/(2*pi)*log(r), and vorticity (anticlockwise positive) is -gamma times
+# the blob's distribution:
+#   Krasny blob: psi=gamma/(4*pi)*log(r**2+delta**2), distribution delta**2/(pi*(r**2+delta**2)**2)
+#   Chorin blob: psi=gamma/(2*pi)*(r/delta+log(delta)-1) inside delta, distribution 1/(2*pi*delta*r) inside delta
+# Targets are taken in blocks so that memory stays bounded. Chorin blobs have compact vorticity, which can be
+# summed over neighbours from a cell list only
+
+import numpy
+import math
+import random
+import definations as dfn
+import cellList
+import matplotlib.pyplot as plt
+
+# Smallest distance (as a fraction of delta) at which the singular Chorin blob vorticity is evaluated
+CHORINCENTER=0.01
+
+def gridPoints(xlim,ylim,h):
+	"""Regular grid with spacing h covering xlim and ylim. Returns X, Y (meshgrid) and the points as an array"""
+	X,Y=numpy.meshgrid(numpy.arange(xlim[0],xlim[1]+h/2.,h),numpy.arange(ylim[0],ylim[1]+h/2.,h))
+	return(X,Y,numpy.array([X.flatten(),Y.flatten()]).transpose())
+
+def blobDistribution(r,blobType,delta):
+	"""Vorticity distribution of a unit blob at distances r (zero for point vortices)"""
+	eta=numpy.zeros(r.shape)
+	krasny=(blobType==1)*numpy.ones(r.shape,bool)
+	chorin=((blobType==2)&(r<delta))*numpy.ones(r.shape,bool)
+	if krasny.any():
+		d2=(delta*numpy.ones(r.shape))[krasny]**2
+		eta[krasny]=d2/(math.pi*(r[krasny]**2+d2)**2)
+	if chorin.any():
+		d=(delta*numpy.ones(r.shape))[chorin]
+		eta[chorin]=1./(2*math.pi*d*numpy.maximum(r[chorin],CHORINCENTER*d))
+	return(eta)
+
+def blobStream(r,blobType,delta):
+	"""Stream function of a unit blob at distances r"""
+	safe=numpy.maximum(r,dfn.NODETOL)
+	psi=numpy.log(safe)/(2*math.pi)
+	krasny=(blobType==1)*numpy.ones(r.shape,bool)
+	chorin=((blobType==2)&(r<delta))*numpy.ones(r.shape,bool)
+	if krasny.any():
+		d2=(delta*numpy.ones(r.shape))[krasny]**2
+		psi[krasny]=numpy.log(r[krasny]**2+d2)/(4*math.pi)
+	if chorin.any():
+		d=(delta*numpy.ones(r.shape))[chorin]
+		psi[chorin]=(r[chorin]/d+numpy.log(d)-1.)/(2*math.pi)
+	return(psi)
+
+def sheetVortices(linList,nPoints=8):
+	"""Point vortices approximating the linear vortex sheets of linList, nPoints on each sheet (midpoint rule)"""
+	pos=[]
+	strength=[]
+	s=(numpy.arange(nPoints)+0.5)/nPoints
+	for eachLin in linList.allLin:
+		x1=numpy.asarray(eachLin.x1,dtype=float)
+		x2=numpy.asarray(eachLin.x2,dtype=float)
+		length=((x2-x1)**2).sum()**0.5
+		pos.append(x1+s[:,None]*(x2-x1))
+		strength.append((eachLin.gamma1+s*(eachLin.gamma2-eachLin.gamma1))*length/nPoints)
+	return(numpy.concatenate(pos+[numpy.zeros([0,2])]),numpy.concatenate(strength+[numpy.zeros(0)]))
+
+def vorticity(pos,fieldGens,pointDelta=None,useCells=True,blockSize=dfn.BLOCKSIZE):
+	"""Vorticity (anticlockwise positive) at pos (array) due to the vortex lists of fieldGens.
+	Point vortices are spread as Chorin blobs of pointDelta if it is given, and left out otherwise.
+	With useCells, Chorin blobs are summed only over the neighbours found with a cell list"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	[srcPos,strength,blobType,delta,others]=dfn.gatherSources(fieldGens)
+	if pointDelta is not None:
+		points=(blobType==0)
+		blobType=numpy.where(points,2,blobType)
+		delta=numpy.where(points,pointDelta,delta)
+	omega=numpy.zeros(len(pos))
+	chorin=(blobType==2)&(delta>0.)
+	if useCells and chorin.any():
+		[i,j,r]=cellList.crossPairs(pos,srcPos[chorin],delta[chorin].max())
+		eta=blobDistribution(r,2,delta[chorin][j])
+		omega=omega-numpy.bincount(i,weights=strength[chorin][j]*eta,minlength=len(pos))
+		direct=(blobType==1)
+	else:
+		direct=(blobType==1)|chorin
+	if direct.any():
+		omega=omega+blockSum(pos,srcPos[direct],-strength[direct],blobType[direct],delta[direct],blobDistribution,blockSize)
+	return(omega)
+
+def streamFunction(pos,fieldGens,vinf=0.0,sheetPoints=8,blockSize=dfn.BLOCKSIZE):
+	"""Stream function at pos (array) due to vinf and fieldGens (u=d(psi)/dy, v=-d(psi)/dx).
+	Linear vortex sheets are taken as sheetPoints point vortices each"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	[srcPos,strength,blobType,delta,others]=dfn.gatherSources(fieldGens)
+	for eachGen in others:
+		if isinstance(eachGen,dfn.linVortList):
+			[sheetPos,sheetStrength]=sheetVortices(eachGen,sheetPoints)
+			srcPos=numpy.concatenate([srcPos,sheetPos])
+			strength=numpy.concatenate([strength,sheetStrength])
+			blobType=numpy.concatenate([blobType,numpy.zeros(len(sheetPos),int)])
+			delta=numpy.concatenate([delta,numpy.zeros(len(sheetPos))])
+	vinf=numpy.zeros(2)+vinf
+	psi=vinf[0]*pos[:,1]-vinf[1]*pos[:,0]
+	return(psi+blockSum(pos,srcPos,strength,blobType,delta,blobStream,blockSize))
+
+def velocity(pos,fieldGens,vinf=0.0,velField=dfn.velField,blockSize=dfn.BLOCKSIZE):
+	"""Velocity at pos (array) due to vinf and fieldGens with the velocity engine velField, in blocks of targets"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	nSources=max(1,sum([eachGen.nPoints for eachGen in fieldGens]))
+	nTargets=max(1,blockSize//nSources)
+	field=numpy.zeros(pos.shape)
+	for start in range(0,len(pos),nTargets):
+		field[start:start+nTargets]=velField(pos[start:start+nTargets],fieldGens,vinf)
+	return(field)
+
+def blockSum(pos,srcPos,strength,blobType,delta,kernel,blockSize=dfn.BLOCKSIZE):
+	"""Sum of strength*kernel(r,blobType,delta) over the sources at every position, for blocks of targets"""
+	total=numpy.zeros(len(pos))
+	M=len(srcPos)
+	if M==0:
+		return(total)
+	nTargets=max(1,blockSize//M)
+	for start in range(0,len(pos),nTargets):
+		block=pos[start:start+nTargets]
+		r=((block[:,None,:]-srcPos[None,:,:])**2).sum(axis=2)**0.5
+		total[start:start+nTargets]=kernel(r,blobType[None,:],delta[None,:]).dot(strength)
+	return(total)
+
+#### Test functions ####
+def testFieldSample(N=2000,delta=0.05,h=0.02):
+	"""Sample a random patch of Chorin and Krasny blobs. Checks that the vorticity from the cell list matches direct summation,
+	that the vorticity integrates to the circulation, and (for the Krasny blobs, whose velocity is smooth) that velocity
+	matches the derivatives of the stream function. Plots vorticity and stream function contours"""
+	V=dfn.vortexList()
+	pos=numpy.array([[random.gauss(0.,0.3),random.gauss(0.,0.3)] for i in range(N)])
+	V.addVortices(pos,numpy.array([random.uniform(0.,2.)/N for i in range(N)]),1+numpy.arange(N)%2,delta)
+	[X,Y,grid]=gridPoints([-1.5,1.5],[-1.5,1.5],h)
+	omega=vorticity(grid,[V])
+	omegaDirect=vorticity(grid,[V],useCells=False)
+	psi=streamFunction(grid,[V])
+	print "Cell list against direct vorticity: %e" %(abs(omega-omegaDirect).max()/abs(omegaDirect).max())
+	print "Integral of vorticity %f, circulation %f (Krasny blobs spread beyond the grid)" %(omega.sum()*h**2,-V.strength.sum())
+
+	K=dfn.vortexList()
+	krasny=V.blobType==1
+	K.addVortices(V.pos[krasny],V.strength[krasny],1,delta)
+	vel=velocity(grid,[K])
+	[dpsidy,dpsidx]=numpy.gradient(streamFunction(grid,[K]).reshape(X.shape),h)
+	inner=(slice(2,-2),slice(2,-2))
+	scale=abs(vel).max()
+	errU=abs(dpsidy[inner]-vel[:,0].reshape(X.shape)[inner]).max()/scale
+	errV=abs(-dpsidx[inner]-vel[:,1].reshape(X.shape)[inner]).max()/scale
+	print "Velocity from stream function / maximum velocity: u error %e, v error %e" %(errU,errV)
+	plt.figure()
+	plt.title('Vorticity and stream function')
+	plt.contourf(X,Y,omega.reshape(X.shape),30)
+	plt.colorbar()
+	plt.contour(X,Y,psi.reshape(X.shape),20,colors='k')
+	return(errU,errV)
@@ -0,0 +1,232 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Fast multipole method to achieve N speed up
+# Uniform quad tree, with multipole (M) expansions going up the tree, multipole to local (L) translations over
+# interaction lists, and local expansions going down the tree. Neighbouring leaves are evaluated directly.
+# u-iv due to a vortex at z0 is i*gamma/(2*pi*(z-z0)). With coefficients a_p=sum(gamma*(z0-zc)**p),
+# M expansion is i/(2*pi)*sum(a_p/(z-zc)**(p+1)) and L expansion is i/(2*pi)*sum(b_k*(z-zc)**k)
+
+import definations as dfn
+import treeCode
+import numpy
+import math
+import random
+import matplotlib.pyplot as plt
+
+class fmmGrid():
+	"""Boxes of a uniform quad tree stored level by level as arrays of coefficients.
+	Level l has 2**l x 2**l boxes covering the square with lower left corner lowLim and side size"""
+	def __init__(self,lowLim,size,nLevels,order):
+		self.lowLim=lowLim
+		self.size=size
+		self.nLevels=nLevels
+		self.order=order
+		self.binom=treeCode.binomials(2*order)
+		self.M=[numpy.zeros([2**l,2**l,order],complex) for l in range(nLevels+1)]
+		self.L=[numpy.zeros([2**l,2**l,order],complex) for l in range(nLevels+1)]
+
+	def boxWidth(self,level):
+		"""Side of a box at level"""
+		return(self.size/2.**level)
+
+	def boxIndex(self,pos,level):
+		"""Box indices of an array of positions at level"""
+		n=2**level
+		ids=numpy.floor((pos-self.lowLim)/self.boxWidth(level)).astype(int)
+		return(numpy.clip(ids,0,n-1))
+
+	def boxCenter(self,ids,level):
+		"""Complex centers of boxes with indices ids at level"""
+		c=self.lowLim+(ids+0.5)*self.boxWidth(level)
+		return(c[...,0]+((1j)*c[...,1]))
+
+	def findCoefs(self,z,strength,leafIds):
+		"""Multipole coefficients of the leaves from the sources (P2M)"""
+		level=self.nLevels
+		n=2**level
+		dz=z-self.boxCenter(leafIds,level)
+		flat=leafIds[:,0]*n+leafIds[:,1]
+		term=strength.astype(complex)
+		for p in range(self.order):
+			re=numpy.bincount(flat,weights=term.real,minlength=n*n)
+			im=numpy.bincount(flat,weights=term.imag,minlength=n*n)
+			self.M[level][:,:,p]=(re+((1j)*im)).reshape(n,n)
+			term=term*dz
+
+	def transCoefs(self):
+		"""Transfers multipole coefficients from children to parents (M2M)"""
+		P=self.order
+		powers=numpy.arange(P)
+		for level in range(self.nLevels,0,-1):
+			h=self.boxWidth(level)
+			parent=self.M[level-1]
+			parent[:]=0.
+			for a in range(2):
+				for b in range(2):
+					d=complex((a-0.5)*h,(b-0.5)*h)
+					T=self.binom[:P,:P]*d**numpy.maximum(powers[:,None]-powers[None,:],0)
+					T=numpy.tril(T)
+					parent+=numpy.tensordot(self.M[level][a::2,b::2],T,axes=([2],[1]))
+
+	def interactCoefs(self,srcCount,tarCount):
+		"""Converts multipole coefficients of interaction list boxes into local coefficients (M2L).
+		Interaction list of a box are the children of its parent's neighbours which are not its own neighbours.
+		Only boxes with sources (srcCount) and boxes with targets (tarCount) are considered"""
+		P=self.order
+		p=numpy.arange(P)
+		for level in range(2,self.nLevels+1):
+			n=2**level
+			h=self.boxWidth(level)
+			[ti,tj]=numpy.nonzero(tarCount[level]>0)
+			for ox in range(-3,4):
+				for oy in range(-3,4):
+					if max(abs(ox),abs(oy))<2:
+						continue
+					si=ti+ox
+					sj=tj+oy
+					valid=(si>=0)&(si<n)&(sj>=0)&(sj<n)
+					valid=valid&(abs(numpy.floor_divide(si,2)-ti//2)<=1)&(abs(numpy.floor_divide(sj,2)-tj//2)<=1)
+					valid[valid]=srcCount[level][si[valid],sj[valid]]>0
+					if not valid.any():
+						continue
+					d=complex(ox*h,oy*h)
+					S=((-1.)**(p[None,:]+1))*self.binom[p[None,:]+p[:,None],p[:,None]]/d**(p[None,:]+p[:,None]+1)
+					self.L[level][ti[valid],tj[valid]]+=self.M[level][si[valid],sj[valid]].dot(S.transpose())
+
+	def passLocalCoefs(self):
+		"""Transfers local coefficients from parents to children (L2L)"""
+		P=self.order
+		powers=numpy.arange(P)
+		for level in range(3,self.nLevels+1):
+			h=self.boxWidth(level)
+			for a in range(2):
+				for b in range(2):
+					d=complex((a-0.5)*h,(b-0.5)*h)
+					R=self.binom[:P,:P].transpose()*d**numpy.maximum(powers[None,:]-powers[:,None],0)
+					R=numpy.triu(R)
+					self.L[level][a::2,b::2]+=numpy.tensordot(self.L[level-1],R,axes=([2],[1]))
+
+	def findVel(self,z,leafIds):
+		"""u-iv at complex positions z in leaves leafIds from the local expansions (L2P)"""
+		t=z-self.boxCenter(leafIds,self.nLevels)
+		coefs=self.L[self.nLevels][leafIds[:,0],leafIds[:,1]]
+		w=numpy.zeros(len(z),complex)
+		for k in range(self.order-1,-1,-1):
+			w=w*t+coefs[:,k]
+		return((1j)/2./math.pi*w)
+
+def occupancy(leafIds,nLevels):
+	"""Number of points in every box of every level, from leaf box indices of the points"""
+	counts=[]
+	for level in range(nLevels+1):
+		n=2**level
+		ids=leafIds//(2**(nLevels-level))
+		counts.append(numpy.bincount(ids[:,0]*n+ids[:,1],minlength=n*n).reshape(n,n))
+	return(counts)
+
+def nearVel(pos,srcPos,strength,blobType,delta,leafTar,leafSrc,nLevels):
+	"""Direct velocity at pos due to sources in the same and neighbouring leaves (P2P)"""
+	n=2**nLevels
+	field=numpy.zeros([len(pos),2])
+	srcFlat=leafSrc[:,0]*n+leafSrc[:,1]
+	order=numpy.argsort(srcFlat,kind='mergesort')
+	starts=numpy.searchsorted(srcFlat[order],numpy.arange(n*n))
+	ends=numpy.searchsorted(srcFlat[order],numpy.arange(n*n),side='right')
+	tarFlat=leafTar[:,0]*n+leafTar[:,1]
+	tarOrder=numpy.argsort(tarFlat,kind='mergesort')
+	boxes=numpy.unique(tarFlat)
+	tarStarts=numpy.searchsorted(tarFlat[tarOrder],boxes)
+	tarEnds=numpy.searchsorted(tarFlat[tarOrder],boxes,side='right')
+	for k in range(len(boxes)):
+		[i,j]=[boxes[k]//n,boxes[k]%n]
+		near=[]
+		for a in range(max(i-1,0),min(i+2,n)):
+			for b in range(max(j-1,0),min(j+2,n)):
+				near.append(order[starts[a*n+b]:ends[a*n+b]])
+		near=numpy.concatenate(near)
+		if len(near)==0:
+			continue
+		ids=tarOrder[tarStarts[k]:tarEnds[k]]
+		field[ids]=dfn.blobVel(pos[ids],srcPos[near],strength[near],blobType[near],delta[near])
+	return(field)
+
+def velFieldFMM(pos,fieldGen,vinf=0.0,order=16,leafSize=32,maxLevel=8):
+	"""Velocity field at 'pos' positions due to vinf and fieldGen, using the fast multipole method for vortices.
+	Can be used in place of definations.velField"""
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+	print "number of Positions = %i" %len(pos)
+	[srcPos,strength,blobType,delta,others]=dfn.gatherSources(fieldGen)
+	field=dfn.othersVel(pos,others,numpy.zeros(pos.shape)+vinf)
+	if len(srcPos)==0 or len(pos)==0:
+		return(field)
+
+	# Krasny blobs decay only as (delta/distance)**2 towards a point vortex, too slowly for far boxes to be
+	# approximated by multipoles, so they are summed directly
+	krasny=(blobType==1)
+	if krasny.any():
+		field=field+dfn.blobVel(pos,srcPos[krasny],strength[krasny],1,delta[krasny])
+		[srcPos,strength,blobType,delta]=[srcPos[~krasny],strength[~krasny],blobType[~krasny],delta[~krasny]]
+		if len(srcPos)==0:
+			return(field)
+
+	# Square containing all sources and targets
+	allPos=numpy.concatenate([srcPos,pos])
+	lowLim=allPos.min(axis=0)
+	size=max((allPos.max(axis=0)-lowLim).max(),dfn.NODETOL)*(1.+1e-06)
+
+	# Number of levels for about leafSize sources per occupied leaf. Leaves should be wider than the cores of
+	# the remaining (point, Chorin) blobs, so that blobs in well separated boxes act like point vortices
+	if delta.max()>0.:
+		maxLevel=min(maxLevel,int(math.floor(math.log(size/delta.max())/math.log(2.))))
+	nLevels=2
+	while nLevels<maxLevel:
+		ids=numpy.clip(numpy.floor((srcPos-lowLim)/(size/2.**nLevels)).astype(int),0,2**nLevels-1)
+		if len(srcPos)<=leafSize*len(numpy.unique(ids[:,0]*2**nLevels+ids[:,1])):
+			break
+		nLevels=nLevels+1
+	nLevels=min(nLevels,maxLevel)
+	if nLevels<2:
+		return(field+dfn.blobVel(pos,srcPos,strength,blobType,delta))
+
+	grid=fmmGrid(lowLim,size,nLevels,order)
+	leafSrc=grid.boxIndex(srcPos,nLevels)
+	leafTar=grid.boxIndex(pos,nLevels)
+	z0=srcPos[:,0]+((1j)*srcPos[:,1])
+	z=pos[:,0]+((1j)*pos[:,1])
+
+	# Upward pass, interaction lists, downward pass and evaluation
+	grid.findCoefs(z0,strength,leafSrc)
+	grid.transCoefs()
+	grid.interactCoefs(occupancy(leafSrc,nLevels),occupancy(leafTar,nLevels))
+	grid.passLocalCoefs()
+	w=grid.findVel(z,leafTar)
+	field[:,0]=field[:,0]+w.real
+	field[:,1]=field[:,1]-w.imag
+	field=field+nearVel(pos,srcPos,strength,blobType,delta,leafTar,leafSrc,nLevels)
+	return(field)
+
+#### Test functions ####
+def orderError(N=4000,orders=[2,4,8,12,16,20],delta=0.01):
+	"""Reports expansion order against measured error. Random point vortices, Krasny and Chorin blobs in a wake like strip;
+	velocity at the vortices by FMM is compared with direct summation"""
+	V=dfn.vortexList()
+	pos=numpy.array([[4*random.random(),random.gauss(0.,0.3)] for i in range(N)])
+	strength=numpy.array([random.uniform(-1.,1.) for i in range(N)])
+	V.addVortices(pos,strength,numpy.arange(N)%3,delta)
+	fieldReg=dfn.velField(pos,[V])
+	scale=abs(fieldReg).max()
+	errs=[]
+	print "order   max error / max velocity"
+	for eachOrder in orders:
+		fieldFMM=velFieldFMM(pos,[V],order=eachOrder)
+		errs.append(abs(fieldFMM-fieldReg).max()/scale)
+		print "%5i   %e" %(eachOrder,errs[-1])
+	plt.figure()
+	plt.semilogy(orders,errs,'o-')
+	plt.title('FMM error against expansion order')
+	plt.xlabel('order')
+	plt.ylabel('max error / max velocity')
+	return(orders,errs)
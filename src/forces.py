@@ -0,0 +1,181 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Force diagnostics
+# Force on the bodies is found from the time derivative of the linear impulse of all vorticity (particles and wall sheets),
+# F=-rho*d/dt(integral of (y*omega,-x*omega)), with a backward difference between steps.
+# Optionally, the surface pressure is found from the vorticity flux of the no slip condition: at a wall,
+# dp/ds=-mu*d(omega)/dn=rho*(vorticity flux into the fluid), with s,n right handed and n into the fluid.
+# The flux of a step is the circulation released by wallNPNSBC.applyNSBC (releasedGamma) over the panel length and dt.
+# With the sign convention of definations.vortex, physical (anticlockwise) circulation is -strength.
+# One row for each step is appended to a CSV file or a binary file of FORCEDTYPE rows
+
+import os
+import numpy
+import math
+import definations as dfn
+import wallBC
+import matplotlib.pyplot as plt
+
+FORCEDTYPE=numpy.dtype([('step',numpy.int64),('time',numpy.float64),('Ix',numpy.float64),('Iy',numpy.float64),
+	('Cd',numpy.float64),('Cl',numpy.float64),('CdPressure',numpy.float64),('ClPressure',numpy.float64)])
+
+def impulse(fieldGens,BCList=[]):
+	"""Linear impulse (integral of (y*omega,-x*omega)) of vortex lists of fieldGens and the no penetration sheets of BCList (linList)"""
+	[pos,strength,blobType,delta,others]=dfn.gatherSources(fieldGens)
+	gamma=-strength
+	I=numpy.array([(gamma*pos[:,1]).sum(),-(gamma*pos[:,0]).sum()])
+	sheets=[eachGen for eachGen in others if isinstance(eachGen,dfn.linVortList)]
+	sheets=sheets+[eachBC.linList for eachBC in BCList if hasattr(eachBC,'linList')]
+	for eachList in sheets:
+		if eachList.nPoints==0:
+			continue
+		x1=numpy.array([l.x1 for l in eachList.allLin],dtype=float)
+		x2=numpy.array([l.x2 for l in eachList.allLin],dtype=float)
+		gamma1=-numpy.array([l.gamma1 for l in eachList.allLin],dtype=float)
+		gamma2=-numpy.array([l.gamma2 for l in eachList.allLin],dtype=float)
+		length=((x2-x1)**2).sum(axis=1)**0.5
+		# Exact first moments of linearly varying sheets
+		moment=(length[:,None]*(gamma1[:,None]*(2*x1+x2)+gamma2[:,None]*(x1+2*x2))/6.).sum(axis=0)
+		I=I+numpy.array([moment[1],-moment[0]])
+	return(I)
+
+def pressureForce(eachBC,dt,rho=1.0):
+	"""Force on a wall from the surface pressure implied by the vorticity flux of the last applyNSBC (releasedGamma) over dt.
+	Pressure is integrated along the panels; the mismatch after going round the wall is spread linearly"""
+	points=numpy.array(eachBC.points,dtype=float)
+	x2=numpy.roll(points,-1,axis=0)
+	side=x2-points
+	length=(side**2).sum(axis=1)**0.5
+	tangent=side/length[:,None]
+	normals=numpy.asarray(eachBC.normals,dtype=float)
+	# Direction of panel order against the right handed s (s x n = +z)
+	handed=numpy.sign(tangent[:,0]*normals[:,1]-tangent[:,1]*normals[:,0])
+	flux=-numpy.asarray(eachBC.releasedGamma,dtype=float)/(length*dt)
+	dp=rho*handed*flux*length
+	p=numpy.concatenate([[0.],numpy.cumsum(dp)])
+	arc=numpy.concatenate([[0.],numpy.cumsum(length)])
+	p=p-p[-1]*arc/arc[-1]
+	pc=(p[:-1]+p[1:])/2.
+	pc=pc-(pc*length).sum()/length.sum()
+	return(-(pc[:,None]*normals*length[:,None]).sum(axis=0))
+
+class forceMonitor():
+	"""Force coefficients of every step, from impulse and optionally from surface pressure, appended to fileName
+	(CSV if it ends with .csv, otherwise binary FORCEDTYPE rows). U and D are the reference velocity and length.
+	With resume, rows are appended to an existing file (e.g. after a restart) instead of starting it again"""
+	def __init__(self,fileName=None,U=1.0,D=1.0,rho=1.0,pressure=False,resume=False):
+		self.fileName=fileName
+		self.U=U
+		self.D=D
+		self.rho=rho
+		self.pressure=pressure
+		self.lastImpulse=None
+		self.rows=[]
+		if fileName is not None and not (resume and os.path.exists(fileName)):
+			f=open(fileName,'w')
+			if fileName.endswith('.csv'):
+				f.write(','.join(FORCEDTYPE.names)+'\n')
+			f.close()
+
+	def record(self,step,time,dt,fieldGens,vinf,BCList,velField=dfn.velField):
+		"""Find impulse at the current particle positions and the forces of the last dt, and append them.
+		No penetration sheets are found again at the current positions (velocities at control points only, O(N)),
+		unless the walls already have sheets for them (wallBC.sheetsValid)"""
+		wallBC.fusedVelField([],fieldGens,vinf,BCList,velField,slip=False)
+		I=impulse(fieldGens,BCList)
+		scale=0.5*self.rho*self.U**2*self.D
+		row=numpy.zeros(1,FORCEDTYPE)
+		row['step']=step
+		row['time']=time
+		row['Ix']=I[0]
+		row['Iy']=I[1]
+		F=numpy.zeros(2)+numpy.nan
+		if self.lastImpulse is not None:
+			F=-self.rho*(I-self.lastImpulse)/dt
+		row['Cd']=F[0]/scale
+		row['Cl']=F[1]/scale
+		Fp=numpy.zeros(2)+numpy.nan
+		if self.pressure and all([hasattr(eachBC,'releasedGamma') for eachBC in BCList]):
+			Fp=sum([pressureForce(eachBC,dt,self.rho) for eachBC in BCList])
+		row['CdPressure']=Fp[0]/scale
+		row['ClPressure']=Fp[1]/scale
+		self.lastImpulse=I
+		self.rows.append(row)
+		if self.fileName is not None:
+			self.append(row)
+		return(row[0])
+
+	def append(self,row):
+		"""Append a row to the file"""
+		if self.fileName.endswith('.csv'):
+			f=open(self.fileName,'a')
+			f.write(','.join(['%d'%row['step'][0]]+['%.12e'%row[name][0] for name in FORCEDTYPE.names[1:]])+'\n')
+		else:
+			f=open(self.fileName,'ab')
+			row.tofile(f)
+		f.close()
+
+	def history(self):
+		"""All rows recorded so far"""
+		return(numpy.concatenate(self.rows+[numpy.zeros(0,FORCEDTYPE)]))
+
+def loadForces(fileName):
+	"""Rows of a force file, as FORCEDTYPE records (memory mapped for binary files)"""
+	if fileName.endswith('.csv'):
+		data=numpy.genfromtxt(fileName,delimiter=',',names=True)
+		rows=numpy.zeros(data.size,FORCEDTYPE)
+		for name in FORCEDTYPE.names:
+			rows[name]=data[name]
+		return(rows)
+	return(numpy.memmap(fileName,dtype=FORCEDTYPE,mode='r'))
+
+#### Test functions ####
+def testForces(nSteps=30,Npanels=50,fileName='forces.csv'):
+	"""Impulsively started viscous flow around a cylinder (Re=1000). Records drag and lift from impulse and pressure
+	in fileName and plots them against time"""
+	import tInt
+	import diffusion
+	diffusion.seedRVM(1)
+	Re=1000
+	delta=(1./Re)**0.5
+	dt=delta*math.pi
+	vinf=numpy.array([1.0,0.0])
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,Npanels)
+	BCList=[wallBC.wallNPNSBC(points,cp,normals,inF,reF)]
+	toMod=[]
+	fieldGens=[]
+	monitor=forceMonitor(fileName,U=1.0,D=2.0,pressure=True)
+	for i in range(1,nSteps+1):
+		tInt.advectRK2(dt,toMod,fieldGens,vinf,BCList)
+		[eachBC.applyNSBC(fieldGens,toMod,0.2,delta,coalesce=True,persist=True) for eachBC in BCList]
+		diffusion.applyRVM(dt,2./Re,toMod,BCList)
+		row=monitor.record(i,i*dt,dt,fieldGens,vinf,BCList)
+		print "time=%f Cd=%f Cl=%f Cd(pressure)=%f Cl(pressure)=%f" %(row['time'],row['Cd'],row['Cl'],row['CdPressure'],row['ClPressure'])
+	rows=loadForces(fileName)
+	plt.figure()
+	plt.title('Force coefficients')
+	plt.plot(rows['time'],rows['Cd'],label='Cd (impulse)')
+	plt.plot(rows['time'],rows['Cl'],label='Cl (impulse)')
+	plt.plot(rows['time'],rows['CdPressure'],label='Cd (pressure)')
+	plt.legend()
+	return(rows)
+
+def testForcesNoWall(nSteps=10,dt=0.05,tol=1e-10):
+	"""Vortex pair in free space (no walls): impulse is conserved by advection, so both force coefficients should stay
+	at zero. Checks that record works without walls"""
+	import tInt
+	vinf=numpy.array([0.0,0.0])
+	V=dfn.vortexList()
+	V.addVortices(numpy.array([[0.0,0.5],[0.0,-0.5]]),numpy.array([1.0,-1.0]),2,0.1)
+	monitor=forceMonitor()
+	for i in range(1,nSteps+1):
+		tInt.advectRK2(dt,[V],[V],vinf,[])
+		row=monitor.record(i,i*dt,dt,[V],vinf,[])
+	rows=monitor.history()
+	err=max(abs(rows['Cd'][1:]).max(),abs(rows['Cl'][1:]).max())
+	print "Largest force coefficient without walls = %e" %err
+	assert err<tol, "force without walls is not zero"
+	return(rows)
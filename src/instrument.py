@@ -0,0 +1,138 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Instrumentation of the time loop
+# Named timers (wall clock time and number of calls of a phase) and counters (kernel evaluations, particles, ...)
+# are kept for the current step and in totals. Times are inclusive: a phase inside another is counted in both.
+# When disabled (the default) a phase is a shared object doing nothing and counters return at once, so the cost is
+# a function call. With a log file, endStep appends one JSON line for every step (step, time, timers, counters, gauges).
+# python -c "import instrument,tInt; instrument.enable('steps.log'); tInt.test4RK2(); instrument.report()"
+
+import json
+import functools
+from timeit import default_timer as clock
+
+ENABLED=False
+LOG=None
+STEPTIMES={}
+STEPCALLS={}
+STEPCOUNTS={}
+GAUGES={}
+TOTALTIMES={}
+TOTALCALLS={}
+TOTALCOUNTS={}
+NSTEPS=[0]
+
+class nullPhase():
+	"""Phase used when instrumentation is disabled"""
+	def __enter__(self):
+		return(self)
+	def __exit__(self,excType,excValue,traceback):
+		return(False)
+
+NULLPHASE=nullPhase()
+
+class phaseTimer():
+	"""Context adding the time spent inside it to the timer name"""
+	def __init__(self,name):
+		self.name=name
+
+	def __enter__(self):
+		self.start=clock()
+		return(self)
+
+	def __exit__(self,excType,excValue,traceback):
+		STEPTIMES[self.name]=STEPTIMES.get(self.name,0.)+clock()-self.start
+		STEPCALLS[self.name]=STEPCALLS.get(self.name,0)+1
+		return(False)
+
+def phase(name):
+	"""Context timing a phase: with instrument.phase('name'): ..."""
+	if not ENABLED:
+		return(NULLPHASE)
+	return(phaseTimer(name))
+
+def timed(name):
+	"""Decorator timing every call of a function as the phase name"""
+	def decorate(function):
+		@functools.wraps(function)
+		def wrapper(*args,**kwargs):
+			if not ENABLED:
+				return(function(*args,**kwargs))
+			with phaseTimer(name):
+				return(function(*args,**kwargs))
+		return(wrapper)
+	return(decorate)
+
+def count(name,n=1):
+	"""Add n to the counter name"""
+	if not ENABLED:
+		return()
+	STEPCOUNTS[name]=STEPCOUNTS.get(name,0)+n
+
+def gauge(name,value):
+	"""Set the current value of name (e.g. number of particles), logged with every step"""
+	if not ENABLED:
+		return()
+	GAUGES[name]=value
+
+def reset():
+	"""Clear all timers, counters and gauges"""
+	for eachDict in [STEPTIMES,STEPCALLS,STEPCOUNTS,GAUGES,TOTALTIMES,TOTALCALLS,TOTALCOUNTS]:
+		eachDict.clear()
+	NSTEPS[0]=0
+
+def enable(logFile=None):
+	"""Start instrumentation, with a fresh log file logFile if given"""
+	global ENABLED,LOG
+	disable()
+	reset()
+	if logFile is not None:
+		LOG=open(logFile,'w')
+	ENABLED=True
+
+def disable():
+	"""Stop instrumentation and close the log file. Totals are kept for report"""
+	global ENABLED,LOG
+	ENABLED=False
+	if LOG is not None:
+		LOG.close()
+		LOG=None
+
+def endStep(step,time=None):
+	"""Close the current step: add its timers and counters to the totals, write them to the log file and start a new step.
+	Returns the summary of the step"""
+	if not ENABLED:
+		return(None)
+	summary={'step':step,'time':time,'timers':dict(STEPTIMES),'calls':dict(STEPCALLS),'counts':dict(STEPCOUNTS),'gauges':dict(GAUGES)}
+	for [total,current] in [[TOTALTIMES,STEPTIMES],[TOTALCALLS,STEPCALLS],[TOTALCOUNTS,STEPCOUNTS]]:
+		for key in current:
+			total[key]=total.get(key,0)+current[key]
+		current.clear()
+	NSTEPS[0]=NSTEPS[0]+1
+	if LOG is not None:
+		LOG.write(json.dumps(summary)+'\n')
+		LOG.flush()
+	return(summary)
+
+def report():
+	"""Print total and per step time of every timer (slowest first) and totals of counters, for the closed steps"""
+	nSteps=max(NSTEPS[0],1)
+	print "%i steps" %NSTEPS[0]
+	print "%-28s %10s %12s %12s" %('timer','calls','total (s)','per step (s)')
+	for name in sorted(TOTALTIMES,key=TOTALTIMES.get,reverse=True):
+		print "%-28s %10i %12.4f %12.6f" %(name,TOTALCALLS[name],TOTALTIMES[name],TOTALTIMES[name]/nSteps)
+	print "%-28s %10s %12s" %('counter','total','per step')
+	for name in sorted(TOTALCOUNTS):
+		print "%-28s %10i %12.1f" %(name,TOTALCOUNTS[name],TOTALCOUNTS[name]/float(nSteps))
+	return(TOTALTIMES,TOTALCOUNTS)
+
+def loadLog(logFile):
+	"""Step summaries of a log file written by endStep"""
+	f=open(logFile)
+	try:
+		return([json.loads(line) for line in f if line.strip()])
+	finally:
+		f.close()
@@ -5,18 +5,27 @@
 
 # Plots and saves figures based on testcase-4 RK-2 requirement
 # Change as per requirement
+# Figures can also be made in a worker process (plotWorker) from snapshots of particle arrays,
+# so that the solver does not wait for plotting
 
+import os
 import numpy
+import multiprocessing
 import matplotlib.pyplot as plt
+import matplotlib.path
 import definations
+import wallBC
+import instrument
 
 ## Plot Velocity Field
-def plotVel(fieldGens,vinf,BCList,tim):
+@instrument.timed('plots.velocity')
+def plotVel(fieldGens,vinf,BCList,tim,velField=definations.velField):
 	"""Plots velocity vector plot
 	Designed to be used with tInt test case 4.
-	Change for different cases as required"""
+	Change for different cases as required.
+	No penetration sheets found for the current step are reused, and the grid is evaluated with velField"""
 	
-	plt.figure()
+	fig=plt.figure()
 	[plt.plot(numpy.array(eachBC.points).transpose()[0],numpy.array(eachBC.points).transpose()[1],linewidth=3.0) for eachBC in BCList]
 	plt.title('Test Case for RK-2 Viscous Flow Around a Cylinder \n Velocity Plot: Time=%f'%tim)
 	X,Y = numpy.meshgrid(numpy.arange(0.0,5.0,0.2),numpy.arange(0.0,2.5,0.1))
@@ -24,37 +33,138 @@ def plotVel(fieldGens,vinf,BCList,tim):
 	plt.ylim([-0.1,2.5])
 	pos=numpy.array([X.flatten(),Y.flatten()]).transpose()
 	
-	# Apply no penetration boundary condition in order to find velocity field
-	[eachBC.findVcp(fieldGens,vinf) for eachBC in BCList]
-	[eachBC.applyNPBC(fieldGens) for eachBC in BCList]
-	Vel = definations.velField(pos,fieldGens,vinf)
-	[eachBC.closeNPBC(fieldGens) for eachBC in BCList]
+	# Velocity with the no penetration boundary condition
+	Vel=gridVel(pos,fieldGens,vinf,BCList,velField)
 	
 	# If any point is inside the boundary give it a zero velocity
-	for j in range(len(pos)):
-		for eachBC in BCList:
-			if eachBC.inBoundary(pos[j]):
-				Vel[j]=numpy.zeros(2)
+	for eachBC in BCList:
+		Vel[eachBC.inMask(pos)]=0.
 	u=Vel.transpose()[0].reshape(X.shape)
 	v=Vel.transpose()[1].reshape(X.shape)
 	plt.quiver(X,Y,u,v)
-	plt.savefig('Velocity_%f.png'%tim)
+	fig.savefig('Velocity_%f.png'%tim)
+	plt.close(fig)
 	return()
 
+def gridVel(pos,fieldGens,vinf,BCList,velField=definations.velField):
+	"""Velocity at pos satisfying no penetration. If every wall has sheets (linList) solved for the current
+	particles (wallBC.sheetsValid) they are reused, otherwise no penetration is solved again"""
+	[Vel]=wallBC.fusedVelField([pos],fieldGens,vinf,BCList,velField,slip=False)
+	return(Vel)
+
 #Plot Vorticities of points
+@instrument.timed('plots.vorticity')
 def plotVort(toMod,BCList,tim):
-	"""Plots velocity vector plot
+	"""Plots vorticity particles, red for positive and blue for other strengths, one scatter for each sign
 	Designed to be used with tInt test case 4.
 	Change for different cases as required"""
 	
-	plt.figure()
+	fig=plt.figure()
 	plt.axis('equal')
 	plt.title('Test Case for RK-2 Viscous Flow Around a Cylinder \n Vorticity Plot: Time=%f'%tim)
 	[plt.plot(numpy.array(eachBC.points).transpose()[0],numpy.array(eachBC.points).transpose()[1],linewidth=3.0) for eachBC in BCList]
-	for eachList in toMod:
-		for eachV in eachList.allV:
-			if numpy.sign(eachV.strength)==1:
-				plt.plot(eachV.position[0],eachV.position[1],'ro',markersize=3.0)
-			else:
-				plt.plot(eachV.position[0],eachV.position[1],'bo',markersize=3.0)
-	plt.savefig('Vorticity%f.png'%tim)
+	[pos,strength,blobType,delta,others]=definations.gatherSources(toMod)
+	scatterSigns(pos,strength)
+	fig.savefig('Vorticity%f.png'%tim)
+	plt.close(fig)
+	return()
+
+def scatterSigns(pos,strength):
+	"""Particles with positive strength in red and others in blue, one scatter call each"""
+	positive=numpy.sign(strength)==1
+	plt.scatter(pos[positive,0],pos[positive,1],s=9.0,c='r',edgecolors='none')
+	plt.scatter(pos[~positive,0],pos[~positive,1],s=9.0,c='b',edgecolors='none')
+
+def sheetArrays(linList):
+	"""End points and strengths of the sheets of a linear vortex sheet list, as arrays"""
+	return([numpy.array([l.x1 for l in linList.allLin],dtype=float).reshape(-1,2),numpy.array([l.x2 for l in linList.allLin],dtype=float).reshape(-1,2),
+		numpy.array([l.gamma1 for l in linList.allLin],dtype=float),numpy.array([l.gamma2 for l in linList.allLin],dtype=float)])
+
+def sheetList(arrays):
+	"""Linear vortex sheet list from sheetArrays"""
+	[x1,x2,gamma1,gamma2]=arrays
+	linList=definations.linVortList()
+	for i in range(len(x1)):
+		linList.addLinVortex(gamma1[i],gamma2[i],x1[i],x2[i])
+	return(linList)
+
+#### Plotting in a worker process ####
+def snapshot(toMod,fieldGens,vinf,BCList,tim):
+	"""Copy of what is needed to plot vorticity and velocity at time tim: vortex arrays, other linear sheets,
+	free stream, wall geometry and no penetration sheets of the current step. It can be sent to another process"""
+	[pos,strength,blobType,delta,others]=definations.gatherSources([eachList for eachList in toMod if isinstance(eachList,definations.vortexList)]+
+		[eachGen for eachGen in fieldGens if isinstance(eachGen,definations.vortexList) and not any([eachGen is eachList for eachList in toMod])])
+	sheets=[sheetArrays(eachGen) for eachGen in fieldGens if isinstance(eachGen,definations.linVortList) and eachGen.nPoints>0]
+	npSheets=None
+	if wallBC.sheetsValid(BCList,fieldGens,vinf):
+		npSheets=[sheetArrays(eachBC.linList) for eachBC in BCList]
+	walls=[[numpy.array(eachBC.points,dtype=float),numpy.array(eachBC.cp,dtype=float),numpy.array(eachBC.normals,dtype=float)] for eachBC in BCList]
+	return({'time':tim,'pos':pos,'strength':strength,'blobType':blobType,'delta':delta,'sheets':sheets,'npSheets':npSheets,'vinf':vinf,'walls':walls})
+
+def snapshotVel(snap,pos,velField=definations.velField):
+	"""Velocity at pos from a snapshot, satisfying no penetration on its walls (with its sheets when it has them). Zero inside the walls"""
+	fieldGens=[definations.vortexList()]
+	fieldGens[0].addVortices(snap['pos'],snap['strength'],snap['blobType'],snap['delta'])
+	fieldGens=fieldGens+[sheetList(arrays) for arrays in snap['sheets']]
+	if snap['npSheets'] is not None:
+		Vel=velField(pos,fieldGens+[sheetList(arrays) for arrays in snap['npSheets']],snap['vinf'])
+	else:
+		BCList=[wallBC.wallNPNSBC(points,cp,normals) for [points,cp,normals] in snap['walls']]
+		[Vel]=wallBC.fusedVelField([pos],fieldGens,snap['vinf'],BCList,velField,slip=False)
+	for [points,cp,normals] in snap['walls']:
+		Vel[matplotlib.path.Path(points).contains_points(pos)]=0.
+	return(Vel)
+
+def renderSnapshot(snap,outDir='.',velField=definations.velField):
+	"""Save vorticity and velocity figures of a snapshot, like plotVort and plotVel, and close them"""
+	tim=snap['time']
+	pos=snap['pos']
+	fig=plt.figure()
+	plt.axis('equal')
+	plt.title('Test Case for RK-2 Viscous Flow Around a Cylinder \n Vorticity Plot: Time=%f'%tim)
+	[plt.plot(points[:,0],points[:,1],linewidth=3.0) for [points,cp,normals] in snap['walls']]
+	scatterSigns(pos,snap['strength'])
+	fig.savefig(os.path.join(outDir,'Vorticity%f.png'%tim))
+	plt.close(fig)
+
+	fig=plt.figure()
+	[plt.plot(points[:,0],points[:,1],linewidth=3.0) for [points,cp,normals] in snap['walls']]
+	plt.title('Test Case for RK-2 Viscous Flow Around a Cylinder \n Velocity Plot: Time=%f'%tim)
+	X,Y = numpy.meshgrid(numpy.arange(0.0,5.0,0.2),numpy.arange(0.0,2.5,0.1))
+	plt.xlim([-0.1,5.0])
+	plt.ylim([-0.1,2.5])
+	Vel=snapshotVel(snap,numpy.array([X.flatten(),Y.flatten()]).transpose(),velField)
+	plt.quiver(X,Y,Vel[:,0].reshape(X.shape),Vel[:,1].reshape(X.shape))
+	fig.savefig(os.path.join(outDir,'Velocity_%f.png'%tim))
+	plt.close(fig)
+
+def workerLoop(queue,outDir,velField=definations.velField):
+	"""Render snapshots from queue with a headless backend until None is received"""
+	plt.switch_backend('Agg')
+	while True:
+		snap=queue.get()
+		if snap is None:
+			break
+		try:
+			renderSnapshot(snap,outDir,velField)
+		except Exception as err:
+			print "plotting of time %f failed: %s" %(snap['time'],err)
+
+class plotWorker():
+	"""Worker process making figures from snapshots. submit blocks only when maxQueue snapshots are waiting.
+	close waits for all submitted snapshots to be plotted. velField is the velocity engine used for the velocity plot"""
+	def __init__(self,maxQueue=4,outDir='.',velField=definations.velField):
+		self.queue=multiprocessing.Queue(maxQueue)
+		self.process=multiprocessing.Process(target=workerLoop,args=(self.queue,outDir,velField))
+		self.process.daemon=True
+		self.process.start()
+	
+	@instrument.timed('plots.submit')
+	def submit(self,toMod,fieldGens,vinf,BCList,tim):
+		"""Send a snapshot of the current state to the worker"""
+		self.queue.put(snapshot(toMod,fieldGens,vinf,BCList,tim))
+	
+	def close(self):
+		"""Finish plotting and stop the worker"""
+		self.queue.put(None)
+		self.process.join()
@@ -0,0 +1,142 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Particle population control
+# Weak particles of the same sign close to each other are merged, and particles which have left
+# a window around the body are removed or lumped. Circulation and linear impulse are conserved;
+# angular impulse is conserved by merging Chorin blobs into a wider core, but not by merging point vortices
+# or Krasny blobs. Particles outside the window are lumped separately for each side of the window, so that
+# a lumped particle stays outside it. Changes in these invariants are reported as an error budget
+
+import numpy
+import definations as dfn
+import random
+import matplotlib.pyplot as plt
+
+# Second moment of vorticity of a blob of unit strength and unit delta, for each blob type
+# (point vortex, Krasny blob (unbounded, not counted), Chorin blob)
+CORESECONDMOMENT=numpy.array([0.,0.,1./3.])
+
+def invariants(vList):
+	"""Circulation, linear impulse (sum of gamma*x, gamma*y) and angular impulse (sum of gamma*|x|**2 including blob cores) of a vortex list"""
+	gamma=vList.strength
+	pos=vList.pos
+	core=CORESECONDMOMENT[vList.blobType]*vList.delta**2
+	return(numpy.array([gamma.sum(),(gamma*pos[:,0]).sum(),(gamma*pos[:,1]).sum(),(gamma*((pos**2).sum(axis=1)+core)).sum()]))
+
+def lump(vList,group,chosen,widen=True):
+	"""Replace the chosen particles of vList by one particle for each value of group (array over chosen particles).
+	A new particle has the total circulation at the circulation weighted centroid. With widen, Chorin blobs get a core which keeps
+	the angular impulse, otherwise the largest delta of the group is kept"""
+	ids=numpy.nonzero(chosen)[0]
+	[groups,inverse]=numpy.unique(group,return_inverse=True)
+	gamma=vList.strength[ids]
+	pos=vList.pos[ids]
+	blobType=vList.blobType[ids]
+	delta=vList.delta[ids]
+	total=numpy.bincount(inverse,weights=gamma)
+	centroid=numpy.array([numpy.bincount(inverse,weights=gamma*pos[:,0]),numpy.bincount(inverse,weights=gamma*pos[:,1])]).transpose()/total[:,None]
+
+	# Core of a merged Chorin blob from the spread of its particles and their cores
+	m2=CORESECONDMOMENT[2]
+	spread=((pos-centroid[inverse])**2).sum(axis=1)
+	newDelta=numpy.bincount(inverse,weights=gamma*(delta**2+spread/m2))/total
+	newDelta=numpy.maximum(newDelta,0.)**0.5
+	newType=numpy.zeros(len(groups),int)
+	newType[inverse]=blobType
+	oldDelta=numpy.zeros(len(groups))
+	numpy.maximum.at(oldDelta,inverse,delta)
+	newDelta=numpy.where((newType==2)&widen,newDelta,oldDelta)
+
+	vList.keepOnly(~chosen)
+	vList.addVortices(centroid,total,newType,newDelta)
+	return(len(ids)-len(groups))
+
+def mergeParticles(vList,radius,weakTol):
+	"""Merge particles weaker than weakTol which have the same sign and blob type and lie in the same cell of size radius.
+	Merged point vortices and Krasny blobs lose the angular impulse of their spread (reported by controlPopulation).
+	Returns the number of particles removed"""
+	weak=abs(vList.strength)<weakTol
+	if weak.sum()<2:
+		return(0)
+	cell=numpy.floor(vList.pos[weak]/radius).astype(int)
+	cell=cell-cell.min(axis=0)
+	span=cell.max()+1
+	group=((cell[:,0]*span+cell[:,1])*2+(vList.strength[weak]>0))*3+vList.blobType[weak]
+
+	# Only groups with more than one particle are merged
+	[groups,inverse,counts]=numpy.unique(group,return_inverse=True,return_counts=True)
+	chosen=numpy.zeros(vList.nPoints,bool)
+	chosen[numpy.nonzero(weak)[0][counts[inverse]>1]]=True
+	if not chosen.any():
+		return(0)
+	return(lump(vList,group[counts[inverse]>1],chosen))
+
+def cullParticles(vList,window,lumpFar=True):
+	"""Remove particles outside window=[xmin,xmax,ymin,ymax]. With lumpFar, they are lumped
+	into one particle of each side of the window (the side they are farthest beyond), sign and blob type instead,
+	which keeps circulation and linear impulse. All particles of a group are beyond the same side and have the same sign,
+	so the lumped particle is outside the window too.
+	Cores of lumped blobs are not widened, so that far away blobs do not grow without bound.
+	Returns the number of particles removed"""
+	pos=vList.pos
+	outside=(pos[:,0]<window[0])|(pos[:,0]>window[1])|(pos[:,1]<window[2])|(pos[:,1]>window[3])
+	if not outside.any():
+		return(0)
+	if not lumpFar:
+		vList.keepOnly(~outside)
+		return(int(outside.sum()))
+	far=pos[outside]
+	beyond=numpy.array([window[0]-far[:,0],far[:,0]-window[1],window[2]-far[:,1],far[:,1]-window[3]]).transpose()
+	side=beyond.argmax(axis=1)
+	group=(side*2+(vList.strength[outside]>0))*3+vList.blobType[outside]
+	return(lump(vList,group,outside,widen=False))
+
+def controlPopulation(toMod,mergeRadius=None,weakTol=None,window=None,lumpFar=True):
+	"""Apply merging (if mergeRadius and weakTol are given) and culling (if window is given) on all vortex lists of toMod.
+	Returns the error budget: particles before and after, merged and culled particles and the change in
+	circulation, linear impulse and angular impulse (in total, and from merging and culling)"""
+	budget={'nBefore':0,'nAfter':0,'nMerged':0,'nCulled':0,'dGamma':0.,'dImpulse':numpy.zeros(2),'dAngImpulse':0.,
+		'dAngImpulseMerged':0.,'dAngImpulseCulled':0.}
+	for eachList in toMod:
+		if not isinstance(eachList,dfn.vortexList):
+			continue
+		budget['nBefore']=budget['nBefore']+eachList.nPoints
+		before=invariants(eachList)
+		if mergeRadius is not None and weakTol is not None:
+			budget['nMerged']=budget['nMerged']+mergeParticles(eachList,mergeRadius,weakTol)
+		merged=invariants(eachList)
+		budget['dAngImpulseMerged']=budget['dAngImpulseMerged']+merged[3]-before[3]
+		if window is not None:
+			budget['nCulled']=budget['nCulled']+cullParticles(eachList,window,lumpFar)
+		change=invariants(eachList)-before
+		budget['dAngImpulseCulled']=budget['dAngImpulseCulled']+change[3]-(merged[3]-before[3])
+		budget['dGamma']=budget['dGamma']+change[0]
+		budget['dImpulse']=budget['dImpulse']+change[1:3]
+		budget['dAngImpulse']=budget['dAngImpulse']+change[3]
+		budget['nAfter']=budget['nAfter']+eachList.nPoints
+	return(budget)
+
+#### Test functions ####
+def testPopulation(N=2000,delta=0.05):
+	"""Merge and cull a random set of weak Chorin blobs and point vortices, print the error budget and plot particles before and after"""
+	V=dfn.vortexList()
+	pos=numpy.array([[random.uniform(0.,4.),random.gauss(0.,0.5)] for i in range(N)])
+	strength=numpy.array([random.uniform(-0.01,0.01) for i in range(N)])
+	V.addVortices(pos,strength,2*(numpy.arange(N)%2),delta)
+	plt.figure()
+	plt.title('Population control: before (blue) and after (red)')
+	plt.plot(V.pos[:,0],V.pos[:,1],'bo',markersize=2.0)
+	window=[-1.,3.,-2.,2.]
+	budget=controlPopulation([V],mergeRadius=0.1,weakTol=0.005,window=window)
+	plt.plot(V.pos[:,0],V.pos[:,1],'ro',markersize=3.0)
+	print budget
+
+	# Particles on opposite sides of the window are not lumped into one inside it
+	W=dfn.vortexList()
+	W.addVortices(numpy.array([[-3.,0.],[12.,0.]]),numpy.array([0.01,0.01]),0,0.)
+	cullParticles(W,[-2.,10.,-3.,3.])
+	print "Lumped particles of far particles on both sides:", W.pos.tolist()
+	return(budget)
@@ -0,0 +1,130 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Remeshing of vortex particles on a regular lattice
+# Circulation of particles is interpolated on lattice nodes with the M4' kernel, which conserves
+# circulation, linear and angular impulse, and the particles are replaced by the lattice nodes.
+# Near a wall, weights of lattice nodes inside a body are dropped and the rest are scaled up so that circulation
+# is kept (a one sided kernel; impulses are not kept exactly there). Particles too close to the wall for that
+# (less than MINOUTSIDE of their weight outside) are left as they are, with coincident ones given as one particle.
+# Nodes with circulation below a fraction RELGAMMATOL of the largest particle circulation are dropped, so that
+# the kernel tails do not spread the particles by 2h at every remesh.
+
+import numpy
+import definations as dfn
+import vic
+import random
+import matplotlib.pyplot as plt
+
+RELGAMMATOL=1e-6	# Default gammaTol, as a fraction of the largest particle circulation
+MINOUTSIDE=0.5		# Smallest sum of kernel weights outside the bodies for a one sided kernel
+
+def remeshLists(toMod,h,BCList=[],blobType=None,delta=None,gammaTol=None):
+	"""Remesh all vortex lists of toMod together on the lattice of spacing h anchored at the origin.
+	New particles are put in the first vortex list and the other vortex lists are emptied.
+	blobType and delta of new particles are the most common blob type and median delta of old particles if not given.
+	Lattice nodes with circulation not larger than gammaTol (RELGAMMATOL times the largest particle circulation by default) are dropped.
+	Returns particles before and after, particles remeshed with a one sided kernel, particles kept near walls
+	(after coalescing) and circulation dropped"""
+	vLists=[eachList for eachList in toMod if isinstance(eachList,dfn.vortexList)]
+	stats={'nBefore':0,'nAfter':0,'nOneSided':0,'nKept':0,'dGamma':0.}
+	if len(vLists)==0:
+		return(stats)
+	[pos,strength,oldType,oldDelta,others]=dfn.gatherSources(vLists)
+	stats['nBefore']=len(pos)
+	if len(pos)==0:
+		return(stats)
+	if blobType is None:
+		blobType=numpy.bincount(oldType).argmax()
+	if delta is None:
+		delta=numpy.median(oldDelta)
+	if gammaTol is None:
+		gammaTol=RELGAMMATOL*abs(strength).max()
+
+	# Lattice nodes around every particle, and particles whose nodes reach inside a body
+	[nodes,weights]=vic.stencil(pos,numpy.zeros(2),h)
+	used=weights!=0.
+	[nodeIds,inverse]=uniqueRows(nodes[used])
+	inside=numpy.zeros(len(nodeIds),bool)
+	for eachBC in BCList:
+		inside=inside|eachBC.inMask(nodeIds*h)
+	insideNode=numpy.zeros(nodes.shape[:2],bool)
+	insideNode[used]=inside[inverse]
+	nearWall=insideNode.any(axis=1)
+
+	# One sided kernel near walls: weights inside bodies dropped, the others scaled to keep circulation
+	weights=numpy.where(insideNode,0.,weights)
+	outside=weights.sum(axis=1)
+	kept=nearWall&(outside<MINOUTSIDE)
+	oneSided=nearWall&(~kept)
+	weights[oneSided]=weights[oneSided]/outside[oneSided][:,None]
+	stats['nOneSided']=int(oneSided.sum())
+
+	# Circulation on the nodes
+	move=used&(~kept[:,None])&(~insideNode)
+	gamma=numpy.bincount(inverse[move[used]],weights=(weights*strength[:,None])[move],minlength=len(nodeIds))
+	keep=abs(gamma)>gammaTol
+	stats['dGamma']=-gamma[~keep].sum()
+
+	# Put kept near wall particles and new lattice particles in the first list
+	[keptPos,keptStrength,keptType,keptDelta]=coalesce(pos[kept],strength[kept],oldType[kept],oldDelta[kept])
+	stats['nKept']=len(keptPos)
+	for eachList in vLists:
+		eachList.keepOnly(numpy.zeros(eachList.nPoints,bool))
+	vLists[0].addVortices(keptPos,keptStrength,keptType,keptDelta)
+	vLists[0].addVortices(nodeIds[keep]*h,gamma[keep],blobType,delta)
+	stats['nAfter']=vLists[0].nPoints
+	return(stats)
+
+def coalesce(pos,strength,blobType,delta):
+	"""Particles at the same position with the same blob type and delta, given as one particle with their total strength"""
+	if len(pos)==0:
+		return(pos,strength,blobType,delta)
+	keys=numpy.array([pos[:,0],pos[:,1],blobType,delta]).transpose()
+	[rows,inverse]=numpy.unique(keys,axis=0,return_inverse=True)
+	total=numpy.bincount(inverse,weights=strength,minlength=len(rows))
+	return(rows[:,:2],total,rows[:,2].astype(int),rows[:,3])
+
+def uniqueRows(ids):
+	"""Unique rows of an integer array (points x 2) and the index of every row in them"""
+	low=ids.min(axis=0)
+	span=ids.max(axis=0)-low+1
+	flat=(ids[:,0]-low[0])*span[1]+(ids[:,1]-low[1])
+	[flatIds,inverse]=numpy.unique(flat,return_inverse=True)
+	rows=numpy.array([flatIds//span[1]+low[0],flatIds%span[1]+low[1]]).transpose()
+	return(rows,inverse)
+
+#### Test functions ####
+def testRemesh(N=1000,h=0.05,nRepeat=5):
+	"""Remesh a random patch of Chorin blobs and a pile of coincident blobs (as released by the no slip condition) next to a cylinder.
+	Prints circulation, linear and angular impulse before and after, and the number of particles over repeated remeshing,
+	which should not keep growing"""
+	import wallBC
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,50)
+	BC=wallBC.wallNPNSBC(points,cp,normals,inF,reF)
+	V=dfn.vortexList()
+	pos=numpy.array([[random.uniform(-1.5,1.5),random.uniform(1.0,1.5)] for i in range(N)])
+	pos=pos[(pos**2).sum(axis=1)>1.]
+	V.addVortices(pos,numpy.array([random.uniform(-0.01,0.01) for i in range(len(pos))]),2,h)
+	V.addVortices(numpy.zeros([20,2])+numpy.array([0.,1.+h]),0.01,2,h)
+	def moments(V):
+		g=V.strength
+		return(numpy.array([g.sum(),(g*V.pos[:,0]).sum(),(g*V.pos[:,1]).sum(),(g*(V.pos**2).sum(axis=1)).sum()]))
+	before=moments(V)
+	plt.figure()
+	plt.axis('equal')
+	plt.title('Remeshing: before (blue) and after (red)')
+	plt.plot(numpy.array(points)[:,0],numpy.array(points)[:,1])
+	plt.plot(V.pos[:,0],V.pos[:,1],'bo',markersize=2.0)
+	stats=remeshLists([V],h,[BC])
+	plt.plot(V.pos[:,0],V.pos[:,1],'r.',markersize=2.0)
+	print stats
+	print "circulation, linear impulse and angular impulse change:", moments(V)-before
+	counts=[V.nPoints]
+	for k in range(nRepeat):
+		remeshLists([V],h,[BC])
+		counts.append(V.nPoints)
+	print "particles over repeated remeshing:", counts
+	return(stats)
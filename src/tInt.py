@@ -3,7 +3,8 @@
 # Aerospace Engineering, Indian Institute of Technology Bombay
 # Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
 
-# RK-2 implementation
+# Runge-Kutta time integrators (RK-2, RK-4 and adaptive Bogacki-Shampine 2(3)) working on position arrays,
+# and a multi-rate RK-2 which substeps only particles close to walls or in strong velocity gradients
 # Provided test cases can solve viscous incompressible N-S around a circular cylinder
 # python -c "import tInt; tInt.test4RK2()"      will give a flow around circular cylinder
 
@@ -15,73 +16,289 @@ import definations as dfn
 import diffusion
 import matplotlib.pyplot as plt
 import plots
+import population as populationControl
+import remesh
+import cellList
+import checkpoint
+import forces
+import instrument
 
-def advectRK2(dt,toMod=[dfn.vortexList(),dfn.traceList()],fieldGens=[dfn.vortexList(),dfn.linVortList()],vinf=0.0,BCList=[]):
-	"""Modify "toMod(List format)" objects according to RK 2 advection based on fieldGens(List format) for advection"""
+# Butcher tableaux: stage coefficients a, weights b, and weights of the embedded lower order solution (None if not embedded)
+TABLEAUX={
+	'RK2':([[],[0.5]],[0.,1.],None),
+	'RK4':([[],[0.5],[0.,0.5],[0.,0.,1.]],[1./6.,1./3.,1./3.,1./6.],None),
+	'BS23':([[],[0.5],[0.,0.75],[2./9.,1./3.,4./9.]],[2./9.,1./3.,4./9.,0.],[7./24.,1./4.,1./3.,1./8.]),
+	}
+
+def stageVel(pos,toMod,fieldGens,vinf,BCList,velField,slip=False,record=False):
+	"""Move toMod points to pos (recording traces only if record) and find velocity there, satisfying no penetration"""
+	dfn.scatterPos(toMod,pos,record)     # Note that this step will also modify appropriate positions in fieldGens, because of shared lists
+	instrument.count('advect.stages')
+	[field]=wallBC.fusedVelField([pos],fieldGens,vinf,BCList,velField,slip=slip)
+	return(field)
+
+def reflectPos(oldPos,newPos,BCList=[]):
+	"""Reflect new positions which are inside a boundary, for points moving from oldPos"""
+	for eachBC in BCList:
+		inside=eachBC.inMask(newPos)
+		if inside.any():
+			newPos[inside]=eachBC.reflectMany(oldPos[inside],newPos[inside]-oldPos[inside])
+	return(newPos)
+
+def rkStages(dt,pos,k1,toMod,fieldGens,vinf,BCList,velField,method,recordStages=False):
+	"""Remaining stages of an explicit RK step from pos, with first stage velocity k1. Stage positions are recorded in traces with recordStages.
+	Returns the new positions (not written to toMod) and the error estimate (largest displacement
+	between the two embedded solutions, None if method is not embedded)"""
+	[a,b,bHat]=TABLEAUX[method]
+	k=[k1]
+	for i in range(1,len(b)):
+		stagePos=pos.copy()
+		for j in range(i):
+			if a[i][j]!=0.:
+				stagePos=stagePos+dt*(a[i][j]*k[j])
+		k.append(stageVel(stagePos,toMod,fieldGens,vinf,BCList,velField,record=recordStages))
+	newPos=pos.copy()
+	for j in range(len(b)):
+		if b[j]!=0.:
+			newPos=newPos+dt*(b[j]*k[j])
+	err=None
+	if bHat is not None:
+		diff=numpy.zeros(pos.shape)
+		for j in range(len(b)):
+			diff=diff+(b[j]-bHat[j])*k[j]
+		err=dt*(((diff**2).sum(axis=1)**0.5).max() if len(pos)>0 else 0.)
+	return(newPos,err)
+
+@instrument.timed('advect')
+def advectRK(dt,toMod=[dfn.vortexList(),dfn.traceList()],fieldGens=[dfn.vortexList(),dfn.linVortList()],vinf=0.0,BCList=[],velField=dfn.velField,method='RK2',recordStages=False):
+	"""Modify "toMod(List format)" objects according to an explicit RK step ('RK2', 'RK4' or 'BS23') based on fieldGens(List format).
+	No slip velocities of the walls are found in the first stage. Returns the error estimate (None for methods without one)
+	and the largest speed of the first stage. Only final positions are recorded in traces, unless recordStages"""
+	pos=dfn.gatherPos(toMod)
+	instrument.gauge('advected',len(pos))
+	k1=stageVel(pos,toMod,fieldGens,vinf,BCList,velField,slip=True)
+	[newPos,err]=rkStages(dt,pos,k1,toMod,fieldGens,vinf,BCList,velField,method,recordStages)
+	dfn.scatterPos(toMod,reflectPos(pos,newPos,BCList))
+	return(err,maxSpeed(k1))
+
+def advectRK2(dt,toMod=[dfn.vortexList(),dfn.traceList()],fieldGens=[dfn.vortexList(),dfn.linVortList()],vinf=0.0,BCList=[],velField=dfn.velField,recordHalfStep=False):
+	"""Modify "toMod(List format)" objects according to RK 2 advection based on fieldGens(List format) for advection
+	velField is the function used for velocity fields, e.g. definations.velField or treeCode.treeVelField()
+	Half step positions are recorded in traces only with recordHalfStep"""
+	advectRK(dt,toMod,fieldGens,vinf,BCList,velField,'RK2',recordHalfStep)
+
+def maxSpeed(field):
+	"""Largest speed of a velocity array"""
+	if len(field)==0:
+		return(0.)
+	return(((field**2).sum(axis=1)**0.5).max())
+
+class stepControl():
+	"""Time step selection for adaptive integration. Next step is the smaller of the CFL step (CFL*length/largest speed)
+	and the error step (safety*dt*(tol/err)**(1/order)), limited to [dtMin,dtMax] and to growing by maxGrowth at a time"""
+	def __init__(self,tol=1e-04,CFL=1.0,length=1.0,dtMin=1e-06,dtMax=numpy.inf,order=3,safety=0.9,maxGrowth=2.0):
+		self.tol=tol
+		self.CFL=CFL
+		self.length=length
+		self.dtMin=dtMin
+		self.dtMax=dtMax
+		self.order=order
+		self.safety=safety
+		self.maxGrowth=maxGrowth
+		self.nAccepted=0
+		self.nRejected=0
 	
-	#Calculate total number of toMod Points and append their positions
-	N=0
-	pos=[]
-	for eachList in toMod:
-		N=N+eachList.nPoints
-		pos=pos+eachList.posit()
-	pos=numpy.array(pos)
-	oldPos=pos.copy()
+	def cflStep(self,speed):
+		"""Largest step allowed by the CFL condition"""
+		if speed<=0.:
+			return(self.dtMax)
+		return(self.CFL*self.length/speed)
+	
+	def errorStep(self,dt,err):
+		"""Step for which the error would be safety*tol"""
+		if err is None:
+			return(self.dtMax)
+		if err<=0.:
+			return(dt*self.maxGrowth)
+		return(dt*min(self.maxGrowth,self.safety*(self.tol/err)**(1./self.order)))
 	
-	# Satisfy no penetration
-	[eachBC.findVcp(fieldGens,vinf) for eachBC in BCList]
-	[eachBC.applyNPBC(fieldGens) for eachBC in BCList]
+	def accept(self,err):
+		"""Whether a step with error estimate err is accepted"""
+		return(err is None or err<=self.tol)
 	
-	#Calculate no slip velocities
-	[eachBC.findVcps(fieldGens,vinf) for eachBC in BCList]
+	def nextStep(self,dt,err,speed):
+		"""Step to try next, after a step of dt with error estimate err and largest speed speed"""
+		dt=min(self.errorStep(dt,err),self.cflStep(speed),self.dtMax)
+		return(max(dt,self.dtMin))
 
-	# Calculate field at all positions 
-	field=dfn.velField(pos,fieldGens,vinf)
+def advectAdaptive(dt,toMod=[dfn.vortexList(),dfn.traceList()],fieldGens=[dfn.vortexList(),dfn.linVortList()],vinf=0.0,BCList=[],velField=dfn.velField,control=None,method='BS23'):
+	"""Modify "toMod(List format)" objects with an adaptive step of the embedded method, trying dt first.
+	Steps are limited by the CFL condition and retried with a smaller step while the error estimate is larger than control.tol.
+	The first stage is found once and reused by retries. Returns the step taken and the step to try next"""
+	if control is None:
+		control=stepControl()
+	pos=dfn.gatherPos(toMod)
+	k1=stageVel(pos,toMod,fieldGens,vinf,BCList,velField,slip=True)
+	speed=maxSpeed(k1)
+	dt=max(min(dt,control.cflStep(speed),control.dtMax),control.dtMin)
+	while True:
+		[newPos,err]=rkStages(dt,pos,k1,toMod,fieldGens,vinf,BCList,velField,method)
+		if control.accept(err) or dt<=control.dtMin:
+			break
+		control.nRejected=control.nRejected+1
+		dt=max(control.errorStep(dt,err),control.dtMin)
+	control.nAccepted=control.nAccepted+1
+	dfn.scatterPos(toMod,reflectPos(pos,newPos,BCList))
+	return(dt,control.nextStep(dt,err,speed))
 
-	# Close NP BC
-	[eachBC.closeNPBC(fieldGens) for eachBC in BCList]
+def wallDistance(pos,BCList=[],blockSize=dfn.BLOCKSIZE):
+	"""Distance of every position (array) from the nearest wall panel of BCList"""
+	dist=numpy.zeros(len(pos))+numpy.inf
+	for eachBC in BCList:
+		x1=numpy.array(eachBC.points,dtype=float)
+		x2=numpy.roll(x1,-1,axis=0)
+		side=x2-x1
+		length2=(side**2).sum(axis=1)
+		nTargets=max(1,blockSize//len(x1))
+		for start in range(0,len(pos),nTargets):
+			block=pos[start:start+nTargets]
+			rel=block[:,None,:]-x1[None,:,:]
+			t=numpy.clip((rel*side[None,:,:]).sum(axis=2)/length2[None,:],0.,1.)
+			d=((rel-t[:,:,None]*side[None,:,:])**2).sum(axis=2).min(axis=1)**0.5
+			dist[start:start+nTargets]=numpy.minimum(dist[start:start+nTargets],d)
+	return(dist)
 
-	#Take first step of RK 2 and modify positions
-	n=0
-	for eachList in toMod:
-		for eachPoint in eachList.allV:	
-			newPos=dfn.eulerInt(pos[n],field[n],dt/2.0)
-			eachPoint.modifyPos(newPos)     # Note that this step will also modify appropriate positions in fieldGens, because of pointers
-			n=n+1
-
-	#Calculate total number of toMod Points and append their positions
-	newN=0
-	pos=[]
+def velocityGradient(pos,field,cutoff):
+	"""Estimate of the velocity gradient at every position: largest velocity difference over distance
+	to the neighbours within cutoff (found with a cell list)"""
+	grad=numpy.zeros(len(pos))
+	[i,j,dist]=cellList.cellPairs(pos,cutoff)
+	keep=dist>dfn.NODETOL
+	[i,j,dist]=[i[keep],j[keep],dist[keep]]
+	g=((field[i]-field[j])**2).sum(axis=1)**0.5/dist
+	numpy.maximum.at(grad,i,g)
+	numpy.maximum.at(grad,j,g)
+	return(grad)
+
+def binParticles(dt,pos,field,BCList=[],nearDist=None,gradTol=None,cutoff=0.1):
+	"""Fast bin of a multi-rate step: particles closer than nearDist to a wall, or for which
+	dt times the velocity gradient is larger than gradTol. Returns a boolean array"""
+	fast=numpy.zeros(len(pos),bool)
+	if nearDist is not None:
+		fast=fast|(wallDistance(pos,BCList)<nearDist)
+	if gradTol is not None:
+		fast=fast|(dt*velocityGradient(pos,field,cutoff)>gradTol)
+	return(fast)
+
+class frozenField():
+	"""Velocities sampled once at a fixed set of targets and reused as a field generator.
+	It can only be evaluated at the same number of targets, taken in the same order"""
+	def __init__(self,values):
+		self.values=values
+	
+	def batchFieldEffect(self,pos):
+		"""Sampled velocities, for positions in the order of the sampled targets"""
+		if len(pos)!=len(self.values):
+			raise ValueError("frozen field has %i targets, %i given" %(len(self.values),len(pos)))
+		return(self.values)
+
+def sourceArrays(toMod,fieldGens):
+	"""Strength, blob type, delta and a source flag for every point of toMod (in gatherPos order),
+	and the vortex lists of fieldGens which are not in toMod"""
+	strength=[]
+	blobType=[]
+	delta=[]
+	isSource=[]
 	for eachList in toMod:
-		newN=newN+eachList.nPoints
-		pos=pos+eachList.posit()
-	pos=numpy.array(pos)
+		n=eachList.nPoints
+		if isinstance(eachList,dfn.vortexList):
+			strength.append(eachList.strength)
+			blobType.append(eachList.blobType)
+			delta.append(eachList.delta)
+		else:
+			strength.append(numpy.zeros(n))
+			blobType.append(numpy.zeros(n,int))
+			delta.append(numpy.zeros(n))
+		inGens=isinstance(eachList,dfn.vortexList) and any([eachGen is eachList for eachGen in fieldGens])
+		isSource.append(numpy.zeros(n,bool)+inGens)
+	fixed=[eachGen for eachGen in fieldGens if isinstance(eachGen,dfn.vortexList) and not any([eachGen is eachList for eachList in toMod])]
+	cat=lambda arrays,dtype: numpy.concatenate(arrays+[numpy.zeros(0,dtype)])
+	return(cat(strength,float),cat(blobType,int),cat(delta,float),cat(isSource,bool),fixed)
+
+def nearMask(pos,ref,dist):
+	"""Boolean array telling which of the positions have a point of ref closer than dist"""
+	near=numpy.zeros(len(pos),bool)
+	if len(pos)==0 or len(ref)==0:
+		return(near)
+	[i,j,d]=cellList.cellPairs(numpy.concatenate([pos,ref]),dist)
+	N=len(pos)
+	near[i[(i<N)&(j>=N)]]=True
+	near[j[(j<N)&(i>=N)]]=True
+	return(near)
+
+def advectMultiRate(dt,toMod=[dfn.vortexList(),dfn.traceList()],fieldGens=[dfn.vortexList(),dfn.linVortList()],vinf=0.0,BCList=[],velField=dfn.velField,nSub=4,nearDist=0.1,gradTol=None,cutoff=0.1,farDist=0.3):
+	"""Modify "toMod(List format)" objects with a multi-rate RK 2 step. Particles are binned (binParticles) into a fast bin,
+	which takes nSub (even) RK 2 substeps, and a slow bin, which takes one RK 2 step of dt.
+	In the substeps, fast sources and slow sources closer than farDist to the fast bin (moved along their RK 2 stage velocities)
+	are evaluated directly. Velocity of the other slow sources at the fast particles and wall control points is found at the
+	start and at the middle of the step and reused by the substeps of each half. Slow particles see all sources at the middle of the step.
+	Returns the fast bin (boolean array in gatherPos order)"""
+	nSub=2*int(math.ceil(nSub/2.))
+	pos=dfn.gatherPos(toMod)
+	k1=stageVel(pos,toMod,fieldGens,vinf,BCList,velField,slip=True)
+	fast=binParticles(dt,pos,k1,BCList,nearDist,gradTol,cutoff)
+	if not fast.any() or fast.all():
+		# Single rate step, with nSub steps if every particle is fast
+		n=nSub if fast.any() else 1
+		[newPos,err]=rkStages(dt/n,pos,k1,toMod,fieldGens,vinf,BCList,velField,'RK2')
+		for k in range(1,n):
+			k1=stageVel(newPos,toMod,fieldGens,vinf,BCList,velField)
+			[newPos,err]=rkStages(dt/n,newPos,k1,toMod,fieldGens,vinf,BCList,velField,'RK2')
+		dfn.scatterPos(toMod,reflectPos(pos,newPos,BCList))
+		return(fast)
 	
-	if newN!=N:
-		print "number of points cannot change in an advection step"
+	# Sources moving in the substeps (fast, and slow ones near the fast bin) and far slow sources
+	[strength,blobType,delta,isSource,fixed]=sourceArrays(toMod,fieldGens)
+	others=[eachGen for eachGen in fieldGens if not isinstance(eachGen,(dfn.vortexList,dfn.traceList))]
+	near=(~fast)&nearMask(pos,pos[fast],farDist)
+	moving=isSource&(fast|near)
+	far=isSource&(~moving)
+	movingList=dfn.vortexList()
+	movingList.addVortices(pos[moving],strength[moving],blobType[moving],delta[moving])
+	cps=numpy.concatenate([eachBC.cp for eachBC in BCList]+[numpy.zeros([0,2])])
+	def freeze(allPos):
+		# Far slow source velocity at wall control points and fast particles
+		farList=dfn.vortexList()
+		farList.addVortices(allPos[far],strength[far],blobType[far],delta[far])
+		return(frozenField(velField(numpy.concatenate([cps,allPos[fast]]),[farList]+fixed,0.0)))
+	def fastVel(allPos,frozen):
+		movingList.setPos(allPos[moving],record=False)
+		[field]=wallBC.fusedVelField([allPos[fast]],[movingList,frozen]+others,vinf,BCList,velField,slip=False)
+		return(field)
+	def substeps(allPos,slowVel,frozen,firstVel=None):
+		# Slow particles move along slowVel, fast particles take RK 2 substeps
+		h=dt/nSub
+		for k in range(nSub//2):
+			v1=firstVel if (k==0 and firstVel is not None) else fastVel(allPos,frozen)
+			halfPos=allPos.copy()
+			halfPos[fast]=allPos[fast]+(h/2.)*v1
+			halfPos[~fast]=allPos[~fast]+(h/2.)*slowVel
+			v2=fastVel(halfPos,frozen)
+			allPos=allPos.copy()
+			allPos[fast]=allPos[fast]+h*v2
+			allPos[~fast]=allPos[~fast]+h*slowVel
+		return(allPos)
 	
-	# Satisfy no penetration
-	[eachBC.findVcp(fieldGens,vinf) for eachBC in BCList]
-	[eachBC.applyNPBC(fieldGens) for eachBC in BCList]
+	# First half: slow particles move along k1, far slow sources frozen at the start
+	midPos=substeps(pos,k1[~fast],freeze(pos),k1[fast])
 	
-	#Calculate field with new positions
-	field=dfn.velField(pos,fieldGens,vinf)
-
-	# Close NP BC
-	[eachBC.closeNPBC(fieldGens) for eachBC in BCList]
-
-    # Take second step of RK 2 and modify final positions
-	n=0
-	for eachList in toMod:
-		for eachPoint in eachList.allV:	
-			newPos=dfn.eulerInt(oldPos[n],field[n],dt)
-			dPos=newPos-oldPos[n]
-			#Reflect the new position if it is in boundary
-			for eachBC in BCList:
-				if (eachBC.inBoundary(newPos)):
-					newPos=eachBC.reflect(oldPos[n],dPos)
-			eachPoint.modifyPos(newPos)
-			n=n+1
+	# Middle: slow stage with all sources, then second half with slow particles moving along it
+	dfn.scatterPos(toMod,midPos,record=False)
+	[k2]=wallBC.fusedVelField([midPos[~fast]],fieldGens,vinf,BCList,velField,slip=False)
+	newPos=substeps(midPos,k2,freeze(midPos))
+	newPos[~fast]=pos[~fast]+dt*k2
+	dfn.scatterPos(toMod,reflectPos(pos,newPos,BCList))
+	return(fast)
 
 #### Test functions ####
 def test1RK2(endTime=100.):
@@ -127,6 +344,70 @@ def test1RK2(endTime=100.):
 	plt.plot(err2)
 	return()
 
+def testRKOrder(endTime=1.0,steps=[10,20,40],tol=1e-06):
+	"""Two vortices of same strength rotating in a circle, integrated with RK2 and RK4 on fixed steps
+	and with the adaptive scheme. Prints the position error at endTime against the exact rotation"""
+	p=numpy.array([[-0.5,0.0],[0.5,0.0]])
+	# Angular speed of the pair (clockwise for positive strength)
+	omega=-1.0/(2*math.pi*1.0**2)*2
+	c=math.cos(omega*endTime)
+	s=math.sin(omega*endTime)
+	exact=p.dot(numpy.array([[c,s],[-s,c]]))
+	def newPair():
+		VList=dfn.vortexList()
+		VList.addVortices(p,1.0,0,0.0)
+		return(VList)
+	errs={}
+	for method in ['RK2','RK4']:
+		errs[method]=[]
+		for N in steps:
+			VList=newPair()
+			for k in range(N):
+				advectRK(endTime/N,[VList],[VList],0.0,[],dfn.velField,method)
+			errs[method].append(abs(VList.pos-exact).max())
+			print "%s, %i steps: error = %e" %(method,N,errs[method][-1])
+	VList=newPair()
+	control=stepControl(tol,CFL=10.,length=1.0)
+	time=0.
+	dt=endTime/steps[0]
+	while time<endTime:
+		[dt,dtNext]=advectAdaptive(min(dt,endTime-time),[VList],[VList],0.0,[],dfn.velField,control)
+		time=time+dt
+		dt=dtNext
+	print "BS23, tol %e: %i steps (%i rejected), error = %e" %(tol,control.nAccepted,control.nRejected,abs(VList.pos-exact).max())
+	return(errs)
+
+def testMultiRate(N=400,dt=0.05,nSub=4,nearDist=0.1,farDist=0.3):
+	"""One step of the multi-rate integrator for blobs just off a cylinder (not reaching the wall), compared with a single rate RK 2 step of dt
+	and with a reference of many small RK 2 steps. Prints errors of the fast and slow bins"""
+	import random
+	[points,cp,normals,inF,reF]=wallBC.cylBCPoints(1.0,50)
+	BCList=[wallBC.wallNPNSBC(points,cp,normals,inF,reF)]
+	vinf=numpy.array([1.0,0.0])
+	rad=numpy.array([1.02+0.2*random.random()**2 for i in range(N)])
+	theta=numpy.array([random.uniform(-math.pi,math.pi) for i in range(N)])
+	pos=numpy.array([rad*numpy.cos(theta),rad*numpy.sin(theta)]).transpose()
+	strength=numpy.array([random.uniform(-0.01,0.01) for i in range(N)])
+	def newList():
+		VList=dfn.vortexList()
+		VList.addVortices(pos,strength,2,0.03)
+		return(VList)
+	results={}
+	for name in ['reference','single rate','multi rate']:
+		VList=newList()
+		if name=='reference':
+			for k in range(4*nSub):
+				advectRK(dt/(4*nSub),[VList],[VList],vinf,BCList)
+		elif name=='single rate':
+			advectRK(dt,[VList],[VList],vinf,BCList)
+		else:
+			fast=advectMultiRate(dt,[VList],[VList],vinf,BCList,nSub=nSub,nearDist=nearDist,farDist=farDist)
+		results[name]=VList.pos.copy()
+	for name in ['single rate','multi rate']:
+		err=((results[name]-results['reference'])**2).sum(axis=1)**0.5
+		print "%s: fast bin (%i particles) error = %e, slow bin error = %e" %(name,fast.sum(),err[fast].max(),err[~fast].max())
+	return(results)
+
 def test2RK2(Npoints=30,Npanels=50):
 	"""Test RK-2 time integrator with boundary conditions. Simulate a non-viscous flow around a cylinder.
 	NPoins being number of tracer points and NPanels being number of panels on the cylinder surface"""
@@ -219,15 +500,33 @@ def test3RK2(Npanels=50):
 	plt.show()
 	return()
 
-def test4RK2(Npanels=50):
+def test4RK2(Npanels=50,velField=dfn.velField,coalesce=False,population=None,remeshEvery=0,remeshH=None,seed=None,diffusionMethod='RVM',method='RK2',tol=None,multiRate=None,checkpointEvery=0,checkpointPath='checkpoint',restart=None,asyncPlots=False,forceFile=None,endTime=6.0):
 	"""Test RK-2 time integrator with boundary conditions. Simulate a Viscous flow around a cylinder.
-	NPoins being number of tracer points and NPanels being number of panels on the cylinder surface"""
+	NPoins being number of tracer points and NPanels being number of panels on the cylinder surface.
+	velField is the velocity field function used for advection.
+	With coalesce, no slip blobs at the same location are released as a few blobs of several units (see wallBC.wallNPNSBC.applyNSBC), into one list of the wall.
+	population is a dictionary of arguments for populationControl.controlPopulation, applied after every diffusion step.
+	With remeshEvery, vortices are remeshed every remeshEvery steps on a lattice of spacing remeshH (blob delta by default).
+	seed makes the random walks of diffusion, and so the whole run, reproducible.
+	diffusionMethod is 'RVM' (random walks) or 'PSE' (particle strength exchange, to be used with remeshEvery).
+	method is the RK scheme for fixed steps ('RK2' or 'RK4'). With tol, steps are chosen by the adaptive
+	Bogacki-Shampine scheme from the error estimate (tol in length units) and the CFL condition.
+	multiRate is a dictionary of arguments for advectMultiRate (e.g. nSub, nearDist), used in place of fixed steps.
+	With checkpointEvery, the state is saved every checkpointEvery steps in the directory checkpointPath.
+	restart is the path of a checkpoint to continue a run from.
+	With asyncPlots, figures are made from snapshots in a worker process (plots.plotWorker) while the solver runs.
+	With forceFile, drag and lift coefficients of every step (from impulse and surface pressure) are appended to it
+	(CSV if it ends with .csv, binary otherwise).
+	The flow is simulated till endTime.
+	Each step is closed with instrument.endStep, which logs its timers and counters if instrument is enabled"""
 	
 	#Define parameters
 	Re=1000
 	delta=(1./Re)**0.5
 	lemda=delta*math.pi
 	gmin=0.2
+	if seed is not None:
+		diffusion.seedRVM(seed)
 	#Define V_Infinite, field generators and modifiable points
 	vinf=numpy.array([1.0,0.0])
 	fieldGens=[]
@@ -245,32 +544,101 @@ def test4RK2(Npanels=50):
 	BC=wallBC.wallNPNSBC(BCpoints,BCcp,BCNormals,BCinFunction,BCreflectFunction)
 	BCList.append(BC)
 
-	# Initiate time mesh
+	# Initiate time stepping
 	startTime=0.0
 	CFL=1.0
 	timeStep=CFL*lemda/((vinf.dot(vinf))**0.5)
-	endTime=6.0
-	timeMesh=dfn.linearTimeMesh(startTime,timeStep,endTime)
+	control=stepControl(tol,CFL,lemda,dtMax=4*timeStep) if tol is not None else None
 
 	#Start time loop
-	for i in range(1,len(timeMesh)):
-		print "time=%f"%timeMesh[i]
-		dt=timeMesh[i]-timeMesh[i-1]
+	time=startTime
+	dt=timeStep
+	i=0
+	if restart is not None:
+		[toMod,fieldGens,time,i,extra]=checkpoint.loadCheckpoint(restart,BCList)
+		dt=extra['dt']
+	worker=plots.plotWorker(velField=velField) if asyncPlots else None
+	monitor=forces.forceMonitor(forceFile,(vinf.dot(vinf))**0.5,2*rad,pressure=True,resume=restart is not None) if forceFile is not None else None
+	while time<endTime:
+		i=i+1
+		dt=min(dt,endTime-time)
 		
 		# Advect particles
-		advectRK2(dt,toMod,fieldGens,vinf,BCList)
+		if multiRate is not None:
+			advectMultiRate(dt,toMod,fieldGens,vinf,BCList,velField,**multiRate)
+			dtNext=timeStep
+		elif control is None:
+			advectRK(dt,toMod,fieldGens,vinf,BCList,velField,method)
+			dtNext=timeStep
+		else:
+			[dt,dtNext]=advectAdaptive(dt,toMod,fieldGens,vinf,BCList,velField,control)
+		time=time+dt
+		print "time=%f"%time
 
 		# Introduce no slip boundary conditions 
 		# Vslips are calculated in the advection step. That is to be changed for better architecture
-		[eachBC.applyNSBC(fieldGens,toMod,gmin,delta) for eachBC in BCList]
+		[eachBC.applyNSBC(fieldGens,toMod,gmin,delta,coalesce=coalesce,persist=coalesce) for eachBC in BCList]
+
+		#Diffuse all particles using RVM or PSE
+		if diffusionMethod=='PSE':
+			diffusion.applyPSE(dt,nu,toMod,BCList)
+		else:
+			diffusion.applyRVM(dt,nu,toMod,BCList)
+
+		# Merge weak particles and remove far away particles
+		if population is not None:
+			budget=populationControl.controlPopulation(toMod,**population)
+			print "particles: %i -> %i, circulation change = %e" %(budget['nBefore'],budget['nAfter'],budget['dGamma'])
+
+		# Remesh vortices on a regular lattice
+		if remeshEvery>0 and i%remeshEvery==0:
+			stats=remesh.remeshLists(toMod,remeshH if remeshH is not None else delta,BCList)
+			print "remeshed: %i -> %i particles, %i one sided and %i kept near walls" %(stats['nBefore'],stats['nAfter'],stats['nOneSided'],stats['nKept'])
 
-		#Diffuse all particles using RVM
-		diffusion.applyRVM(dt,nu,toMod,BCList)
+		# Solve no penetration once for the particles of the end of the step. Forces, plots and the first stage of
+		# the next step use these sheets (wallBC.sheetsValid) instead of solving it again
+		wallBC.fusedVelField([],fieldGens,vinf,BCList,velField,slip=False)
+
+		# Force coefficients of the step
+		if monitor is not None:
+			row=monitor.record(i,time,dt,fieldGens,vinf,BCList,velField)
+			print "Cd=%f Cl=%f" %(row['Cd'],row['Cl'])
 
 		# Post Processing: to be done after 5 time steps
-		if i%5==0:	
+		if i%5==0 and worker is not None:
+			# Plot Vorticity Particles and Velocity Field in the worker
+			worker.submit(toMod,fieldGens,vinf,BCList,time)
+		elif i%5==0:	
 			# Plot Vorticity Particles			
-			plots.plotVort(toMod,BCList,timeMesh[i])
+			plots.plotVort(toMod,BCList,time)
 			# Plot Velocity Field
-			plots.plotVel(fieldGens,vinf,BCList,timeMesh[i])
+			plots.plotVel(fieldGens,vinf,BCList,time,velField)
+		dt=dtNext
+
+		# Save the state to continue from
+		if checkpointEvery>0 and i%checkpointEvery==0:
+			checkpoint.saveCheckpoint(checkpointPath,toMod,fieldGens,BCList,time,i,{'dt':dt})
+		instrument.endStep(i,time)
+	if worker is not None:
+		worker.close()
 	return()
+
+def testSheetReuse(nSteps=6,logFile='sheetReuse.log'):
+	"""Runs nSteps of test4RK2 with forces and checks, from the instrument log, that no penetration is solved once
+	at the end of every step and that forces, plots and the first stage of the next step reuse those sheets:
+	after the first step, RK-2 solves no penetration twice a step (second stage and end of step)"""
+	Re=1000
+	timeStep=((1./Re)**0.5)*math.pi
+	instrument.enable(logFile)
+	try:
+		test4RK2(forceFile='sheetReuseForces.csv',endTime=(nSteps-0.5)*timeStep)
+	finally:
+		instrument.disable()
+	steps=instrument.loadLog(logFile)
+	for eachStep in steps[1:]:
+		solves=eachStep['calls'].get('wall.NPSolve',0)
+		reuses=eachStep['counts'].get('wall.sheetReuses',0)
+		print "step %i: %i no penetration solves, %i reuses" %(eachStep['step'],solves,reuses)
+		assert solves==2, "no penetration is solved %i times in step %i" %(solves,eachStep['step'])
+		assert reuses>=1, "sheets of the last step are not reused in step %i" %eachStep['step']
+	return(steps)
@@ -0,0 +1,174 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Trace (trajectory) recording of traced particles
+# Positions are stored as rows (frame, id, x, y) in a preallocated array, which either grows, or is used as a
+# ring buffer keeping the latest rows. Frames can be decimated. With a file name, full buffers are appended to
+# a raw binary file of TRACEDTYPE rows, which can be memory mapped with loadTraces for post processing
+
+import os
+import numpy
+import random
+import matplotlib.pyplot as plt
+
+TRACEDTYPE=numpy.dtype([('frame',numpy.int64),('id',numpy.int64),('pos',numpy.float64,(2,))])
+
+class traceRecorder():
+	"""Recorder of particle positions. Every call of record is a frame; only every 'every'th frame is kept.
+	capacity is the number of rows kept in memory. With ringBuffer, older rows are overwritten when it is full,
+	otherwise it grows, or, with fileName, it is appended to the file and emptied"""
+	def __init__(self,capacity=4096,every=1,ringBuffer=False,fileName=None):
+		self.capacity=capacity
+		self.every=every
+		self.ringBuffer=ringBuffer
+		self.fileName=fileName
+		self.rows=numpy.zeros(capacity,TRACEDTYPE)
+		self.nRows=0
+		self.start=0
+		self.frame=0
+		self.nWritten=0
+
+	def record(self,ids,pos,force=False):
+		"""Record positions pos (array) of particles ids as a new frame. With force, the rows are kept even if
+		the frame is skipped by decimation (used for first positions of particles); it is then not counted as a frame"""
+		if not force:
+			self.frame=self.frame+1
+			if (self.frame-1)%self.every!=0:
+				return()
+		n=len(ids)
+		if n==0:
+			return()
+		new=numpy.zeros(n,TRACEDTYPE)
+		new['frame']=self.frame
+		new['id']=ids
+		new['pos']=pos
+		if self.fileName is not None:
+			if self.nRows+n>self.capacity:
+				self.flush()
+			if n>self.capacity:
+				self.writeRows(new)
+				return()
+		elif self.ringBuffer:
+			if n>=self.capacity:
+				self.rows[:]=new[n-self.capacity:]
+				self.nRows=self.capacity
+				self.start=0
+				return()
+			end=(self.start+self.nRows)%self.capacity
+			slots=(end+numpy.arange(n))%self.capacity
+			self.rows[slots]=new
+			overflow=max(self.nRows+n-self.capacity,0)
+			self.nRows=self.nRows+n-overflow
+			self.start=(self.start+overflow)%self.capacity
+			return()
+		elif self.nRows+n>len(self.rows):
+			newRows=numpy.zeros(max(2*len(self.rows),self.nRows+n),TRACEDTYPE)
+			newRows[:self.nRows]=self.rows[:self.nRows]
+			self.rows=newRows
+		self.rows[self.nRows:self.nRows+n]=new
+		self.nRows=self.nRows+n
+
+	def writeRows(self,rows):
+		"""Append rows to the file"""
+		f=open(self.fileName,'ab')
+		try:
+			rows.tofile(f)
+		finally:
+			f.close()
+		self.nWritten=self.nWritten+len(rows)
+
+	def flush(self):
+		"""Append rows kept in memory to the file (if any) and empty the buffer"""
+		if self.fileName is None or self.nRows==0:
+			return()
+		self.writeRows(self.rows[:self.nRows])
+		self.nRows=0
+
+	def memoryRows(self):
+		"""Rows kept in memory, oldest first"""
+		if self.ringBuffer and self.fileName is None:
+			ids=(self.start+numpy.arange(self.nRows))%self.capacity
+			return(self.rows[ids])
+		return(self.rows[:self.nRows])
+
+	def allRows(self):
+		"""All recorded rows, from the file and from memory, oldest first"""
+		rows=self.memoryRows()
+		if self.fileName is not None and self.nWritten>0:
+			rows=numpy.concatenate([loadTraces(self.fileName)[:self.nWritten],rows])
+		return(rows)
+
+	def history(self,pointId):
+		"""Recorded positions (array) of the particle with id pointId"""
+		rows=self.allRows()
+		return(rows['pos'][rows['id']==pointId])
+
+	def histories(self):
+		"""Dictionary of id and recorded positions of every recorded particle"""
+		rows=self.allRows()
+		order=numpy.argsort(rows['id'],kind='mergesort')
+		[ids,starts]=numpy.unique(rows['id'][order],return_index=True)
+		parts=numpy.split(rows['pos'][order],starts[1:])
+		return(dict(zip(ids,parts)))
+
+	def settings(self):
+		"""Settings and counters, to build the recorder again (e.g. from a checkpoint)"""
+		return({'capacity':self.capacity,'every':self.every,'ringBuffer':self.ringBuffer,'fileName':self.fileName,
+			'frame':self.frame,'nWritten':self.nWritten})
+
+def recorderFromSettings(settings,rows):
+	"""A recorder with settings (from traceRecorder.settings) holding rows in memory"""
+	recorder=traceRecorder(settings['capacity'],settings['every'],settings['ringBuffer'],settings['fileName'])
+	recorder.frame=settings['frame']
+	recorder.nWritten=settings['nWritten']
+	recorder.rows=numpy.zeros(max(recorder.capacity,len(rows)),TRACEDTYPE)
+	recorder.rows[:len(rows)]=rows
+	recorder.nRows=len(rows)
+	# Rows written to the file after the settings were taken are dropped
+	if recorder.fileName is not None and os.path.exists(recorder.fileName):
+		if os.path.getsize(recorder.fileName)>recorder.nWritten*TRACEDTYPE.itemsize:
+			f=open(recorder.fileName,'r+b')
+			try:
+				f.truncate(recorder.nWritten*TRACEDTYPE.itemsize)
+			finally:
+				f.close()
+	return(recorder)
+
+def loadTraces(fileName):
+	"""Memory map of the rows of a trace file"""
+	if os.path.getsize(fileName)==0:
+		return(numpy.zeros(0,TRACEDTYPE))
+	return(numpy.memmap(fileName,dtype=TRACEDTYPE,mode='r'))
+
+#### Test functions ####
+def testRecorder(N=50,nFrames=200,every=4,fileName='traceTest.bin'):
+	"""Record random walks with decimation in memory, in a ring buffer and streamed to a file.
+	Prints the largest difference between recorded and expected histories"""
+	pos=numpy.zeros([N,2])
+	ids=numpy.arange(N)
+	walks=[]
+	if os.path.exists(fileName):
+		os.remove(fileName)
+	recorders=[traceRecorder(64,every),traceRecorder(10*N,every,ringBuffer=True),traceRecorder(64,every,fileName=fileName)]
+	for eachRecorder in recorders:
+		eachRecorder.record(ids,pos,force=True)
+	walks.append(pos.copy())
+	for k in range(nFrames):
+		pos=pos+numpy.array([[random.gauss(0.,0.1),random.gauss(0.,0.1)] for i in range(N)])
+		for eachRecorder in recorders:
+			eachRecorder.record(ids,pos)
+		if k%every==0:
+			walks.append(pos.copy())
+	recorders[2].flush()
+	walks=numpy.array(walks)
+	errs=[abs(recorders[0].history(3)-walks[:,3]).max(),abs(recorders[1].history(3)-walks[-10:,3]).max(),abs(recorders[2].history(3)-walks[:,3]).max()]
+	print "Errors of growing, ring buffer and streamed recorders:", errs
+	print "Rows in file: %i" %len(loadTraces(fileName))
+	plt.figure()
+	plt.title('Recorded random walks')
+	for [pointId,hist] in recorders[2].histories().items()[:10]:
+		plt.plot(hist[:,0],hist[:,1])
+	os.remove(fileName)
+	return(max(errs))
@@ -4,72 +4,409 @@
 # Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
 
 # Tree code algorithm to achieve N.logN speed up
-# Incomplete code
+# Barnes-Hut quad tree with complex multipole expansions.
+# u-iv due to a vortex at z0 is i*gamma/(2*pi*(z-z0)). About a cluster center zc this is
+# i/(2*pi)*sum(a_p/(z-zc)**(p+1)), with cluster coefficients a_p=sum(gamma*(z0-zc)**p)
 
 import definations as dfn
 import numpy
+import math
 import random
 import matplotlib.pyplot as plt
 import time
+
+# Largest relative velocity error allowed for a Krasny blob taken as a point vortex. Krasny blobs differ from
+# point vortices by a relative (delta/distance)**2, so clusters with Krasny blobs are far only beyond delta/sqrt(KRASNYTOL)
+KRASNYTOL=1e-06
+
+def binomials(order):
+	"""Pascal triangle of binomial coefficients C(p,k) for p,k < order"""
+	B=numpy.zeros([order,order])
+	for p in range(order):
+		B[p][0]=1.
+		for k in range(1,p+1):
+			B[p][k]=B[p-1][k-1]+B[p-1][k]
+	return(B)
+
 class tree():
 	"""A tree structure that contains info aboout various clusters"""
-	def __init__(self):
-		"""Initiate zeroth level box and decide lowest number of particles in a cluster"""
-		self.allBoxes
-		self.levelMap 
+	def __init__(self,leafSize=32,theta=0.5,order=12,maxLevel=20,rebuildFactor=2.0):
+		"""Initiate zeroth level box and decide lowest number of particles in a cluster.
+		theta is the opening angle (cluster size/distance) below which a cluster is used as a whole,
+		order is the number of terms in multipole expansions.
+		rebuildFactor decides, in incremental updates, when a drifted subtree is built again"""
+		self.allBoxes=[]
+		self.levelMap=[]
+		self.leafSize=leafSize
+		self.theta=theta
+		self.order=order
+		self.maxLevel=maxLevel
+		self.rebuildFactor=rebuildFactor
+		self.binom=binomials(order)
+		self.otherGens=[]
+		self.listTags={}
+		self.nextTag=0
+		self.keys=numpy.zeros(0,int)
+		self.leafOf=numpy.zeros(0,int)
+	
+	def loadSources(self,fieldGens):
+		"""Take vortices of fieldGens as arrays. Every vortex gets a key from its list and its id, which stays the same across time steps.
+		Tags of lists are kept only for the lists of fieldGens; a list seen for the first time gets a tag never used before"""
+		[self.pos,self.strength,self.blobType,self.delta,self.otherGens]=dfn.gatherSources(fieldGens)
+		self.z=self.pos[:,0]+((1j)*self.pos[:,1])
+		keys=[]
+		listTags={}
+		for eachList in fieldGens:
+			if isinstance(eachList,dfn.vortexList):
+				old=self.listTags.get(id(eachList))
+				if old is not None and old[1] is eachList:
+					listTags[id(eachList)]=old
+				elif id(eachList) not in listTags:
+					listTags[id(eachList)]=(self.nextTag,eachList)
+					self.nextTag=self.nextTag+1
+				keys.append(eachList.ids+(listTags[id(eachList)][0]<<40))
+		self.listTags=listTags
+		if len(keys)>0:
+			self.keys=numpy.concatenate(keys)
+		else:
+			self.keys=numpy.zeros(0,int)
+	
 	def mkTree(self,fieldGens):
 		"""Generate tree in a downward direction, based on fieldGens"""
+		self.loadSources(fieldGens)
+		self.allBoxes=[]
+		self.levelMap=[]
+		self.leafOf=-numpy.ones(len(self.pos),int)
+		if len(self.pos)==0:
+			return()
+		
+		# Zeroth level box is the smallest square containing all the points
+		root=self.boundingBox(numpy.arange(len(self.pos)))
+		root.glbId=0
+		self.allBoxes.append(root)
+		self.splitBox(root)
+		self.compact()
+		return()
+	
+	def boundingBox(self,ids):
+		"""Smallest square cluster containing points ids"""
+		lowLim=self.pos[ids].min(axis=0)
+		upLim=self.pos[ids].max(axis=0)
+		size=max((upLim-lowLim).max(),dfn.NODETOL)*(1.+1e-06)
+		center=(lowLim+upLim)/2.
+		box=clustr(center[0]-size/2.,center[0]+size/2.,center[1]-size/2.,center[1]+size/2.)
+		box.fieldGensInsideId=ids
+		return(box)
+	
+	def splitBox(self,box):
+		"""Split box, and then its children, in four as long as they have more than leafSize points"""
+		stack=[box]
+		while len(stack)>0:
+			box=stack.pop()
+			box.childrenId=[]
+			if len(box.fieldGensInsideId)<=self.leafSize or box.levelId>=self.maxLevel:
+				self.leafOf[box.fieldGensInsideId]=box.glbId
+				continue
+			for child in box.split():
+				child.findClustrFieldGens(self.pos,box.fieldGensInsideId)
+				if len(child.fieldGensInsideId)>0:
+					self.addBox(child,box)
+					stack.append(child)
+	
+	def addBox(self,box,parent):
+		"""Add box to the tree and to its parent"""
+		box.glbId=len(self.allBoxes)
+		box.parentId=parent.glbId
+		box.levelId=parent.levelId+1
+		self.allBoxes.append(box)
+		parent.childrenId.append(box.glbId)
+	
+	def compact(self):
+		"""Find points of every box from the leaves of the points, drop empty boxes and number the boxes level by level"""
+		order=[self.allBoxes[0]]
+		for box in order:
+			order.extend([self.allBoxes[eachId] for eachId in box.childrenId])
+		sorter=numpy.argsort(self.leafOf,kind='mergesort')
+		leaves=self.leafOf[sorter]
+		for box in reversed(order):
+			if len(box.childrenId)==0:
+				box.fieldGensInsideId=sorter[numpy.searchsorted(leaves,box.glbId):numpy.searchsorted(leaves,box.glbId,side='right')]
+			else:
+				children=[self.allBoxes[eachId] for eachId in box.childrenId]
+				children=[child for child in children if len(child.fieldGensInsideId)>0]
+				box.childrenId=[child.glbId for child in children]
+				if len(children)>0:
+					box.fieldGensInsideId=numpy.concatenate([child.fieldGensInsideId for child in children])
+				else:
+					box.fieldGensInsideId=numpy.zeros(0,int)
+		
+		# Number the boxes again, parents before children
+		self.allBoxes=[]
+		self.levelMap=[]
+		oldBoxes=dict([(box.glbId,box) for box in order])
+		stack=[(order[0],-1,0)]
+		for [box,parentId,levelId] in stack:
+			if len(box.fieldGensInsideId)==0 and parentId>=0:
+				continue
+			children=box.childrenId
+			box.glbId=len(self.allBoxes)
+			box.parentId=parentId
+			box.levelId=levelId
+			box.childrenId=[]
+			self.allBoxes.append(box)
+			if levelId==len(self.levelMap):
+				self.levelMap.append([])
+			self.levelMap[levelId].append(box.glbId)
+			if parentId>=0:
+				self.allBoxes[parentId].childrenId.append(box.glbId)
+			if len(children)==0:
+				self.leafOf[box.fieldGensInsideId]=box.glbId
+			stack.extend([(oldBoxes[eachId],box.glbId,levelId+1) for eachId in children])
+		return()
+	
+	def update(self,fieldGens):
+		"""Update the tree to new positions of the vortices in fieldGens, instead of building it again.
+		Vortices keep their leaves and box sizes and coefficients are fitted again. New vortices are inserted in the leaves containing them.
+		Subtrees whose leaves hold more than rebuildFactor*leafSize vortices, or whose vortices spread more than
+		rebuildFactor times the box size, are built again. The whole tree is built again if a new vortex is outside it"""
+		oldKeys=self.keys
+		oldLeafOf=self.leafOf
+		self.loadSources(fieldGens)
+		if len(self.allBoxes)==0 or len(self.pos)==0:
+			self.mkTree(fieldGens)
+			self.findCoefs()
+			return()
+		
+		# Vortices that were in the tree stay in their leaves
+		sorter=numpy.argsort(oldKeys)
+		found=numpy.searchsorted(oldKeys[sorter],self.keys)
+		found=numpy.minimum(found,len(oldKeys)-1)
+		old=sorter[found]
+		self.leafOf=numpy.where(oldKeys[old]==self.keys,oldLeafOf[old],-1)
+		
+		# Insert new vortices, going down from zeroth level box
+		newIds=numpy.nonzero(self.leafOf<0)[0]
+		if len(newIds)>0:
+			root=self.allBoxes[0]
+			root.findClustrFieldGens(self.pos,newIds)
+			if len(root.fieldGensInsideId)<len(newIds):
+				self.mkTree(fieldGens)
+				self.findCoefs()
+				return()
+			self.insert(root,newIds)
+		self.compact()
+		
+		# Build drifted subtrees again, top most boxes first
+		rebuilt=False
+		for level in range(len(self.levelMap)):
+			for eachId in self.levelMap[level]:
+				box=self.allBoxes[eachId]
+				if box.fieldGensInsideId is None:
+					continue
+				ids=box.fieldGensInsideId
+				spread=abs(self.z[ids]-box.center).max()
+				crowded=(len(box.childrenId)==0 and len(ids)>self.rebuildFactor*self.leafSize and level<self.maxLevel)
+				if crowded or spread>self.rebuildFactor*box.halfDiagonal:
+					self.rebuild(box)
+					rebuilt=True
+		if rebuilt:
+			self.compact()
+		self.findCoefs()
+		return()
+	
+	def insert(self,box,ids):
+		"""Put new vortices ids in leaves under box. Quadrants without a box get a new leaf"""
+		stack=[(box,ids)]
+		while len(stack)>0:
+			[box,ids]=stack.pop()
+			if len(box.childrenId)==0:
+				self.leafOf[ids]=box.glbId
+				continue
+			children=[self.allBoxes[eachId] for eachId in box.childrenId]
+			for quadrant in box.split():
+				quadrant.findClustrFieldGens(self.pos,ids)
+				if len(quadrant.fieldGensInsideId)==0:
+					continue
+				child=[eachChild for eachChild in children if eachChild.xmin==quadrant.xmin and eachChild.ymin==quadrant.ymin and eachChild.xmax==quadrant.xmax]
+				if len(child)==0:
+					self.addBox(quadrant,box)
+					self.leafOf[quadrant.fieldGensInsideId]=quadrant.glbId
+				else:
+					stack.append((child[0],quadrant.fieldGensInsideId))
+	
+	def rebuild(self,box):
+		"""Build the subtree under box again, in a box fitted to its vortices. Boxes below it are marked as removed"""
+		stack=list(box.childrenId)
+		while len(stack)>0:
+			child=self.allBoxes[stack.pop()]
+			stack.extend(child.childrenId)
+			child.fieldGensInsideId=None
+		fitted=self.boundingBox(box.fieldGensInsideId)
+		for eachAttr in ['xmin','xmax','ymin','ymax','center','halfDiagonal']:
+			setattr(box,eachAttr,getattr(fitted,eachAttr))
+		self.splitBox(box)
+	
 	def findCoefs(self):
-		"""Calculates coffecients in downward direction"""
+		"""Calculates coffecients in upward direction, childless clusters first and then parents from their children.
+		Cluster radii are fitted to their vortices, which may have moved out of the box"""
+		for level in range(len(self.levelMap)-1,-1,-1):
+			for eachId in self.levelMap[level]:
+				box=self.allBoxes[eachId]
+				box.maxDelta=self.delta[box.fieldGensInsideId].max()
+				box.krasnyDelta=(self.delta[box.fieldGensInsideId]*(self.blobType[box.fieldGensInsideId]==1)).max()
+				if len(box.childrenId)==0:
+					box.findCoef(self)
+					box.radius=max(box.halfDiagonal,abs(self.z[box.fieldGensInsideId]-box.center).max())
+				else:
+					box.transCoefs(self)
+					box.radius=max([box.halfDiagonal]+[abs(self.allBoxes[eachChild].center-box.center)+self.allBoxes[eachChild].radius for eachChild in box.childrenId])
+		return()
+	
 	def findVel(self,pos):
-		"""Find velocity induced due to the tree structure at 'pos'; velocity induced by vortex sheets and any other field Generators that are not included in the tree structure, needs to be calculated seperately""" 
+		"""Find velocity induced due to the tree structure at 'pos' (array of positions); velocity induced by vortex sheets and any other field Generators that are not included in the tree structure, needs to be calculated seperately""" 
+		pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+		field=numpy.zeros([len(pos),2])
+		if len(self.allBoxes)==0 or len(pos)==0:
+			return(field)
+		z=pos[:,0]+((1j)*pos[:,1])
+		w=numpy.zeros(len(pos),complex)
+		
+		# Walk down the tree with the set of positions that still need each box opened
+		stack=[(0,numpy.arange(len(pos)))]
+		while len(stack)>0:
+			[boxId,ids]=stack.pop()
+			box=self.allBoxes[boxId]
+			far=box.isFar(z[ids],self.theta)
+			if far.any():
+				w[ids[far]]=w[ids[far]]+box.findVel(z[ids[far]])
+			ids=ids[~far]
+			if len(ids)==0:
+				continue
+			if len(box.childrenId)==0:
+				inside=box.fieldGensInsideId
+				field[ids]=field[ids]+dfn.blobVel(pos[ids],self.pos[inside],self.strength[inside],self.blobType[inside],self.delta[inside])
+			else:
+				for eachChild in box.childrenId:
+					stack.append((eachChild,ids))
+		field[:,0]=field[:,0]+w.real
+		field[:,1]=field[:,1]-w.imag
+		return(field)
 
-def velFieldFMM(pos,fieldGen,vinf = 0.0):
-	"""Final function that calculates velocity field at 'pos' positions"""
+def velFieldFMM(pos,fieldGen,vinf=0.0,theta=0.5,order=12,leafSize=32):
+	"""Final function that calculates velocity field at 'pos' positions.
+	Can be used in place of definations.velField"""
 	
-	field=numpy.zeros(pos.shape)
+	pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
 	print "number of Positions = %i" %len(pos)
 	
 	# Initiate tree
-	myTree = tree()
+	myTree = tree(leafSize,theta,order)
 	
-	# Create the tree
-	myTree.mkTree(fieldGens)
+	# Create the tree and find coefficients of all clusters
+	myTree.mkTree(fieldGen)
+	myTree.findCoefs()
+
+	# Calculate velocity from tree struct and add vinf
+	field=myTree.findVel(pos)+vinf
+	
+	# Seperately calculate velocity of field generators that are not in the tree
+	return(dfn.othersVel(pos,myTree.otherGens,field))
 
-	for i in range(len(pos)):
-		vel=vector.zeroValue
-		# Seperately calculate velocity is it is linear vortex sheet
-		for eachGen in fieldGen:
-			if type(eachGen) == linVortList or type(eachGen) == linVortex:
-				vel=vel+eachGen.fieldEffect(pos[i])
-		# Add vinf
-		field[i]=vel+vinf
+class treeVelField():
+	"""Velocity field function that keeps its tree across calls. It can be used in place of definations.velField,
+	e.g. tInt.advectRK2(...,velField=treeCode.treeVelField()).
+	The tree is used as it is while vortices do not move (control points and particles of one RK stage),
+	and updated incrementally when they move or new vortices are added"""
+	def __init__(self,theta=0.5,order=12,leafSize=32,rebuildFactor=2.0):
+		self.myTree=tree(leafSize,theta,order,rebuildFactor=rebuildFactor)
+		self.nBuilds=0
+		self.nUpdates=0
+		self.nReuses=0
+	
+	def __call__(self,pos,fieldGen,vinf=0.0):
+		"""Velocity field at 'pos' positions due to vinf and fieldGen"""
+		pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+		print "number of Positions = %i" %len(pos)
+		myTree=self.myTree
+		[srcPos,strength,blobType,delta,others]=dfn.gatherSources(fieldGen)
+		if len(myTree.allBoxes)==0:
+			myTree.mkTree(fieldGen)
+			myTree.findCoefs()
+			self.nBuilds=self.nBuilds+1
+		elif srcPos.shape==myTree.pos.shape and (srcPos==myTree.pos).all() and (strength==myTree.strength).all():
+			myTree.otherGens=others
+			self.nReuses=self.nReuses+1
+		else:
+			myTree.update(fieldGen)
+			self.nUpdates=self.nUpdates+1
 		
-		# Calculate velocity from tree struct
-		vel = vel + myTree.findVel(pos)
-	return(field)
+		# Velocity from the tree, vinf and field generators that are not in the tree
+		field=myTree.findVel(pos)+vinf
+		return(dfn.othersVel(pos,others,field))
 
 class clustr():
 	"""A rectengular cluster which contains specified number of particles, and stores coefficients"""
 	def __init__(self,xmin,xmax,ymin,ymax):
 		"""Initiate a cluster with  appropriate xmin, xmax, ymin, ymax values"""
-		self.glbId
-		self.parentId = []
-		self.childrenId = []
-		self.levelId
-		self.Coeffs
-	def findClustrFieldGens(fieldGens):
-		"""Find fieldGens that reside inside this cluster"""
-		self.fieldGensInsideId
-	def findVel(self,pos):
-		"""Find velocity due to this cluster on 'pos'"""
-		# Check whether 'pos' is sufficiently far away
-	def transCoefs(self,allBoxes):
+		self.xmin=xmin
+		self.xmax=xmax
+		self.ymin=ymin
+		self.ymax=ymax
+		self.center=complex((xmin+xmax)/2.,(ymin+ymax)/2.)
+		self.halfDiagonal=0.5*((xmax-xmin)**2+(ymax-ymin)**2)**0.5
+		self.radius=self.halfDiagonal
+		self.glbId=0
+		self.parentId=-1
+		self.childrenId=[]
+		self.levelId=0
+		self.Coeffs=[]
+		self.maxDelta=0.
+		self.krasnyDelta=0.
+		self.fieldGensInsideId=numpy.zeros(0,int)
+	
+	def split(self):
+		"""Give the four children clusters of this cluster"""
+		xmid=(self.xmin+self.xmax)/2.
+		ymid=(self.ymin+self.ymax)/2.
+		return([clustr(self.xmin,xmid,self.ymin,ymid),clustr(xmid,self.xmax,self.ymin,ymid),clustr(self.xmin,xmid,ymid,self.ymax),clustr(xmid,self.xmax,ymid,self.ymax)])
+	
+	def findClustrFieldGens(self,pos,ids):
+		"""Find fieldGens (out of ids of the parent) that reside inside this cluster. Lower edges are inclusive"""
+		p=pos[ids]
+		inside=(p[:,0]>=self.xmin)&(p[:,0]<self.xmax)&(p[:,1]>=self.ymin)&(p[:,1]<self.ymax)
+		self.fieldGensInsideId=ids[inside]
+	
+	def findVel(self,z):
+		"""Find u-iv due to this cluster on complex positions z, using its multipole expansion"""
+		u=1./(z-self.center)
+		w=numpy.zeros(len(z),complex)
+		for p in range(len(self.Coeffs)-1,-1,-1):
+			w=(w+self.Coeffs[p])*u
+		return((1j)/2./math.pi*w)
+	
+	def transCoefs(self,myTree):
 		"""Transfers coefficients from childs to parents"""
-	def findCoef(self,fieldGens):
+		self.Coeffs=numpy.zeros(myTree.order,complex)
+		powers=numpy.arange(myTree.order)
+		for eachChild in self.childrenId:
+			child=myTree.allBoxes[eachChild]
+			d=child.center-self.center
+			dPow=d**numpy.maximum(powers[:,None]-powers[None,:],0)
+			self.Coeffs=self.Coeffs+(myTree.binom*dPow).dot(child.Coeffs)
+	
+	def findCoef(self,myTree):
 		"""Find coefficients for childless clusters"""
-	def isFar(self,pos):
-		"""Find whether 'pos' is far from the cluster"""
+		ids=self.fieldGensInsideId
+		dz=myTree.z[ids]-self.center
+		powers=numpy.arange(myTree.order)
+		self.Coeffs=(myTree.strength[ids][None,:]*dz[None,:]**powers[:,None]).sum(axis=1)
+	
+	def isFar(self,z,theta=0.5):
+		"""Find whether complex positions z are far from the cluster. The cluster should look smaller than theta,
+		and z should be outside the core of every blob in it. Outside their cores Chorin blobs are exact point vortices.
+		Krasny blobs differ from them by a relative (delta/distance)**2, so z should also be beyond delta/sqrt(KRASNYTOL)"""
+		dist=abs(z-self.center)
+		return((self.radius<theta*dist)&(dist-self.radius>max(self.maxDelta,self.krasnyDelta/KRASNYTOL**0.5)))
 
 #### Test functions ####
 def randomFieldGens(N = 200):
@@ -108,9 +445,8 @@ def checkTreeGen():
 	plt.figure()
 	# Plot all the field Gen points
 	for eachList in fieldGens:
-		if type(eachList) != linVortList:
-			for eachV in eachList:
-				plt.plot(eachV.position[0],eachV.position[1],'ro',markersize = 3.0)
+		if type(eachList) == dfn.vortexList:
+			plt.plot(eachList.pos[:,0],eachList.pos[:,1],'ro',markersize = 3.0)
 	
 	#Plot tree structure
 	for eachClustr in myTree.allBoxes:
@@ -141,11 +477,20 @@ def checkTreeCoeffs():
 	
 	# Find and print errors between the two
 	for i in range(20):
-		err = numpy.norm(fieldReg - fieldFMM)
+		err = numpy.linalg.norm(fieldReg[i] - fieldFMM[i])
 		print err
 		if err > 1e-06:
 			print "Error is greater than 1e-06"
 	
+	# Krasny blobs, which are not point vortices at any finite distance, against direct summation
+	for blobType in [0,1,2]:
+		V = dfn.vortexList()
+		V.addVortices(numpy.array([[random.random(),random.random()] for i in range(2000)]),numpy.array([random.uniform(-1.,1.) for i in range(2000)]),blobType,0.05)
+		fieldReg = dfn.velField(V.pos,[V],vinf = 0.0)
+		errs = [abs(engine(V.pos,[V],vinf = 0.0)-fieldReg).max()/abs(fieldReg).max() for engine in [velFieldFMM,treeVelField()]]
+		print "Blob type %i: largest relative error of velFieldFMM %e, treeVelField %e" %(blobType,errs[0],errs[1])
+		assert max(errs) < 1e-04, "tree velocity of blob type %i differs from direct summation" %blobType
+	
 def checkFMMTime():
 	"""Compare the time taken to calculate velocity fields on each other with varying number of fieldGens"""
  	
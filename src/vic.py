@@ -0,0 +1,135 @@
+# Code for 2-dimensional vortex methods
+# Written by: Achyut Panchal
+# Aerospace Engineering, Indian Institute of Technology Bombay
+# Inspired by lectures from Prof. Prabhu Ramachandran, IIT Bombay
+
+# Vortex in cell (particle-mesh) velocity field
+# Circulation of vortices is spread on a regular grid, stream function is found with FFTs
+# and velocity is interpolated back. Other field generators are added by definations.othersVel.
+# With the sign convention of definations.vortex, stream function of a vortex is gamma/(2*pi)*log(r),
+# u=d(psi)/dy and v=-d(psi)/dx
+
+import definations as dfn
+import numpy
+import math
+import random
+import matplotlib.pyplot as plt
+
+def M4(r):
+	"""M4' interpolation kernel. Conserves circulation, linear and angular impulse"""
+	r=abs(r)
+	w=numpy.zeros(r.shape)
+	inner=r<1.
+	outer=(r>=1.)&(r<2.)
+	w[inner]=1.-2.5*r[inner]**2+1.5*r[inner]**3
+	w[outer]=0.5*(2.-r[outer])**2*(1.-r[outer])
+	return(w)
+
+def stencil(pos,lowLim,h):
+	"""Grid nodes and M4' weights of the 4x4 nodes around each position.
+	Returns node indices (positions x 16 x 2) and weights (positions x 16)"""
+	s=(pos-lowLim)/h
+	base=numpy.floor(s).astype(int)-1
+	nodes=numpy.zeros([len(pos),16,2],int)
+	weights=numpy.zeros([len(pos),16])
+	k=0
+	for a in range(4):
+		for b in range(4):
+			nodes[:,k,0]=base[:,0]+a
+			nodes[:,k,1]=base[:,1]+b
+			weights[:,k]=M4(s[:,0]-nodes[:,k,0])*M4(s[:,1]-nodes[:,k,1])
+			k=k+1
+	return(nodes,weights)
+
+def greenFFT(nx,ny,h):
+	"""FFT of the free space Green's function log(r)/(2*pi) on a grid padded to twice its size (Hockney's method).
+	Value at r=0 is the average over a disc of the size of a cell"""
+	i=numpy.arange(2*nx)
+	j=numpy.arange(2*ny)
+	i=numpy.minimum(i,2*nx-i)
+	j=numpy.minimum(j,2*ny-j)
+	r=h*(i[:,None]**2+j[None,:]**2)**0.5
+	r[0,0]=1.
+	G=numpy.log(r)/2./math.pi
+	G[0,0]=(math.log(h/math.pi**0.5)-0.5)/2./math.pi
+	return(numpy.fft.rfft2(G))
+
+class vicVelField():
+	"""Particle-mesh velocity field function. It can be used in place of definations.velField,
+	e.g. tInt.advectRK2(...,velField=vic.vicVelField(h=0.02)).
+	h is the grid spacing (by default the median blob delta), margin is the number of empty cells around
+	sources and targets, and maxNodes limits the grid size, making h larger if needed"""
+	def __init__(self,h=None,margin=4,maxNodes=2**22):
+		self.h=h
+		self.margin=margin
+		self.maxNodes=maxNodes
+		self.greens={}
+
+	def __call__(self,pos,fieldGen,vinf=0.0):
+		"""Velocity field at 'pos' positions due to vinf and fieldGen"""
+		pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+		print "number of Positions = %i" %len(pos)
+		[srcPos,strength,blobType,delta,others]=dfn.gatherSources(fieldGen)
+		field=dfn.othersVel(pos,others,numpy.zeros(pos.shape)+vinf)
+		if len(srcPos)==0 or len(pos)==0:
+			return(field)
+		return(field+self.meshVel(pos,srcPos,strength,delta))
+
+	def gridSpacing(self,allPos,delta):
+		"""Grid spacing, from h, the blob deltas and maxNodes"""
+		size=allPos.max(axis=0)-allPos.min(axis=0)
+		h=self.h
+		if h is None:
+			if (delta>0).any():
+				h=numpy.median(delta[delta>0])
+			else:
+				h=max(size.max(),dfn.NODETOL)/256.
+		n=(size/h+2*self.margin+1)
+		if n[0]*n[1]>self.maxNodes:
+			h=h*(n[0]*n[1]/self.maxNodes)**0.5
+		return(h)
+
+	def meshVel(self,pos,srcPos,strength,delta):
+		"""Velocity at pos due to vortices at srcPos through the grid"""
+		allPos=numpy.concatenate([srcPos,pos])
+		h=self.gridSpacing(allPos,delta)
+		lowLim=allPos.min(axis=0)-self.margin*h
+		[nx,ny]=numpy.ceil((allPos.max(axis=0)+self.margin*h-lowLim)/h).astype(int)+1
+
+		# Spread circulation on the grid nodes
+		[nodes,weights]=stencil(srcPos,lowLim,h)
+		flat=(nodes[:,:,0]*ny+nodes[:,:,1]).ravel()
+		gamma=numpy.bincount(flat,weights=(weights*strength[:,None]).ravel(),minlength=nx*ny).reshape(nx,ny)
+
+		# Stream function by convolution with Green's function on the padded grid
+		key=(nx,ny,h)
+		if key not in self.greens:
+			self.greens={key:greenFFT(nx,ny,h)}
+		psi=numpy.fft.irfft2(numpy.fft.rfft2(gamma,[2*nx,2*ny])*self.greens[key],[2*nx,2*ny])[:nx,:ny]
+
+		# Velocity on the grid, and back on the positions
+		[dpsidx,dpsidy]=numpy.gradient(psi,h)
+		[nodes,weights]=stencil(pos,lowLim,h)
+		u=(dpsidy[nodes[:,:,0],nodes[:,:,1]]*weights).sum(axis=1)
+		v=-(dpsidx[nodes[:,:,0],nodes[:,:,1]]*weights).sum(axis=1)
+		return(numpy.array([u,v]).transpose())
+
+#### Test functions ####
+def testVIC(N=5000,h=0.02):
+	"""Compare particle-mesh velocity with direct summation for a patch of Chorin blobs.
+	Errors are printed inside the patch and away from it"""
+	V=dfn.vortexList()
+	pos=numpy.array([[random.gauss(0.,0.3),random.gauss(0.,0.3)] for i in range(N)])
+	V.addVortices(pos,1./N,2,2*h)
+	X,Y=numpy.meshgrid(numpy.linspace(-1.5,1.5,31),numpy.linspace(-1.5,1.5,31))
+	grid=numpy.array([X.flatten(),Y.flatten()]).transpose()
+	fieldReg=dfn.velField(grid,[V])
+	fieldVIC=vicVelField(h)(grid,[V])
+	err=((fieldVIC-fieldReg)**2).sum(axis=1)**0.5/abs(fieldReg).max()
+	far=(grid**2).sum(axis=1)>1.
+	print "Maximum error / maximum velocity: inside the patch %e, away from it %e" %(err[~far].max(),err[far].max())
+	plt.figure()
+	plt.title('Particle-mesh velocity error')
+	plt.contourf(X,Y,err.reshape(X.shape))
+	plt.colorbar()
+	return(err)
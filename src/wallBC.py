@@ -9,11 +9,19 @@
 
 import math
 import cmath
+import os
+import hashlib
 import numpy
 import definations as dfn
+import instrument
 import matplotlib.pyplot as plt
 NODETOL=1e-08
 
+# A matrices of wall geometries already assembled, in memory, and on disk if CACHEDIR is set
+# (e.g. os.path.join(os.path.expanduser('~'),'.vortexMethods','linNPA'))
+NPACACHE={}
+CACHEDIR=None
+
 #### Define boundary condition classes ####
 
 class wallNPNSBC:
@@ -24,21 +32,43 @@ class wallNPNSBC:
 		self.cp=cp
 		self.normals=normals
 		self.A=linNPA(points,cp,normals)
+		self.Ainv=factorA(self.A)
 		self.inBoundary=inFunction
 		self.reflect=reflectFunction
 		# Find cps points, that are control points for no Slip conditions.
 		# located just above the normal control points for no penetration
 		self.cps=self.cp+(100*NODETOL)*(self.normals)
 	
-	def findVcp(self,fieldGens=[],vinf=0.0):
+	def inMask(self,pos):
+		"""Boolean array telling which of the positions (array) are inside the boundary.
+		Boundary functions marked with acceptsArrays are called once for all positions"""
+		pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+		if getattr(self.inBoundary,'acceptsArrays',False):
+			return(numpy.asarray(self.inBoundary(pos),dtype=bool).reshape(len(pos)))
+		return(numpy.array([bool(self.inBoundary(eachPos)) for eachPos in pos],dtype=bool))
+	
+	def reflectMany(self,pos,dPos):
+		"""Reflected positions of points at pos (array) moving by dPos into the boundary"""
+		pos=numpy.asarray(pos,dtype=float).reshape(-1,2)
+		dPos=numpy.asarray(dPos,dtype=float).reshape(-1,2)
+		if getattr(self.reflect,'acceptsArrays',False):
+			return(self.reflect(pos,dPos).reshape(-1,2))
+		newPos=numpy.zeros(pos.shape)
+		for i in range(len(pos)):
+			newPos[i]=self.reflect(pos[i],dPos[i])
+		return(newPos)
+	
+	@instrument.timed('wall.findVcp')
+	def findVcp(self,fieldGens=[],vinf=0.0,velField=dfn.velField):
 		"""find V at control points.
 		This step is to be executed at starting of each step"""
-		self.vcp=dfn.velField(self.cp,fieldGens,vinf)
+		self.vcp=velField(self.cp,fieldGens,vinf)
 	
-	def findVcps(self,fieldGens,vinf=0.0):
+	@instrument.timed('wall.findVcps')
+	def findVcps(self,fieldGens,vinf=0.0,velField=dfn.velField):
 		"""For slip boundary conditions Vcp is to be find slightly above the control point
 		that is done by using this function. """
-		self.vcps=dfn.velField(self.cps,fieldGens,vinf)
+		self.vcps=velField(self.cps,fieldGens,vinf)
 	
 	
 	def closeNPBC(self,fieldGens):
@@ -46,45 +76,174 @@ class wallNPNSBC:
 		This is to be applied after each time step is over"""
 		fieldGens.pop(self.fieldGenIndex)	
 	
+	@instrument.timed('wall.NPSolve')
 	def applyNPBC(self,fieldGens=[]):
 		"""modifies fieldGens in order to apply boundary conditions"""
 		self.fieldGenIndex=len(fieldGens)
-		linList=NPLinList(self.points,self.vcp,self.A,self.cp,self.normals)		
+		linList=NPLinList(self.points,self.vcp,self.A,self.cp,self.normals,self.Ainv)		
 		fieldGens.append(linList)
+		self.linList=linList
+		self.linListState=None
 		self.initFlag=1
 	
-	def applyNSBC(self,fieldGens,toMod,gmin=0.1,delta=0.03):
+	@instrument.timed('wall.NPSolve')
+	def solveNP(self,vcp):
+		"""gammas at the wall points for velocities vcp at control points, using the factorized A.
+		vcp can also be a batch of velocity sets (sets x points x 2), giving gammas as points x sets"""
+		return(solveGamma(self.Ainv,NPB(self.points,vcp,self.normals)))
+	
+	@instrument.timed('wall.noSlipRelease')
+	def applyNSBC(self,fieldGens,toMod,gmin=0.1,delta=0.03,coalesce=False,persist=False,maxPerBlob=4):
 		""" adds vortices near the boundary to both toMod and fieldGens.
-		In order to satisfy no-slip condition"""
+		In order to satisfy no-slip condition.
+		With coalesce, the blobs released at the same location are given as blobs of at most maxPerBlob units (one blob if maxPerBlob is None),
+		whose strength is the sum of theirs. Only the mean vorticity after RVM diffusion is the same: a blob of k units takes one random walk
+		for all of them, so the released vorticity is not spread within the blob and there are k times fewer independent samples,
+		which raises the variance of the RVM estimate by up to a factor maxPerBlob.
+		With persist, blobs are added to one vortex list of this wall (blobStore), which is put in toMod and fieldGens only once.
+		Number of particles and lists are kept in nsMetrics"""
 		
 		#Find vSlips
 		N=len(self.points)
-		vSlip=numpy.zeros(N)
-		tange=numpy.array([numpy.array([-self.normals[i][1],self.normals[i][0]]) for i in range(N)])
-		vSlip =numpy.array([-self.vcps[i].dot(tange[i]) for i in range(N)])
+		tange=numpy.array([-self.normals[:,1],self.normals[:,0]]).transpose()
+		vSlip=-(self.vcps*tange).sum(axis=1)
 		#Calculate parameters
 		lemda=delta*math.pi
 		nBlobs=vSlip/gmin
 		direc=numpy.sign(nBlobs)
-		nBlobs=numpy.vectorize(int)(abs(nBlobs))
+		nBlobs=abs(nBlobs).astype(int)
 		blobLoc=self.cp+delta*(self.normals)
 		blobStren=gmin*lemda
+		self.releasedGamma=direc*nBlobs*blobStren
+		
+		#Number of units in every blob released at each location
+		if coalesce:
+			if maxPerBlob is None:
+				units=nBlobs[nBlobs>0]
+				panel=numpy.nonzero(nBlobs>0)[0]
+			else:
+				nPackets=-(-nBlobs//maxPerBlob)
+				panel=numpy.repeat(numpy.arange(N),nPackets)
+				first=numpy.cumsum(nPackets)-nPackets
+				packet=numpy.arange(len(panel))-first[panel]
+				units=numpy.minimum(maxPerBlob,nBlobs[panel]-packet*maxPerBlob)
+		else:
+			panel=numpy.repeat(numpy.arange(N),nBlobs)
+			units=numpy.ones(len(panel),int)
 		
 		#introduce Chorin blobs
-		BlobList=dfn.vortexList()
-		for i in range(N):
-			for j in range(nBlobs[i]):
-				BlobList.addVortex(position=blobLoc[i], strength=direc[i]*blobStren, blobType=2, delta=delta, traceFlag=0)
-		toMod.append(BlobList)
-		fieldGens.append(BlobList)
+		if persist:
+			if not hasattr(self,'blobStore'):
+				self.blobStore=dfn.vortexList()
+			if not any([eachList is self.blobStore for eachList in toMod]):
+				toMod.append(self.blobStore)
+			if not any([eachList is self.blobStore for eachList in fieldGens]):
+				fieldGens.append(self.blobStore)
+			BlobList=self.blobStore
+		else:
+			BlobList=dfn.vortexList()
+			toMod.append(BlobList)
+			fieldGens.append(BlobList)
+		BlobList.addVortices(blobLoc[panel],direc[panel]*blobStren*units,blobType=2,delta=delta,traceFlag=0)
+		
+		#Keep metrics of released blobs, particles and lists
+		if not hasattr(self,'nsMetrics'):
+			self.nsMetrics={'steps':0,'unitsReleased':0,'blobsReleased':0}
+		self.nsMetrics['steps']=self.nsMetrics['steps']+1
+		self.nsMetrics['unitsReleased']=self.nsMetrics['unitsReleased']+int(nBlobs.sum())
+		self.nsMetrics['blobsReleased']=self.nsMetrics['blobsReleased']+len(panel)
+		self.nsMetrics['nParticles']=sum([eachList.nPoints for eachList in toMod])
+		self.nsMetrics['nLists']=len(toMod)
+		self.nsMetrics['nFieldGens']=len(fieldGens)
+		instrument.count('noSlip.units',int(nBlobs.sum()))
+		instrument.count('noSlip.blobs',len(panel))
+		instrument.gauge('particles',self.nsMetrics['nParticles'])
+		instrument.gauge('lists',len(toMod))
+		instrument.gauge('fieldGens',len(fieldGens))
 		return()
 		
 #### Non penetration wall boundary functions ####
 
-def NPLinList(points,vcp,A,cp,normals):
-	"""Gives back a linear vortex sheet list, which will satisfy non penetration boundary conditions on wall defined by points. Points should be in the order of wall boundary line"""
+def fusedVelField(posList,fieldGens,vinf=0.0,BCList=[],velField=dfn.velField,slip=True):
+	"""Velocity at every set of positions in posList, with no penetration satisfied on all walls of BCList.
+	Positions, control points (and slip control points if slip) of all walls are evaluated against fieldGens in a single velField call.
+	No penetration sheets are then found from the control point velocities and their effect is added to the other points.
+	Sets vcp (and vcps) of each wall as findVcp and findVcps do, and removes the sheets from fieldGens again.
+	Sheets of each wall (linList) are tagged with the state of the sources they were solved for (linListState).
+	If every wall already has sheets for the current sources (sheetsValid), control points are not evaluated and
+	the sheets are used as they are.
+	Returns a list of velocity arrays, one for each set of posList"""
+	posList=[numpy.asarray(eachPos,dtype=float).reshape(-1,2) for eachPos in posList]
+	nBC=len(BCList)
+	reuse=nBC>0 and sheetsValid(BCList,fieldGens,vinf)
+	nSolve=0 if reuse else nBC
+	sets=[] if reuse else [eachBC.cp for eachBC in BCList]
+	if slip:
+		sets=sets+[eachBC.cps for eachBC in BCList]
+	sets=sets+posList
+	if len(sets)==0:
+		# Nothing to evaluate, and no sheets to solve
+		return([])
+	sizes=[len(eachSet) for eachSet in sets]
+	with instrument.phase('fused.velField'):
+		field=velField(numpy.concatenate(sets),fieldGens,vinf)
+	parts=numpy.split(field,numpy.cumsum(sizes)[:-1])
+	if slip:
+		instrument.count('wall.slipPoints',sum([len(eachBC.cps) for eachBC in BCList]))
+	
+	# Satisfy no penetration with velocities at control points, then add sheets at all other points
+	if reuse:
+		instrument.count('wall.sheetReuses')
+		sheets=[eachBC.linList for eachBC in BCList]
+	else:
+		instrument.count('wall.panels',sum([len(eachBC.points) for eachBC in BCList]))
+		for i in range(nBC):
+			BCList[i].vcp=parts[i]
+		[eachBC.applyNPBC(fieldGens) for eachBC in BCList]
+		if nBC>0:
+			state=sourceState(fieldGens[:BCList[0].fieldGenIndex],vinf)
+			for eachBC in BCList:
+				eachBC.linListState=state
+		sheets=[fieldGens[eachBC.fieldGenIndex] for eachBC in BCList]
+	restPos=numpy.concatenate(sets[nSolve:]+[numpy.zeros([0,2])])
+	rest=numpy.concatenate(parts[nSolve:]+[numpy.zeros([0,2])])
+	with instrument.phase('fused.sheetEffect'):
+		for eachSheet in sheets:
+			rest=rest+eachSheet.batchFieldEffect(restPos)
+	if not reuse:
+		[eachBC.closeNPBC(fieldGens) for eachBC in reversed(BCList)]
+	
+	parts=numpy.split(rest,numpy.cumsum(sizes[nSolve:])[:-1])
+	if slip:
+		for i in range(nBC):
+			BCList[i].vcps=parts[i]
+		parts=parts[nBC:]
+	return(parts)
+
+def sourceState(fieldGens,vinf=0.0):
+	"""Positions, strengths, blob types and deltas of the vortex lists of fieldGens and vinf as one array, to tell whether
+	no penetration sheets solved for them are still valid. None if fieldGens has other field generators (e.g. sheets or
+	the frozen fields of tInt.advectMultiRate), whose effect is not compared"""
+	[pos,strength,blobType,delta,others]=dfn.gatherSources(fieldGens)
+	if len(others)>0:
+		return(None)
+	return(numpy.concatenate([pos.flatten(),strength,blobType,delta,numpy.zeros(2)+vinf]))
+
+def sheetsValid(BCList,fieldGens,vinf=0.0):
+	"""True if every wall of BCList has sheets (linList) solved by fusedVelField for the current sources of fieldGens"""
+	state=sourceState(fieldGens,vinf)
+	if state is None:
+		return(False)
+	return(all([numpy.array_equal(getattr(eachBC,'linListState',None),state) for eachBC in BCList]))
+
+def NPLinList(points,vcp,A,cp,normals,Ainv=None):
+	"""Gives back a linear vortex sheet list, which will satisfy non penetration boundary conditions on wall defined by points. Points should be in the order of wall boundary line.
+	If Ainv (from factorA) is given, it is used instead of solving with A"""
 	B=NPB(points,vcp,normals)
-	gammas=findGamma(A,B)
+	if Ainv is None:
+		gammas=findGamma(A,B)
+	else:
+		gammas=solveGamma(Ainv,B)
 	linList=dfn.linVortList()
 	for i in range(len(points)):
 		if i==len(points)-1:
@@ -93,45 +252,91 @@ def NPLinList(points,vcp,A,cp,normals):
 			linList.addLinVortex(gammas[i],gammas[i+1],points[i],points[i+1])
 	return(linList)
 
-def linNPA(points,cp,normals):
-	"""returns the A matrix required for calculating wall Non penetration boundary conditions based on linear vortex panels"""
+def linNPA(points,cp,normals,cache=True,cacheDir=None):
+	"""returns the A matrix required for calculating wall Non penetration boundary conditions based on linear vortex panels.
+	A[i][j] is the normal velocity at control point i due to unit gamma at point j, through the panels on both sides of point j.
+	Matrices are kept in memory, keyed by a hash of points, cp and normals. They are also kept on disk in cacheDir
+	(CACHEDIR by default) if it is not None"""
+	key=geometryKey(points,cp,normals)
+	if cache and key in NPACACHE:
+		return(NPACACHE[key].copy())
+	fileName=None
+	if cacheDir is None:
+		cacheDir=CACHEDIR
+	if cache and cacheDir is not None:
+		fileName=os.path.join(cacheDir,key+'.npy')
+		if os.path.exists(fileName):
+			A=numpy.load(fileName)
+			NPACACHE[key]=A
+			return(A.copy())
+	
+	# Panel j goes from point j to point j+1, gamma at point j is gamma1 of panel j and gamma2 of panel j-1
+	points=numpy.asarray(points,dtype=float)
+	normals=numpy.asarray(normals,dtype=float)
 	N=len(points)
+	geom=dfn.panelGeometry(points,numpy.roll(points,-1,axis=0))
+	[c1,c2]=dfn.panelInfluence(cp,geom)
+	vel=c1+numpy.roll(c2,1,axis=1)
 	A=numpy.zeros([N+1,N])
-	gamma=numpy.zeros(N)
-	for i in range(N):
-		for j in range(N):
-			l1=j
-			if j==N-1:
-				l2=0
-				l0=j-1
-			elif j==0:
-				l2=j+1
-				l0=-1
-			else:
-				l2=j+1
-				l0=j-1
-			linVo1=dfn.linVortex(1.,0.,points[l1],points[l2])
-			linVo2=dfn.linVortex(0.,1.,points[l0],points[l1])
-			vel=linVo1.fieldEffect(cp[i])+linVo2.fieldEffect(cp[i])
-			vdotN=vel.dot(normals[i])
-			A[i][j]=vdotN
+	A[:N]=vel.real*normals[:,0][:,None]-vel.imag*normals[:,1][:,None]
 	
 	#Keep circulation zero
 	A[N][:]=1.0
+	
+	if cache:
+		NPACACHE[key]=A.copy()
+		if fileName is not None:
+			saveAtomic(fileName,A)
 	return(A)
 
+def geometryKey(points,cp,normals):
+	"""Hash of a wall geometry"""
+	h=hashlib.sha1()
+	for eachArray in [points,cp,normals]:
+		eachArray=numpy.ascontiguousarray(eachArray,dtype=float)
+		h.update(str(eachArray.shape).encode())
+		h.update(eachArray.tostring())
+	return(h.hexdigest())
+
+def saveAtomic(fileName,A):
+	"""Save an array in .npy format, through a temporary file, so that a half written file is never seen"""
+	try:
+		if not os.path.isdir(os.path.dirname(fileName)):
+			os.makedirs(os.path.dirname(fileName))
+		tmpName=fileName+'.%i.tmp' %os.getpid()
+		f=open(tmpName,'wb')
+		numpy.save(f,A)
+		f.close()
+		os.rename(tmpName,fileName)
+	except (IOError,OSError):
+		print "Could not write cache file %s" %fileName
+	return()
+
 def findGamma(A,B):
 	"""Solve Ax=B to give gammas for boundary conditions"""
 	gamma=numpy.linalg.lstsq(A,B)
 	return(gamma[0])
 
+def factorA(A):
+	"""Factorize A once for all the right hand sides. Gives the pseudo-inverse of A,
+	with which solveGamma gives the same least squares solution as findGamma"""
+	return(numpy.linalg.pinv(A))
+
+def solveGamma(Ainv,B):
+	"""Solve Ax=B with Ainv from factorA. B can have one right hand side in each column"""
+	return(Ainv.dot(B))
 
 def NPB(points,vcp,normals):
-	"""Give the B matrx(right hand side) for boundary condition matrix for wall non penetration boundary conditions"""
+	"""Give the B matrx(right hand side) for boundary condition matrix for wall non penetration boundary conditions.
+	vcp can also be a batch of velocity sets (sets x points x 2), giving one column of B for each set"""
 	N=len(points)
+	vcp=numpy.asarray(vcp,dtype=float)
+	if vcp.ndim==3:
+		B=numpy.zeros([N+1,len(vcp)])
+		B[:N]=-(vcp*numpy.asarray(normals)).sum(axis=2).transpose()
+		return(B)
 	B=numpy.zeros(N+1)
-	for i in range(N):
-		B[i]=	-vcp[i].dot(normals[i])
+	B[:N]=-(vcp*numpy.asarray(normals)).sum(axis=1)
 	return(B)
 
 #### Functions for reading or defining boundary points ####	
@@ -161,35 +366,50 @@ def cylBCPoints(rad=1.,NPoints=20):
 		cpl[i]=cp
 	
 	def inFunction(pos):
-		"""A function which says whether a point is inside the boundary or nor"""
-		return(pos[0]**2+pos[1]**2<rad**2)
+		"""A function which says whether a point is inside the boundary or nor. Works on an array of points too"""
+		return(pos[...,0]**2+pos[...,1]**2<rad**2)
 	
 	def reflectFunction(pos,dPos):
-		"""A function that reflects a point which otherwise could have got inside the boundary"""
+		"""A function that reflects a point which otherwise could have got inside the boundary.
+		Works on arrays of points too"""
 	
 		#Find intersection point
-		A=dPos.dot(dPos)
-		B=2*pos.dot(dPos)
-		C=pos.dot(pos)-rad**2
+		A=(dPos*dPos).sum(axis=-1)
+		B=2*(pos*dPos).sum(axis=-1)
+		C=(pos*pos).sum(axis=-1)-rad**2
 		L1=(-B+(B**2-4*A*C)**0.5)/2/A
 		L2=(-B-(B**2-4*A*C)**0.5)/2/A
 	
 		# use a point with minimum L
-		if abs(L1)<abs(L2):
-			L=L1
-		else:
-			L=L2  
-		iPoint=pos+L*dPos
+		L=numpy.where(abs(L1)<abs(L2),L1,L2)
+		iPoint=pos+L[...,None]*dPos
 	
 		#Find normal at intersection point
-		iNormal=iPoint/(iPoint.dot(iPoint))**0.5
+		iNormal=iPoint/((iPoint*iPoint).sum(axis=-1)[...,None])**0.5
 	
 		#Find reflected position
-		newPos=pos+dPos-((dPos.dot(iNormal))*iNormal)
+		newPos=pos+dPos-((dPos*iNormal).sum(axis=-1)[...,None]*iNormal)
 		return(newPos)
+	inFunction.acceptsArrays=True
+	reflectFunction.acceptsArrays=True
 	return(points,cpl,normals,inFunction,reflectFunction)
 
 #### Tests ####
+def testLinNPA(Np=40):
+	"""Compare A matrix with element by element assembly using linVortex objects"""
+	[points,cpl,normals,iF,rF]=cylBCPoints(1.0,Np)
+	A=linNPA(points,cpl,normals,cache=False)
+	Aloop=numpy.zeros([Np+1,Np])
+	for i in range(Np):
+		for j in range(Np):
+			linVo1=dfn.linVortex(1.,0.,points[j],points[(j+1)%Np])
+			linVo2=dfn.linVortex(0.,1.,points[j-1],points[j])
+			Aloop[i][j]=(linVo1.fieldEffect(cpl[i])+linVo2.fieldEffect(cpl[i])).dot(normals[i])
+	Aloop[Np][:]=1.0
+	err=abs(A-Aloop).max()
+	print "Maximum difference between vectorized and element by element A = %e" %err
+	return(err)
+
 def testCylBC1(Np=50):
 	"""Test cylinder-constant velocity-no penetration boundary condition"""
 	vinf=numpy.array([10.0,0.0])